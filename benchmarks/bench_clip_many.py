@@ -0,0 +1,68 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+benchmark of clip.clip_many() against a sequential loop of clip_from_bbox()
+
+Usage: python bench_clip_many.py PARENT.osm.pbf XMIN YMIN XMAX YMAX
+       [--n-regions 16] [--kernel osmosis]
+
+The bounding box XMIN YMIN XMAX YMAX (e.g. of the parent file) is split into a grid of n-regions cells,
+which are clipped once one after the other and once in a single pass.
+"""
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+from osm_flex.clip import clip_from_bbox, clip_many
+
+
+def _grid_bboxes(bounds, n_regions):
+    n_cells = int(np.ceil(np.sqrt(n_regions)))
+    xs = np.linspace(bounds[0], bounds[2], n_cells + 1)
+    ys = np.linspace(bounds[1], bounds[3], n_cells + 1)
+    return {f'cell_{i}_{j}': [xs[i], ys[j], xs[i+1], ys[j+1]]
+            for i in range(n_cells) for j in range(n_cells)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('-----')[1])
+    parser.add_argument('parent', type=pathlib.Path)
+    parser.add_argument('bounds', type=float, nargs=4)
+    parser.add_argument('--n-regions', type=int, default=16)
+    parser.add_argument('--kernel', default='osmosis')
+    args = parser.parse_args()
+
+    bboxes = _grid_bboxes(args.bounds, args.n_regions)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        for name, bbox in bboxes.items():
+            clip_from_bbox(bbox, args.parent,
+                           pathlib.Path(tmpdir, f'seq_{name}.osm.pbf'),
+                           kernel=args.kernel)
+        t_sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        clip_many(bboxes, args.parent, pathlib.Path(tmpdir, 'many'),
+                  kernel=args.kernel)
+        t_many = time.perf_counter() - start
+
+    print(f'{len(bboxes)} regions, kernel {args.kernel}')
+    print(f'sequential clip_from_bbox: {t_sequential:8.2f} s')
+    print(f'clip_many:                 {t_many:8.2f} s')
+    print(f'speed-up:                  {t_sequential / t_many:8.2f} x')
+
+
+if __name__ == '__main__':
+    main()
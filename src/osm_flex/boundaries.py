@@ -0,0 +1,310 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+indexed access to Natural Earth boundaries
+"""
+
+import functools
+import logging
+import os
+import pathlib
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+import shapely
+from cartopy.io import shapereader
+
+from osm_flex.config import BOUNDARY_INDEX_DIR
+
+LOGGER = logging.getLogger(__name__)
+
+# Natural Earth layer name, ISO3 field and name field per boundary layer
+NE_LAYERS = {
+    'admin0': ('admin_0_countries', 'ADM0_A3', 'NAME'),
+    'admin1': ('admin_1_states_provinces', 'adm0_a3', 'name_en'),
+}
+
+# version of the index file format
+_INDEX_VERSION = 1
+
+
+def _build_index(shp_file, iso_field, name_field):
+    """
+    read all records of a shapefile into arrays of ISO3 codes, names and
+    WKB geometries
+    """
+    iso3, names, wkb = [], [], []
+    for rec in shapereader.Reader(shp_file).records():
+        iso3.append(rec.attributes[iso_field])
+        names.append(rec.attributes[name_field])
+        wkb.append(shapely.to_wkb(rec.geometry))
+    return {'version': _INDEX_VERSION,
+            'source': str(shp_file),
+            'mtime_ns': os.stat(shp_file).st_mtime_ns,
+            'iso3': np.array(iso3, dtype=object),
+            'name': np.array(names, dtype=object),
+            'wkb': np.array(wkb, dtype=object)}
+
+
+def _read_index(shp_file, iso_field, name_field, index_file):
+    """
+    load the index of a shapefile from index_file, or build and store it if
+    the file is missing or outdated
+    """
+    index_file = pathlib.Path(index_file)
+    if index_file.is_file():
+        with open(index_file, 'rb') as file:
+            index = pickle.load(file)
+        if (index.get('version') == _INDEX_VERSION
+                and index['source'] == str(shp_file)
+                and index['mtime_ns'] == os.stat(shp_file).st_mtime_ns):
+            return index
+    LOGGER.info('Indexing boundaries of %s', shp_file)
+    index = _build_index(shp_file, iso_field, name_field)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=index_file.parent, suffix='.tmp', delete=False) as file:
+        pickle.dump(index, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file.name, index_file)
+    return index
+
+
+def _group_positions(keys):
+    """positions of the entries of keys, grouped by key"""
+    order = np.argsort(keys, kind='stable')
+    unique, starts = np.unique(keys[order], return_index=True)
+    return dict(zip(unique.tolist(), np.split(order, starts[1:])))
+
+
+class _Layer:
+    """boundary records of one layer with lookups by ISO3 code and name"""
+
+    def __init__(self, index):
+        self.iso3 = index['iso3']
+        self.name = index['name']
+        self.geometry = shapely.from_wkb(index['wkb'])
+        self.by_iso3 = _group_positions(self.iso3.astype(str))
+        self.by_name = _group_positions(
+            np.char.lower(self.name.astype(str)))
+
+
+@functools.lru_cache(maxsize=None)
+def load_boundaries(layer='admin0', resolution='10m',
+                    index_dir=BOUNDARY_INDEX_DIR):
+    """
+    Load a Natural Earth boundary layer once per process.
+
+    The records are kept as WKB in a local index file in index_dir, which is
+    much faster to load than the shapefile, and rebuilt whenever the
+    shapefile changes.
+
+    Parameters
+    ----------
+    layer : str, optional
+        'admin0' (countries, default) or 'admin1' (states and provinces)
+    resolution : str, optional
+        Natural Earth resolution, '10m' (default), '50m' or '110m'
+    index_dir : pathlib.Path, optional
+        directory of the index files. Default is BOUNDARY_INDEX_DIR.
+
+    Returns
+    -------
+    _Layer
+        records with attributes iso3, name and geometry (arrays) and dicts
+        by_iso3, by_name (lower case) mapping to the record positions
+    """
+    if layer not in NE_LAYERS:
+        raise ValueError(f"Layer '{layer}' is not valid. Abort.")
+    ne_name, iso_field, name_field = NE_LAYERS[layer]
+    shp_file = shapereader.natural_earth(resolution=resolution,
+                                         category='cultural', name=ne_name)
+    index = _read_index(shp_file, iso_field, name_field,
+                        pathlib.Path(index_dir, f'{ne_name}_{resolution}.pkl'))
+    return _Layer(index)
+
+
+def _check_countries(countries):
+    if isinstance(countries, str):
+        return [countries]
+    if not all(isinstance(country, str) for country in countries):
+        LOGGER.error("countries need to be of type str")
+        raise TypeError("Invalid type for input parameter 'countries'")
+    return list(countries)
+
+
+def country_shapes(countries, resolution='10m', by_name=True):
+    """
+    Shapes of countries according to Natural Earth.
+
+    Parameters
+    ----------
+    countries : str or list of str
+        ISO3 codes (ADM0_A3) or English names of the countries
+    resolution : str, optional
+        Natural Earth resolution. Default is '10m'.
+    by_name : bool, optional
+        whether countries are also looked up by their English name if they
+        are not an ISO3 code. Default is True.
+
+    Returns
+    -------
+    dict
+        (multi-)polygon per country, with the entries of countries as keys
+
+    Raises
+    ------
+    LookupError
+        if a country is not found
+    """
+    boundaries = load_boundaries('admin0', resolution)
+    shapes = {}
+    for country in _check_countries(countries):
+        pos = boundaries.by_iso3.get(country)
+        if pos is None and by_name:
+            pos = boundaries.by_name.get(country.lower())
+        if pos is None:
+            raise LookupError(
+                f'natural_earth records are empty for country {country}')
+        shapes[country] = boundaries.geometry[pos[0]]
+    return shapes
+
+
+def admin1_shapes(countries, resolution='10m'):
+    """
+    Shapes of the admin1 regions (states, provinces) of countries according
+    to Natural Earth.
+
+    Parameters
+    ----------
+    countries : str or list of str
+        ISO3 codes (adm0_a3) of the countries
+    resolution : str, optional
+        Natural Earth resolution. Default is '10m'.
+
+    Returns
+    -------
+    dict
+        per country, a dict of the admin1 shapes with their (English) names
+        as keys
+
+    Raises
+    ------
+    LookupError
+        if no admin1 regions are found for a country
+    """
+    boundaries = load_boundaries('admin1', resolution)
+    shapes = {}
+    for country in _check_countries(countries):
+        pos = boundaries.by_iso3.get(country)
+        if pos is None:
+            raise LookupError(
+                f'natural_earth records are empty for country {country}')
+        shapes[country] = dict(zip(boundaries.name[pos].tolist(),
+                                   boundaries.geometry[pos]))
+    return shapes
+
+
+def assign_regions(gdf, country, split=False, as_dict=False,
+                   column='region'):
+    """
+    Label features with the region they are located in, e.g. the admin1
+    region of extracted features.
+
+    Points are located directly, lines and polygons by a representative
+    point on their surface (shapely.point_on_surface), all at once with a
+    bulk query of a spatial index of the regions.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        features in EPSG:4326
+    country : str or dict
+        ISO3 code of the country, whose admin1 regions (see admin1_shapes())
+        are used, or a dict of region shapes with the region names as keys
+    split : bool, optional
+        if True, lines and polygons crossing region boundaries, also into
+        the area outside of all regions, are split into one part per region.
+        The part outside of all regions, if any, is kept with a missing
+        region. Default is False.
+    as_dict : bool, optional
+        if True, return a gdf per region instead of a single gdf. Features
+        outside of all regions are dropped then. Default is False.
+    column : str, optional
+        name of the region column. Default is 'region'.
+
+    Returns
+    -------
+    gpd.GeoDataFrame or dict
+        gdf with the region name in column (missing outside of all
+        regions), or a dict of gdfs with the region names as keys
+    """
+    regions = admin1_shapes(country)[country] if isinstance(country, str) \
+        else country
+    names = np.array(list(regions), dtype=object)
+    tree = shapely.STRtree(list(regions.values()))
+    geometry = gdf.geometry.values
+    is_point = shapely.get_dimensions(geometry) == 0
+
+    feature_idx, region_idx = tree.query(shapely.point_on_surface(geometry),
+                                         predicate='intersects')
+    # first region of features on the boundaries between regions
+    feature_idx, first = np.unique(feature_idx, return_index=True)
+    labels = np.full(len(gdf), None, dtype=object)
+    labels[feature_idx] = names[region_idx[first]]
+    gdf = gdf.assign(**{column: labels})
+
+    if split:
+        feature_idx, region_idx = tree.query(geometry, predicate='intersects')
+        lines = ~is_point[feature_idx]
+        feature_idx, region_idx = feature_idx[lines], region_idx[lines]
+        # features in several regions, or partly outside of their only one
+        crossing = np.bincount(feature_idx, minlength=len(gdf))[
+            feature_idx] > 1
+        crossing[~crossing] = ~shapely.covered_by(
+            geometry[feature_idx[~crossing]],
+            tree.geometries[region_idx[~crossing]])
+        feature_idx, region_idx = feature_idx[crossing], region_idx[crossing]
+        if len(feature_idx):
+            order = np.argsort(feature_idx, kind='stable')
+            feature_idx, region_idx = feature_idx[order], region_idx[order]
+            parts = shapely.intersection(geometry[feature_idx],
+                                         tree.geometries[region_idx])
+            # drop parts which only touch a region
+            valid = (shapely.get_dimensions(parts)
+                     == shapely.get_dimensions(geometry[feature_idx]))
+            # remainders outside of all regions, from the union of the
+            # contiguous parts of each feature
+            split_idx, starts = np.unique(feature_idx, return_index=True)
+            ends = [*starts[1:], len(parts)]
+            rest = shapely.difference(geometry[split_idx], [
+                shapely.union_all(parts[start:end])
+                for start, end in zip(starts, ends)])
+            outside = ~shapely.is_empty(rest) & (
+                shapely.get_dimensions(rest)
+                == shapely.get_dimensions(geometry[split_idx]))
+            split_gdf = gdf.iloc[np.concatenate(
+                [feature_idx[valid], split_idx[outside]])].copy()
+            split_gdf[column] = np.concatenate(
+                [names[region_idx[valid]], np.full(outside.sum(), None)])
+            split_gdf = split_gdf.set_geometry(
+                np.concatenate([parts[valid], rest[outside]]), crs=gdf.crs)
+            keep = np.ones(len(gdf), dtype=bool)
+            keep[feature_idx] = False
+            gdf = pd.concat([gdf[keep], split_gdf])
+            LOGGER.info('split %d features crossing region boundaries, %d of '
+                        'them partly outside of all regions',
+                        len(split_idx), outside.sum())
+
+    if not as_dict:
+        return gdf
+    LOGGER.info('%d features outside of all regions',
+                gdf[column].isna().sum())
+    return {name: group for name, group in gdf.groupby(column, sort=False)}
@@ -0,0 +1,216 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+content-addressed cache for clipped osm.pbf files
+
+Cached files are stored as <key>.osm.pbf in the cache directory, where the
+key is a hash of the parent file identity, the clipping shape, the kernel
+and its options. Files are placed in and taken from the cache via hard links
+(or copies across file systems), and each update is atomic: the file is
+first linked to a temporary name and then renamed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import uuid
+
+import shapely
+
+from osm_flex.config import CLIP_CACHE_DIR, CLIP_CACHE_QUOTA
+from osm_flex.download import read_manifest_entry
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _hash_file(path, chunk_size=2**20):
+    """sha256 of the content of a file"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _file_identity(path, hash_content=False):
+    """
+    Identity of a file: its size and modification time, or the hash of its
+    content if hash_content is True (slow for large files, unless the hash
+    was recorded in the download manifest).
+    """
+    if hash_content:
+        entry = read_manifest_entry(path)
+        if entry is not None and 'sha256' in entry:
+            return entry['sha256']
+        return _hash_file(path)
+    stat = pathlib.Path(path).stat()
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def _shape_hash(shape):
+    """
+    Canonical hash of a clipping shape: a bounding box, the path to a .poly
+    file (hashed by content) or a list of shapely geometries.
+    """
+    if isinstance(shape, (pathlib.Path, str)):
+        return _hash_file(shape)
+    if isinstance(shape, shapely.Geometry):
+        shape = [shape]
+    if isinstance(shape[0], shapely.Geometry):
+        wkb = shapely.to_wkb(shapely.normalize(shape), hex=True)
+        return hashlib.sha256(''.join(wkb).encode()).hexdigest()
+    return hashlib.sha256(
+        json.dumps([float(coord) for coord in shape]).encode()).hexdigest()
+
+
+def clip_cache_key(shape, osmpbf_clip_from, kernel, kernel_options=None,
+                   hash_parent=False):
+    """
+    Cache key of a clipped file.
+
+    Parameters
+    ----------
+    shape : list or str or pathlib.Path
+        bounding box [xmin, ymin, xmax, ymax], path to a .poly file or list
+        of shapely (Multi-)Polygons
+    osmpbf_clip_from : str or pathlib.Path
+        file path to the parent osm.pbf file
+    kernel : str
+        name of the clipping kernel
+    kernel_options : dict, optional
+        further options of the clipping kernel
+    hash_parent : bool, optional
+        identify the parent file by the hash of its content instead of its
+        size and modification time. Default is False.
+
+    Returns
+    -------
+    str
+        hex digest identifying the clipped file
+    """
+    key = json.dumps({
+        'parent': _file_identity(osmpbf_clip_from, hash_parent),
+        'shape': _shape_hash(shape),
+        'kernel': kernel,
+        'options': kernel_options or {},
+        }, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _link_atomic(source, target):
+    """
+    Hard link (or copy, across file systems) source to target, replacing an
+    existing target atomically
+    """
+    target = pathlib.Path(target)
+    tmp = target.with_name(f'.{target.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+
+
+def _used_file(path):
+    """
+    hidden side file whose modification time is the last use of a cached
+    file. The cached file itself is not touched: it is hard linked to
+    outputs, whose modification time identifies them (see clip_cache_key()).
+    """
+    path = pathlib.Path(path)
+    return path.with_name(f'.{path.name}.used')
+
+
+def _mark_used(path):
+    """record the use of a cached file, for the eviction"""
+    _used_file(path).touch()
+
+
+def _last_used(path, stat):
+    """time of the last use of a cached file in ns, see _used_file()"""
+    try:
+        return _used_file(path).stat().st_mtime_ns
+    except FileNotFoundError:
+        return stat.st_mtime_ns
+
+
+def fetch_from_cache(key, osmpbf_output, cache_dir=CLIP_CACHE_DIR):
+    """
+    Place the cached file for key at osmpbf_output, if it exists.
+
+    Returns
+    -------
+    bool
+        whether the file was found in the cache
+    """
+    cached = pathlib.Path(cache_dir, f'{key}.osm.pbf')
+    try:
+        _link_atomic(cached, osmpbf_output)
+    except FileNotFoundError:
+        return False
+    # mark as recently used, for the eviction
+    _mark_used(cached)
+    LOGGER.info('Reuse cached clip %s for %s', cached.name, osmpbf_output)
+    return True
+
+
+def add_to_cache(key, osmpbf_file, cache_dir=CLIP_CACHE_DIR,
+                 quota=CLIP_CACHE_QUOTA):
+    """
+    Add a clipped file to the cache under key, and evict the least recently
+    used files if the cache exceeds the quota.
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cached = cache_dir / f'{key}.osm.pbf'
+    _link_atomic(osmpbf_file, cached)
+    _mark_used(cached)
+    evict_cache(cache_dir, quota)
+
+
+def evict_cache(cache_dir=CLIP_CACHE_DIR, quota=CLIP_CACHE_QUOTA,
+                pattern='*.osm.pbf', keep=None):
+    """
+    Delete the least recently used files in the cache until its size is
+    below quota. The last use of a file is the modification time of its side
+    file .<name>.used if there is one, else of the file itself.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlib.Path, optional
+        cache directory. Default is CLIP_CACHE_DIR.
+    quota : float, optional
+        maximal size of the cache in bytes. Default is CLIP_CACHE_QUOTA.
+        Use 0 to clear the cache.
+    pattern : str, optional
+        glob pattern of the cached files. Default is '*.osm.pbf'.
+    keep : pathlib.Path, optional
+        a file which is not deleted, e.g. the one in use. Default is None.
+    """
+    files = []
+    for path in pathlib.Path(cache_dir).glob(pattern):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((_last_used(path, stat), stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= quota:
+            break
+        if keep is not None and path == pathlib.Path(keep):
+            continue
+        LOGGER.info('Evict %s from %s', path.name, cache_dir)
+        path.unlink(missing_ok=True)
+        _used_file(path).unlink(missing_ok=True)
+        total -= size
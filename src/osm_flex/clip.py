@@ -11,14 +11,29 @@ PARTICULAR PURPOSE.  See the GNU General Public License for more details.
 clipping functions
 """
 
+import asyncio
+import collections
+import dataclasses
+import hashlib
+import inspect
+import json
 import logging
 import numpy as np
+import os
 import pathlib
 import shapely
-import subprocess
-from cartopy.io import shapereader
+import tempfile
+import time
+from typing import Optional
 
-from osm_flex.config import POLY_DIR, OSMCONVERT_PATH
+from osm_flex.boundaries import admin1_shapes, country_shapes
+from osm_flex.cache import (add_to_cache, clip_cache_key, evict_cache,
+                            fetch_from_cache)
+from osm_flex.config import (POLY_CACHE_QUOTA, POLY_DIR, OSMCONVERT_PATH,
+                             OSM_DATA_DIR)
+from osm_flex.download import read_manifest_entry
+from osm_flex.external import _run_command
+from osm_flex.pbf import read_header
 LOGGER = logging.getLogger(__name__)
 
 
@@ -35,23 +50,16 @@ def get_admin1_shapes(country):
     country_shapes : dict
         Shapes (according to Natural Earth) of admin1 regions of country
         with name as keys
+
+    See also
+    --------
+    boundaries.admin1_shapes() to query many countries at once.
     """
 
     if not isinstance(country, str):
         LOGGER.error("country needs to be of type str")
         raise TypeError("Invalid type for input parameter 'country'")
-    admin1_file = shapereader.natural_earth(resolution='10m',
-                                            category='cultural',
-                                            name='admin_1_states_provinces')
-    admin1_recs = shapereader.Reader(admin1_file)
-    admin1_shapes = {}
-    for rec in admin1_recs.records():
-        if rec.attributes['adm0_a3'] == country:
-            name = rec.attributes['name_en']
-            admin1_shapes[name] = rec.geometry
-    if not admin1_shapes:
-        raise LookupError(f'natural_earth records are empty for country {country}')
-    return admin1_shapes
+    return admin1_shapes(country)[country]
 
 def get_country_shape(country):
     """Provide Natural Earth registry info and shape files for admin1 regions
@@ -66,31 +74,57 @@ def get_country_shape(country):
     -------
     country_shape : (multi-)polygon
         Shape of the country according to Natural Earth.
+
+    See also
+    --------
+    boundaries.country_shapes() to query many countries at once, also by
+    name.
     """
 
     if not isinstance(country, str):
         LOGGER.error("country needs to be of type str")
         raise TypeError("Invalid type for input parameter 'country'")
-    admin0_file = shapereader.natural_earth(resolution='10m',
-                                            category='cultural',
-                                            name='admin_0_countries')
-    admin0_recs = shapereader.Reader(admin0_file)
-    for rec in admin0_recs.records():
-        if rec.attributes['ADM0_A3'] == country:
-            return rec.geometry
-    raise LookupError(f'natural_earth records are empty for country {country}')
+    return country_shapes(country, by_name=False)[country]
 
 
-def _simplify_shapelist(geom_list, thres=None):
+def _simplify_shapelist(geom_list, thres=None, max_vertices=None):
     """
     remove tiny shapes and simplify outlines to save on file size for
     .poly files
+
+    Parameters
+    ----------
+    geom_list : list
+        list of shapely (Multi-)Polygons
+    thres : float, optional
+        minimal area of the kept shapes. Default is 0.1 if the shapes cover
+        more than 1 square degree, 0.01 otherwise.
+    max_vertices : int, optional
+        vertex budget of all shapes together. The simplification tolerance
+        is doubled until the shapes fit into the budget. Default is no budget.
     """
+    geoms = np.asarray(geom_list, dtype=object)
+    areas = shapely.area(geoms)
     if thres is None:
-        thresh = 0.1 if shapely.unary_union(geom_list).area > 1 else 0.01
-    geom_list = [geom for geom in geom_list if geom.area>thresh]
-    return [geom.simplify(tolerance=0.01, preserve_topology=True) for
-            geom in geom_list]
+        thres = 0.1 if areas.sum() > 1 else 0.01
+    geoms = geoms[areas > thres]
+
+    tolerance = 0.01
+    simplified = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    if max_vertices is not None and len(geoms):
+        bounds = shapely.total_bounds(geoms)
+        extent = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+        while (shapely.get_num_coordinates(simplified).sum() > max_vertices
+               and tolerance < extent):
+            tolerance *= 2
+            simplified = shapely.simplify(geoms, tolerance,
+                                          preserve_topology=True)
+        n_vertices = shapely.get_num_coordinates(simplified).sum()
+        if n_vertices > max_vertices:
+            LOGGER.warning('Shapes have %d vertices after simplification, '
+                           'more than the budget of %d.', n_vertices,
+                           max_vertices)
+    return list(simplified)
 
 
 def _shapely2poly(geom_list, filename):
@@ -98,11 +132,14 @@ def _shapely2poly(geom_list, filename):
     Convert list of shapely (multi)polygon(s) into .poly files needed for
     osmosis to generate cut-outs from bigger osm.pbf files.
 
+    The file is written under a temporary name and then linked to filename,
+    such that concurrent writers never see or produce a partial file.
+
     Parameters
     ---------
     geom_list : list
         list of polygon, polygons or multipolygons containing a (complex) shape
-        to be cut out of a bigger file
+        to be cut out of a bigger file. Interior rings are written as holes.
     filename : pathlib.Path or str
         output filename including directory path.
 
@@ -120,32 +157,91 @@ def _shapely2poly(geom_list, filename):
     if filename.exists():
         raise ValueError(f'File {filename} already exists, aborting.')
 
-    # start writing the .poly file
-    file = open(filename, 'w')
-    file.write('Polygons' + "\n")
-
-    # loop over the different polygons, get their exterior and write the
-    # coordinates of the ring to the .poly file
-    i = 0
+    # collect the rings of all polygons, holes are marked with a leading '!'
+    rings, labels = [], []
     for shape in geom_list:
         if shape.geom_type == 'MultiPolygon':
             polygons = shape.geoms
         elif shape.geom_type == 'Polygon':
             polygons = [shape]
-
+        else:
+            raise ValueError(f'Cannot write {shape.geom_type} to .poly file.')
         for polygon in polygons:
-            polygon = np.array(polygon.exterior.coords)
-            file.write(str(i) + "\n")
-            i += 1
-            for ring in polygon:
-                file.write("    " + str(ring[0]) + "     " + str(ring[1]) +"\n")
+            labels.append(str(len(labels)))
+            rings.append(polygon.exterior)
+            for interior in polygon.interiors:
+                labels.append(f'!{len(labels)}')
+                rings.append(interior)
+
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    ends = np.cumsum(np.bincount(index, minlength=len(rings))).tolist()
+
+    with tempfile.NamedTemporaryFile(
+            'w', dir=filename.parent, suffix='.tmp', delete=False) as file:
+        file.write('Polygons\n')
+        for label, start, end in zip(labels, [0] + ends[:-1], ends):
+            file.write(f'{label}\n')
+            # all coordinates of the ring in one call
+            np.savetxt(file, coords[start:end], fmt='    %s     %s')
+            file.write('END\n')
+        file.write('END\n')
+    try:
+        os.link(file.name, filename)
+    except FileExistsError as err:
+        raise ValueError(f'File {filename} already exists, aborting.') from err
+    finally:
+        os.unlink(file.name)
 
-            # close the ring of one subpolygon if done
-            file.write("END" +"\n")
 
-    # close the file when done
-    file.write("END" +"\n")
-    file.close()
+def write_poly(shape_list, poly_dir=POLY_DIR, max_vertices=None,
+               quota=POLY_CACHE_QUOTA):
+    """
+    Write shapes to a content-addressed .poly file.
+
+    The file name is derived from the simplified shapes, so that identical
+    shapes share one file and different shapes never collide, also across
+    concurrent processes. Existing files are reused.
+
+    The content-addressed files in poly_dir form a cache: once they exceed
+    quota, the least recently used ones are deleted. Other files in
+    poly_dir are never deleted.
+
+    Parameters
+    ----------
+    shape_list : list
+        list of shapely (Multi-)Polygon(s)
+    poly_dir : str or pathlib.Path, optional
+        directory of the .poly file. Default is POLY_DIR.
+    max_vertices : int, optional
+        vertex budget of the simplified shapes. The clipping cost of the
+        kernels grows with the number of vertices. Default is no budget.
+    quota : float, optional
+        maximal size of the content-addressed .poly files in poly_dir in
+        bytes. Default is POLY_CACHE_QUOTA.
+
+    Returns
+    -------
+    pathlib.Path
+        path of the .poly file
+    """
+    shape_list = _simplify_shapelist(shape_list, max_vertices=max_vertices)
+    key = hashlib.sha256(b''.join(
+        shapely.to_wkb(shapely.normalize(shape_list)))).hexdigest()
+    poly_file = pathlib.Path(poly_dir, f'{key}.poly')
+    if poly_file.is_file():
+        # mark as recently used, for the eviction
+        os.utime(poly_file)
+    else:
+        try:
+            _shapely2poly(shape_list, poly_file)
+        except ValueError:
+            # written concurrently by another process
+            if not poly_file.is_file():
+                raise
+    evict_cache(poly_dir, quota, pattern='[0-9a-f]' * 64 + '.poly',
+                keep=poly_file)
+    return poly_file
+
 
 def _build_osmconvert_cmd(shape, osmpbf_clip_from, osmpbf_output):
     """
@@ -178,27 +274,20 @@ def _build_osmconvert_cmd(shape, osmpbf_clip_from, osmpbf_output):
                 f'-o={osmpbf_output}'
                 ] # '--complete-ways', '--complete-multipolygons' # add option
 
-def _osmconvert_clip(shape, osmpbf_clip_from, osmpbf_output,
-                     overwrite=False):
-
-    osmpbf_clip_from = pathlib.Path(osmpbf_clip_from)
-    if not osmpbf_clip_from.suffix:
-        osmpbf_clip_from = osmpbf_clip_from.with_suffix('.osm.pbf')
-    if not osmpbf_clip_from.is_file():
-        raise ValueError(f"OSM file {osmpbf_clip_from} to clip from not found.")
-
-    if ((not pathlib.Path(osmpbf_output).is_file()) or
-        (pathlib.Path(osmpbf_output).is_file() and overwrite)):
 
-        LOGGER.info("""File doesn`t yet exist or overwriting old one.
-                    Assembling osmosis command.""")
-        cmd = _build_osmconvert_cmd(shape, osmpbf_clip_from, osmpbf_output)
-
-    LOGGER.info('''Extracting from larger file...
-                This will take a while''')
+def _osmosis_filter_args(shape):
+    """
+    osmosis arguments to filter a bounding box or .poly file
+    """
+    if isinstance(shape, (pathlib.Path, str)):
+        return ['--bounding-polygon', 'file='+str(shape)]
+    if isinstance(shape[0], (float, int)):
+        return ['--bounding-box', f'top={shape[3]}', f'left={shape[0]}',
+                f'bottom={shape[1]}', f'right={shape[2]}']
 
-    return subprocess.run(cmd, stdout=subprocess.PIPE,
-                          universal_newlines=True)
+    raise ValueError('''shape does not have the correct format.
+                        Only bounding boxes, shapely (multi-)polygons or
+                        filepaths to .poly files are allowed''')
 
 
 def _build_osmosis_cmd(shape, osmpbf_clip_from, osmpbf_output):
@@ -215,29 +304,42 @@ def _build_osmosis_cmd(shape, osmpbf_clip_from, osmpbf_output):
     osmpbf_output : str or pathlib.Path
         file path (incl. name & ending) under which extract will be stored
     """
-    if isinstance(shape, (pathlib.Path, str)):
-        return ['osmosis', '--read-pbf', 'file='+str(osmpbf_clip_from),
-            '--bounding-polygon', 'file='+str(shape), '--write-pbf',
-            'file='+str(osmpbf_output)]
-    if isinstance(shape[0], (float, int)):
-        return['osmosis', '--read-pbf', 'file='+str(osmpbf_clip_from),
-            '--bounding-box', f'top={shape[3]}', f'left={shape[0]}',
-            f'bottom={shape[1]}', f'right={shape[2]}',
+    return ['osmosis', '--read-pbf', 'file='+str(osmpbf_clip_from),
+            *_osmosis_filter_args(shape),
             '--write-pbf', 'file='+str(osmpbf_output)]
 
-    raise ValueError('''shape does not have the correct format.
-                        Only bounding boxes, shapely (multi-)polygons or
-                        filepaths to .poly files are allowed''')
 
+def _build_osmosis_multi_cmd(shapes, osmpbf_clip_from, osmpbf_outputs,
+                             tmp_dir=None):
+    """
+    builds osmosis command for clipping several shapes in one pass over the
+    parent file, by fanning out the read stream with --tee
 
-def _osmosis_clip(shape, osmpbf_clip_from, osmpbf_output,
-                  overwrite=False):
+    Parameters
+    -----------
+    shapes : list
+        list of bounding boxes [xmin, ymin, xmax, ymax] or string/Path to
+        .poly files delimiting the bounds.
+    osmpbf_clip_from: str or pathlib.Path
+        file path to planet.osm.pbf or other osm.pbf file to clip
+    osmpbf_outputs : list
+        file paths (incl. name & ending) under which the extracts will be
+        stored, in the same order as shapes
+    tmp_dir : str or pathlib.Path
+        unused, for consistency with other kernels
     """
-    Runs the command line tool osmosis to cut out all map info within
-    shape (bounding box or poygon(s)), from a bigger parent file.
+    cmd = ['osmosis', '--read-pbf', 'file='+str(osmpbf_clip_from),
+           '--tee', f'outputCount={len(shapes)}']
+    for shape, osmpbf_output in zip(shapes, osmpbf_outputs):
+        cmd += [*_osmosis_filter_args(shape),
+                '--write-pbf', 'file='+str(osmpbf_output)]
+    return cmd
 
-    If your device doesn't have osmosis yet, see installation instructions:
-    https://wiki.openstreetmap.org/wiki/Osmosis/Installation
+
+def _build_osmium_cmd(shape, osmpbf_clip_from, osmpbf_output,
+                      strategy='complete_ways'):
+    """
+    builds osmium command for clipping
 
     Parameters
     -----------
@@ -248,38 +350,232 @@ def _osmosis_clip(shape, osmpbf_clip_from, osmpbf_output,
         file path to planet.osm.pbf or other osm.pbf file to clip
     osmpbf_output : str or pathlib.Path
         file path (incl. name & ending) under which extract will be stored
-    overwrite : bool
-        default is False. Whether to overwrite files if they already exist.
+    strategy : str
+        osmium extract strategy, one of 'simple', 'complete_ways' or 'smart'.
+        Default is 'complete_ways'.
+    """
+    if isinstance(shape, (pathlib.Path, str)):
+        filter_args = ['-p', str(shape)]
+    elif isinstance(shape[0], (float, int)):
+        filter_args = ['-b', f'{shape[0]},{shape[1]},{shape[2]},{shape[3]}']
+    else:
+        raise ValueError('''shape does not have the correct format.
+                            Only bounding boxes, shapely (multi-)polygons or
+                            filepaths to .poly files are allowed''')
+    return ['osmium', 'extract', *filter_args, '-s', strategy,
+            '-o', str(osmpbf_output), '--overwrite', str(osmpbf_clip_from)]
 
-    Returns
-    -------
-    None or subprocess
+
+def _build_osmium_multi_cmd(shapes, osmpbf_clip_from, osmpbf_outputs,
+                            tmp_dir, strategy='complete_ways'):
+    """
+    builds osmium command for clipping several shapes in one pass over the
+    parent file, via an osmium extract config file stored in tmp_dir
+
+    Parameters
+    -----------
+    shapes : list
+        list of bounding boxes [xmin, ymin, xmax, ymax] or string/Path to
+        .poly files delimiting the bounds.
+    osmpbf_clip_from: str or pathlib.Path
+        file path to planet.osm.pbf or other osm.pbf file to clip
+    osmpbf_outputs : list
+        file paths (incl. name & ending) under which the extracts will be
+        stored, in the same order as shapes
+    tmp_dir : str or pathlib.Path
+        directory in which the config file is written
+    strategy : str
+        osmium extract strategy, one of 'simple', 'complete_ways' or 'smart'.
+        Default is 'complete_ways'.
+    """
+    extracts = []
+    for shape, osmpbf_output in zip(shapes, osmpbf_outputs):
+        extract = {'output': str(pathlib.Path(osmpbf_output).absolute())}
+        if isinstance(shape, (pathlib.Path, str)):
+            extract['polygon'] = {'file_name': str(shape), 'file_type': 'poly'}
+        else:
+            extract['bbox'] = [float(coord) for coord in shape]
+        extracts.append(extract)
+
+    config_file = pathlib.Path(tmp_dir, 'osmium_extract.json')
+    config_file.write_text(json.dumps({'extracts': extracts}))
+    return ['osmium', 'extract', '-c', str(config_file), '-s', strategy,
+            '--overwrite', str(osmpbf_clip_from)]
+
+
+def _osmium_env(threads=None):
+    """
+    environment variables for osmium: the size of the thread pool used e.g.
+    for compressing the PBF output blocks in parallel
     """
+    if threads is None:
+        return {}
+    return {'OSMIUM_POOL_THREADS': str(threads)}
+
+
+"""
+registry of clipping kernels. Each kernel provides a command builder for a
+single shape (cmd), optionally one for many shapes in one pass over the
+parent file (multi_cmd), and optionally a function returning environment
+variables for the kernel (env). Further keyword arguments given to the
+clipping functions are passed on to these functions.
+"""
+CLIP_KERNELS = {
+    'osmosis': {'cmd': _build_osmosis_cmd,
+                'multi_cmd': _build_osmosis_multi_cmd},
+    'osmconvert': {'cmd': _build_osmconvert_cmd},
+    'osmium': {'cmd': _build_osmium_cmd,
+               'multi_cmd': _build_osmium_multi_cmd,
+               'env': _osmium_env},
+}
+
+
+def register_kernel(name, cmd, multi_cmd=None, env=None):
+    """
+    Register a clipping kernel, which then can be used by name in all
+    clipping functions.
+
+    Parameters
+    ----------
+    name : str
+        name of the kernel
+    cmd : callable
+        function (shape, osmpbf_clip_from, osmpbf_output, **options)
+        returning the command to clip one shape, as a list of strings
+    multi_cmd : callable, optional
+        function (shapes, osmpbf_clip_from, osmpbf_outputs, tmp_dir,
+        **options) returning the command to clip several shapes in one pass
+    env : callable, optional
+        function (**options) returning a dict of environment variables to
+        set when running the kernel
+    """
+    CLIP_KERNELS[name] = {'cmd': cmd, 'multi_cmd': multi_cmd, 'env': env}
+
+
+def _get_kernel(kernel):
+    """Look up a clipping kernel in the registry"""
+    try:
+        return CLIP_KERNELS[kernel]
+    except KeyError:
+        raise ValueError(f"Kernel '{kernel}' is not valid. Abort.") from None
+
+
+def _split_kernel_options(kernel_spec, kernel_options):
+    """Separate the options of the environment function from the others"""
+    env_func = kernel_spec.get('env')
+    if env_func is None:
+        return {}, kernel_options
+    env_keys = inspect.signature(env_func).parameters
+    env_options = {key: val for key, val in kernel_options.items()
+                   if key in env_keys}
+    return (env_func(**env_options),
+            {key: val for key, val in kernel_options.items()
+             if key not in env_keys})
+
+
+def _check_parent_file(osmpbf_clip_from):
+    """Complete the file suffix of the parent file and check it exists"""
     osmpbf_clip_from = pathlib.Path(osmpbf_clip_from)
     if not osmpbf_clip_from.suffix:
         osmpbf_clip_from = osmpbf_clip_from.with_suffix('.osm.pbf')
     if not osmpbf_clip_from.is_file():
         raise ValueError(f"OSM file {osmpbf_clip_from} to clip from not found.")
+    return osmpbf_clip_from
+
+
+def _prepare_clip(shape, osmpbf_clip_from, osmpbf_output, overwrite=False,
+                  kernel='osmosis', cache=False, **kernel_options):
+    """
+    Check the inputs of a clip, fetch it from the cache if possible and
+    otherwise assemble the kernel command.
+
+    Returns
+    -------
+    cmd, env, key : list, dict, str
+        kernel command, environment variables and cache key (None without
+        cache), or None if the file was taken from the cache
+    """
+    kernel_spec = _get_kernel(kernel)
+    osmpbf_clip_from = _check_parent_file(osmpbf_clip_from)
 
-    if ((not pathlib.Path(osmpbf_output).is_file()) or
-        (pathlib.Path(osmpbf_output).is_file() and overwrite)):
+    if pathlib.Path(osmpbf_output).is_file():
+        if not overwrite:
+            raise ValueError(f"File {osmpbf_output} already exists. Abort.")
+        # remove instead of overwriting in place, the file may be linked
+        # to the clip cache
+        pathlib.Path(osmpbf_output).unlink()
 
-        LOGGER.info("""File doesn`t yet exist or overwriting old one.
-                    Assembling osmosis command.""")
+    key = None
+    if cache:
+        key = clip_cache_key(shape, osmpbf_clip_from, kernel, kernel_options)
+        if fetch_from_cache(key, osmpbf_output):
+            return None
 
-        cmd = _build_osmosis_cmd(shape, osmpbf_clip_from, osmpbf_output)
+    LOGGER.info(f"""File doesn`t yet exist or overwriting old one.
+                Assembling {kernel} command.""")
+    env, kernel_options = _split_kernel_options(kernel_spec, kernel_options)
+    cmd = kernel_spec['cmd'](shape, osmpbf_clip_from, osmpbf_output,
+                             **kernel_options)
+    return cmd, env, key
 
-        LOGGER.info('''Extracting from larger file...
-                    This will take a while''')
 
-        return subprocess.run(cmd, stdout=subprocess.PIPE,
-                            universal_newlines=True)
+def _clip(shape, osmpbf_clip_from, osmpbf_output, overwrite=False,
+          kernel='osmosis', cache=False, **kernel_options):
+    """
+    Runs a clipping kernel to cut out all map info within shape (bounding
+    box or .poly file), from a bigger parent file.
 
-    raise ValueError(f"File {osmpbf_output} already exists. Abort.")
+    Parameters
+    -----------
+    shape : list or str or pathlib.Path
+        list containing [xmin, ymin, xmax, ymax] for a bounding box or
+        a string/Path to the .poly file path delimiting the bounds.
+    osmpbf_clip_from: str or pathlib.Path
+        file path to planet.osm.pbf or other osm.pbf file to clip
+    osmpbf_output : str or pathlib.Path
+        file path (incl. name & ending) under which extract will be stored
+    overwrite : bool
+        default is False. Whether to overwrite files if they already exist.
+    kernel : str
+        name of the clipping kernel, see CLIP_KERNELS. Default is 'osmosis'.
+    cache : bool
+        default is False. Whether to reuse an identical clip from the clip
+        cache, and to add new clips to it.
+    **kernel_options
+        further options of the kernel
+
+    Returns
+    -------
+    subprocess.CompletedProcess or None
+        None if the file was taken from the cache
+
+    Raises
+    ------
+    RuntimeError
+        if the kernel fails
+    """
+    prepared = _prepare_clip(shape, osmpbf_clip_from, osmpbf_output,
+                             overwrite, kernel, cache, **kernel_options)
+    if prepared is None:
+        return None
+    cmd, env, key = prepared
+
+    LOGGER.info('''Extracting from larger file...
+                This will take a while''')
+    try:
+        result = _run_command(cmd, env)
+    except BaseException:
+        # a partial output would be taken for a finished clip later
+        pathlib.Path(osmpbf_output).unlink(missing_ok=True)
+        raise
+    if cache and pathlib.Path(osmpbf_output).is_file():
+        add_to_cache(key, osmpbf_output)
+    return result
 
 
 def clip_from_bbox(bbox, osmpbf_clip_from, osmpbf_output,
-                   overwrite=False, kernel='osmosis'):
+                   overwrite=False, kernel='osmosis', cache=False,
+                   **kernel_options):
     """
     get OSM raw data from abounding-box, which is extracted
     from a bigger (e.g. the planet) file.
@@ -295,8 +591,17 @@ def clip_from_bbox(bbox, osmpbf_clip_from, osmpbf_output,
     overwrite : bool
         default is False. Whether to overwrite files if they already exist.
     kernel : str
-        name of the clipping kernel: 'osmconvert' or 'osmosis'
+        name of the clipping kernel: 'osmconvert', 'osmosis', 'osmium' or
+        any other kernel added with register_kernel().
         Default is 'osmosis'.
+    cache : bool
+        default is False. Whether to reuse an identical clip (same parent
+        file, shape, kernel and options) from the clip cache in
+        CLIP_CACHE_DIR, and to add new clips to it.
+    **kernel_options
+        further options of the kernel, e.g. strategy ('simple',
+        'complete_ways' or 'smart') and threads for osmium.
+
     Note
     ----
     This function uses the command line tool osmosis to cut out new
@@ -305,17 +610,13 @@ def clip_from_bbox(bbox, osmpbf_clip_from, osmpbf_output,
     https://wiki.openstreetmap.org/wiki/Osmosis/Installation
     """
     # TODO: allow for osmpbf_output to be only file name & save in default DIR
-    if kernel == 'osmosis':
-        _osmosis_clip(bbox, osmpbf_clip_from, osmpbf_output, overwrite)
-        return
-    if kernel == 'osmconvert':
-        _osmconvert_clip(bbox, osmpbf_clip_from, osmpbf_output, overwrite)
-        return
-    raise ValueError(f"Kernel '{kernel}' is not valid. Abort.")
+    _clip(bbox, osmpbf_clip_from, osmpbf_output, overwrite, kernel, cache,
+          **kernel_options)
 
 
 def clip_from_poly(poly_file, osmpbf_clip_from, osmpbf_output,
-                   overwrite=False, kernel='osmosis'):
+                   overwrite=False, kernel='osmosis', cache=False,
+                   **kernel_options):
     """
     get OSM raw data from a custom shape defined in .poly file which is clipped
     from a .osm.pbf file.
@@ -333,34 +634,40 @@ def clip_from_poly(poly_file, osmpbf_clip_from, osmpbf_output,
     overwrite : bool
         default is False. Whether to overwrite files if they already exist.
     kernel : str
-        name of the clipping kernel: 'osmconvert' or 'osmosis'
+        name of the clipping kernel: 'osmconvert', 'osmosis', 'osmium' or
+        any other kernel added with register_kernel().
         Default is 'osmosis'.
+    cache : bool
+        default is False. Whether to reuse an identical clip (same parent
+        file, shape, kernel and options) from the clip cache in
+        CLIP_CACHE_DIR, and to add new clips to it.
+    **kernel_options
+        further options of the kernel, e.g. strategy ('simple',
+        'complete_ways' or 'smart') and threads for osmium.
 
     Note
     ----
-    This function uses the command line tool osmosis or osmconvert to clip 
-    new osm.pbf files from the original ones.
+    This function uses the command line tool osmosis, osmconvert or osmium
+    to clip new osm.pbf files from the original ones.
     Installation instructions (windows, linux, apple) - see
     https://wiki.openstreetmap.org/wiki/Osmosis/Installation or 
-    https://wiki.openstreetmap.org/wiki/Osmconvert
+    https://wiki.openstreetmap.org/wiki/Osmconvert or
+    https://osmcode.org/osmium-tool/
     """
-    if kernel == 'osmosis':
-        _osmosis_clip(poly_file, osmpbf_clip_from, osmpbf_output, overwrite)
-        return
-    if kernel == 'osmconvert':
-        _osmconvert_clip(poly_file, osmpbf_clip_from, osmpbf_output, overwrite)
-        return
-    raise ValueError(f"Kernel '{kernel}' is not valid. Abort.")
+    _clip(poly_file, osmpbf_clip_from, osmpbf_output, overwrite, kernel, cache,
+          **kernel_options)
 
 
 def clip_from_shapes(shape_list, osmpbf_clip_from, osmpbf_output,
-                     overwrite=False, kernel='osmosis'):
+                     overwrite=False, kernel='osmosis', cache=False,
+                     max_vertices=None, **kernel_options):
     """
     get OSM raw data from a custom shape defined by a list of polygons
     which is extracted from the entire OSM planet file.
     The list of shapes first needs to be converted to a .poly file and then
-    passed back to the function (under the hood, a temporary file is created
-    and deleted upon completion again).
+    passed back to the function (under the hood, a content-addressed .poly
+    file is written to POLY_DIR with write_poly(), and reused for identical
+    shapes).
 
     Parameters
     ----------
@@ -374,31 +681,640 @@ def clip_from_shapes(shape_list, osmpbf_clip_from, osmpbf_output,
     overwrite : bool
         default is False. Whether to overwrite files if they already exist.
     kernel : str
-        name of the clipping kernel: 'osmconvert' or 'osmosis'
+        name of the clipping kernel: 'osmconvert', 'osmosis', 'osmium' or
+        any other kernel added with register_kernel().
         Default is 'osmosis'.
+    cache : bool
+        default is False. Whether to reuse an identical clip (same parent
+        file, shape, kernel and options) from the clip cache in
+        CLIP_CACHE_DIR, and to add new clips to it.
+    max_vertices : int, optional
+        vertex budget of the simplified shapes. Fewer vertices make the
+        clipping faster. Default is no budget.
+    **kernel_options
+        further options of the kernel, e.g. strategy ('simple',
+        'complete_ways' or 'smart') and threads for osmium.
 
     Note
     ----
-    This function uses the command line tool osmosis or osmconvert to clip 
-    new osm.pbf files from the original ones.
+    This function uses the command line tool osmosis, osmconvert or osmium
+    to clip new osm.pbf files from the original ones.
     Installation instructions (windows, linux, apple) - see
     https://wiki.openstreetmap.org/wiki/Osmosis/Installation or 
-    https://wiki.openstreetmap.org/wiki/Osmconvert 
-    
+    https://wiki.openstreetmap.org/wiki/Osmconvert or
+    https://osmcode.org/osmium-tool/
+    """
+    _get_kernel(kernel)
+    poly_file = write_poly(shape_list, max_vertices=max_vertices)
+    _clip(poly_file, osmpbf_clip_from, osmpbf_output, overwrite, kernel,
+          cache, **kernel_options)
+
+
+def clip_many(shapes_by_name, osmpbf_clip_from, out_dir, overwrite=False,
+              kernel='osmosis', cache=False, max_vertices=None,
+              **kernel_options):
+    """
+    get OSM raw data for many shapes at once, all clipped in a single pass
+    over the parent file.
+
+    Parameters
+    ----------
+    shapes_by_name : dict
+        shapes to clip, with the output name as key. Each shape is a bounding
+        box [xmin, ymin, xmax, ymax], a file path to a .poly file, or a list
+        of (Multi-)Polygon(s).
+    osmpbf_clip_from : str or pathlib.Path
+        file path (including filename) to the *.osm.pbf file to clip from.
+    out_dir : str or pathlib.Path
+        directory in which the extracts are stored as <name>.osm.pbf
+    overwrite : bool
+        default is False. Whether to overwrite files if they already exist.
+        Existing files are skipped otherwise.
+    kernel : str
+        name of the clipping kernel: 'osmconvert', 'osmosis', 'osmium' or
+        any other kernel added with register_kernel().
+        Default is 'osmosis'. Kernels which cannot write several outputs at
+        once, such as osmconvert, clip the shapes one after the other.
+    cache : bool
+        default is False. Whether to reuse identical clips (same parent
+        file, shape, kernel and options) from the clip cache in
+        CLIP_CACHE_DIR, and to add new clips to it.
+    max_vertices : int, optional
+        vertex budget of each simplified shape given as polygons. Fewer
+        vertices make the clipping faster. Default is no budget.
+    **kernel_options
+        further options of the kernel, e.g. strategy ('simple',
+        'complete_ways' or 'smart') and threads for osmium.
+
+    Returns
+    -------
+    dict
+        file paths of the extracts, with the same keys as shapes_by_name
+
+    Note
+    ----
+    This function uses the command line tool osmosis, osmconvert or osmium
+    to clip new osm.pbf files from the original ones.
+    Installation instructions (windows, linux, apple) - see
+    https://wiki.openstreetmap.org/wiki/Osmosis/Installation or
+    https://wiki.openstreetmap.org/wiki/Osmconvert or
+    https://osmcode.org/osmium-tool/
+    """
+    kernel_spec = _get_kernel(kernel)
+    osmpbf_clip_from = _check_parent_file(osmpbf_clip_from)
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    outputs = {name: out_dir / f'{name}.osm.pbf' for name in shapes_by_name}
+    todo = [name for name, output in outputs.items()
+            if overwrite or not output.is_file()]
+    LOGGER.info('Skip %d existing files.', len(outputs) - len(todo))
+    if not todo:
+        return outputs
+
+    with tempfile.TemporaryDirectory(dir=POLY_DIR) as tmp_dir:
+        shapes = []
+        for name in todo:
+            shape = shapes_by_name[name]
+            if isinstance(shape, shapely.Geometry):
+                shape = [shape]
+            if isinstance(shape[0], shapely.Geometry):
+                shape = write_poly(shape, tmp_dir, max_vertices)
+            shapes.append(shape)
+
+        if cache:
+            keys = [clip_cache_key(shape, osmpbf_clip_from, kernel,
+                                   kernel_options) for shape in shapes]
+            missing = [i for i, (key, name) in enumerate(zip(keys, todo))
+                       if not fetch_from_cache(key, outputs[name])]
+            keys = [keys[i] for i in missing]
+            shapes = [shapes[i] for i in missing]
+            todo = [todo[i] for i in missing]
+            if not todo:
+                return outputs
+        for name in todo:
+            # remove instead of overwriting in place, the file may be linked
+            # to the clip cache
+            outputs[name].unlink(missing_ok=True)
+
+        if kernel_spec.get('multi_cmd') is None:
+            for shape, name in zip(shapes, todo):
+                _clip(shape, osmpbf_clip_from, outputs[name], True, kernel,
+                      **kernel_options)
+        else:
+            LOGGER.info('Extracting %d files from larger file...', len(todo))
+            env, kernel_options = _split_kernel_options(kernel_spec,
+                                                        kernel_options)
+            try:
+                _run_command(
+                    kernel_spec['multi_cmd'](
+                        shapes, osmpbf_clip_from,
+                        [outputs[name] for name in todo],
+                        tmp_dir=tmp_dir, **kernel_options),
+                    env)
+            except BaseException:
+                # partial outputs would be taken for finished clips later
+                for name in todo:
+                    outputs[name].unlink(missing_ok=True)
+                raise
+
+        if cache:
+            for key, name in zip(keys, todo):
+                if outputs[name].is_file():
+                    add_to_cache(key, outputs[name])
+    return outputs
+
+
+# =============================================================================
+#  CLIP PLANNING
+# =============================================================================
+
+def _shape_bounds(shape):
+    """
+    bounds [xmin, ymin, xmax, ymax] of a bounding box, a .poly file or a
+    list of shapely (Multi-)Polygons
+    """
+    if isinstance(shape, (pathlib.Path, str)):
+        coords = []
+        for line in pathlib.Path(shape).read_text().splitlines():
+            try:
+                coords.append([float(val) for val in line.split()])
+            except ValueError:
+                continue
+        coords = np.array([coord for coord in coords if len(coord) == 2])
+        return [*coords.min(axis=0), *coords.max(axis=0)]
+    if isinstance(shape, shapely.Geometry):
+        shape = [shape]
+    if isinstance(shape[0], shapely.Geometry):
+        return list(shapely.total_bounds(shape))
+    return [float(coord) for coord in shape]
+
+
+def _bbox_contains(outer, inner):
+    """whether the bounding box outer contains the bounding box inner"""
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+def _bbox_area(bbox):
+    return max(bbox[2] - bbox[0], 0) * max(bbox[3] - bbox[1], 0)
+
+
+def _parent_extents(search_dir):
+    """
+    extents of the osm.pbf files in search_dir according to their headers,
+    taken from the download manifest if possible.
+    Files without bounding box in the header are only considered if their
+    name starts with 'planet', as covering the whole world.
+
+    Returns
+    -------
+    list of tuples
+        (file size, bounding box, path) for each file, ordered by file size
+    """
+    extents = []
+    for path in pathlib.Path(search_dir).glob('*.osm.pbf'):
+        try:
+            entry = read_manifest_entry(path)
+            header = (entry['header'] if entry and entry.get('header')
+                      else read_header(path))
+            bbox = header['bbox']
+        except (ValueError, OSError):
+            LOGGER.debug('Skip %s, no valid osm.pbf header', path)
+            continue
+        if bbox is None:
+            if not path.name.startswith('planet'):
+                continue
+            bbox = [-180., -90., 180., 90.]
+        extents.append((path.stat().st_size, bbox, path))
+    return sorted(extents, key=lambda extent: extent[0])
+
+
+def find_smallest_parent(shape, search_dir=OSM_DATA_DIR):
+    """
+    Find the smallest osm.pbf file which fully contains a shape, among the
+    files in a directory (e.g. the downloaded planet, continent and country
+    files).
+
+    Parameters
+    ----------
+    shape : list or str or pathlib.Path
+        bounding box [xmin, ymin, xmax, ymax], path to a .poly file or list
+        of shapely (Multi-)Polygons
+    search_dir : str or pathlib.Path
+        directory with the osm.pbf files. Default is OSM_DATA_DIR.
+
+    Returns
+    -------
+    pathlib.Path
+        the smallest (in file size) osm.pbf file whose header bounding box
+        contains the shape
+
+    Note
+    ----
+    Containment is checked against the bounding boxes in the file headers.
+    Geofabrik extracts are cut along polygons, which may not cover the whole
+    bounding box, e.g. along borders with neighbouring countries.
+    """
+    bounds = _shape_bounds(shape)
+    for _, bbox, path in _parent_extents(search_dir):
+        if _bbox_contains(bbox, bounds):
+            return path
+    raise LookupError(f'No osm.pbf file in {search_dir} contains the bounds '
+                      f'{bounds}.')
+
+
+def _plan_stages(names, bounds_by_name, stage_bbox, min_stage_regions):
+    """
+    Recursively group shapes into intermediate clipping stages: the shapes
+    are split by the quadrant of the stage bounding box their centre lies in,
+    and each quadrant with at least min_stage_regions shapes, whose shapes
+    cover at most half of the stage area, becomes a new stage.
+
+    Returns
+    -------
+    dict
+        'bbox' of the stage, 'names' of the shapes clipped directly from the
+        stage, and sub-'stages'
+    """
+    x_mid = (stage_bbox[0] + stage_bbox[2]) / 2
+    y_mid = (stage_bbox[1] + stage_bbox[3]) / 2
+    quadrants = {}
+    for name in names:
+        bounds = bounds_by_name[name]
+        quadrant = ((bounds[0] + bounds[2]) / 2 > x_mid,
+                    (bounds[1] + bounds[3]) / 2 > y_mid)
+        quadrants.setdefault(quadrant, []).append(name)
+
+    stage = {'bbox': stage_bbox, 'names': [], 'stages': []}
+    for group in quadrants.values():
+        group_bbox = [min(bounds_by_name[name][0] for name in group),
+                      min(bounds_by_name[name][1] for name in group),
+                      max(bounds_by_name[name][2] for name in group),
+                      max(bounds_by_name[name][3] for name in group)]
+        if (len(group) >= min_stage_regions
+                and 0 < _bbox_area(group_bbox) <= _bbox_area(stage_bbox) / 2):
+            stage['stages'].append(_plan_stages(
+                group, bounds_by_name, group_bbox, min_stage_regions))
+        else:
+            stage['names'] += group
+    return stage
+
+
+def _run_stage(stage, parent, shapes_by_name, out_dir, stage_margin,
+               clip_kwargs):
+    """clip the shapes and sub-stages of a stage in one pass over parent"""
+    stage_shapes = {}
+    for i, sub_stage in enumerate(stage['stages']):
+        bbox = sub_stage['bbox']
+        margin_x = (bbox[2] - bbox[0]) * stage_margin
+        margin_y = (bbox[3] - bbox[1]) * stage_margin
+        name = f'_stage_{parent.name.split(".")[0]}_{i}'
+        stage_shapes[name] = [
+            max(bbox[0] - margin_x, -180.), max(bbox[1] - margin_y, -90.),
+            min(bbox[2] + margin_x, 180.), min(bbox[3] + margin_y, 90.)]
+        # never reuse intermediate files of an earlier run
+        pathlib.Path(out_dir, f'{name}.osm.pbf').unlink(missing_ok=True)
+
+    LOGGER.info('Clip %d regions and %d intermediate stages from %s',
+                len(stage['names']), len(stage_shapes), parent)
+    outputs = clip_many(
+        {**{name: shapes_by_name[name] for name in stage['names']},
+         **stage_shapes},
+        parent, out_dir, **clip_kwargs)
+
+    for name, sub_stage in zip(stage_shapes, stage['stages']):
+        try:
+            _run_stage(sub_stage, outputs[name], shapes_by_name, out_dir,
+                       stage_margin, clip_kwargs)
+        finally:
+            outputs[name].unlink(missing_ok=True)
+
+
+def clip_planned(shapes_by_name, out_dir, search_dir=OSM_DATA_DIR,
+                 min_stage_regions=5, stage_margin=0.05, overwrite=False,
+                 kernel='osmosis', cache=False, **kernel_options):
+    """
+    Clip many shapes, each from the smallest available parent file which
+    contains it, and in stages if many small regions are requested from a
+    large parent file.
+
+    For each parent file, the requested shapes are grouped recursively by
+    quadrants. Groups of at least min_stage_regions shapes, which cover at
+    most half of the area of their parent, are first clipped as one
+    intermediate file along their common bounding box (e.g. planet ->
+    continent -> admin1 regions). Each parent or intermediate file is read
+    once for all the shapes and stages it serves.
+
+    Parameters
+    ----------
+    shapes_by_name : dict
+        shapes to clip, with the output name as key. Each shape is a bounding
+        box [xmin, ymin, xmax, ymax], a file path to a .poly file, or a list
+        of (Multi-)Polygon(s).
+    out_dir : str or pathlib.Path
+        directory in which the extracts are stored as <name>.osm.pbf
+    search_dir : str or pathlib.Path
+        directory with the osm.pbf files to clip from. Default is
+        OSM_DATA_DIR.
+    min_stage_regions : int
+        minimal number of shapes for an intermediate stage. Default is 5.
+    stage_margin : float
+        margin added on all sides of the intermediate stage bounding boxes,
+        as fraction of their width and height, to retain features crossing
+        the region borders. Default is 0.05.
+    overwrite : bool
+        default is False. Whether to overwrite files if they already exist.
+        Existing files are skipped otherwise.
+    kernel : str
+        name of the clipping kernel: 'osmconvert', 'osmosis', 'osmium' or
+        any other kernel added with register_kernel().
+        Default is 'osmosis'.
+    cache : bool
+        default is False. Whether to reuse identical clips from the clip
+        cache, and to add new clips to it.
+    **kernel_options
+        further options of the kernel, e.g. strategy ('simple',
+        'complete_ways' or 'smart') and threads for osmium.
+
+    Returns
+    -------
+    dict
+        file paths of the extracts, with the same keys as shapes_by_name
+
+    See also
+    --------
+    find_smallest_parent() for the choice of the parent files.
+    """
+    out_dir = pathlib.Path(out_dir)
+    outputs = {name: out_dir / f'{name}.osm.pbf' for name in shapes_by_name}
+    todo = [name for name, output in outputs.items()
+            if overwrite or not output.is_file()]
+    bounds_by_name = {name: _shape_bounds(shapes_by_name[name])
+                      for name in todo}
+
+    extents = _parent_extents(search_dir)
+    by_parent = {}
+    for name in todo:
+        for _, bbox, path in extents:
+            if _bbox_contains(bbox, bounds_by_name[name]):
+                by_parent.setdefault((path, tuple(bbox)), []).append(name)
+                break
+        else:
+            raise LookupError(f'No osm.pbf file in {search_dir} contains the '
+                              f'shape {name}.')
+
+    clip_kwargs = {'overwrite': overwrite, 'kernel': kernel, 'cache': cache,
+                   **kernel_options}
+    for (parent, bbox), names in by_parent.items():
+        stage = _plan_stages(names, bounds_by_name, list(bbox),
+                             min_stage_regions)
+        _run_stage(stage, parent, shapes_by_name, out_dir, stage_margin,
+                   clip_kwargs)
+    return outputs
+
+
+# =============================================================================
+#  ASYNC CLIP RUNNER
+# =============================================================================
+
+@dataclasses.dataclass
+class ClipResult:
+    """
+    outcome of a clip job run by clip_async()
+
+    Attributes
+    ----------
+    name : str
+        name of the job
+    output : pathlib.Path
+        file path of the extract
+    status : str
+        'done', 'cached', 'skipped' (output exists), 'failed', 'timeout'
+        or 'cancelled'
+    returncode : int or None
+        exit code of the kernel, None if it was not run to the end
+    duration : float
+        run time of the job in seconds
+    stderr : str
+        last lines written by the kernel to stderr, or the error of a job
+        whose kernel could not be run
+    """
+    name: str
+    output: pathlib.Path
+    status: str
+    returncode: Optional[int] = None
+    duration: float = 0.
+    stderr: str = ''
+
+
+def _default_max_jobs(mem_per_job):
+    """
+    number of concurrent clip jobs which fit into the available memory,
+    at most the number of CPUs
+    """
+    n_cpus = os.cpu_count() or 1
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return n_cpus
+    return max(1, min(n_cpus, int(available // mem_per_job)))
+
+
+# maximal length of a line of kernel output passed on to the logger
+_MAX_LINE = 2**16
+
+
+async def _log_stream(stream, name, level, tail):
+    """
+    pass the lines of a kernel output stream on to the logger. Lines longer
+    than _MAX_LINE bytes are split, instead of failing like StreamReader's
+    line iteration.
+    """
+    def log(line):
+        line = line.decode(errors='replace').rstrip()
+        LOGGER.log(level, '%s: %s', name, line)
+        tail.append(line)
+
+    buffer = b''
+    while True:
+        chunk = await stream.read(_MAX_LINE)
+        if not chunk:
+            break
+        *lines, buffer = (buffer + chunk).split(b'\n')
+        for line in lines:
+            log(line)
+        while len(buffer) > _MAX_LINE:
+            log(buffer[:_MAX_LINE])
+            buffer = buffer[_MAX_LINE:]
+    if buffer:
+        log(buffer)
+
+
+async def _run_clip_kernel(name, cmd, env, key, osmpbf_output, timeout,
+                           cache, start):
+    """run the kernel of a clip job as a subprocess, see _run_clip_job()"""
+    proc = await asyncio.create_subprocess_exec(
+        *[str(arg) for arg in cmd], stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, **env} if env else None)
+    stderr_tail = collections.deque(maxlen=20)
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            _log_stream(proc.stdout, name, logging.DEBUG, []),
+            _log_stream(proc.stderr, name, logging.INFO, stderr_tail),
+            proc.wait()), timeout)
+    except BaseException as err:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        osmpbf_output.unlink(missing_ok=True)
+        if not isinstance(err, asyncio.TimeoutError):
+            raise
+        LOGGER.warning('%s: timeout after %s s', name, timeout)
+        return ClipResult(name, osmpbf_output, 'timeout', None,
+                          time.perf_counter() - start,
+                          '\n'.join(stderr_tail))
+
+    duration = time.perf_counter() - start
+    if proc.returncode != 0:
+        LOGGER.warning('%s: %s failed with exit code %d', name, cmd[0],
+                       proc.returncode)
+        osmpbf_output.unlink(missing_ok=True)
+        status = 'failed'
+    else:
+        status = 'done'
+        if cache and osmpbf_output.is_file():
+            add_to_cache(key, osmpbf_output)
+    return ClipResult(name, osmpbf_output, status, proc.returncode,
+                      duration, '\n'.join(stderr_tail))
+
+
+async def _run_clip_job(name, shape, osmpbf_clip_from, osmpbf_output,
+                        semaphore, timeout, overwrite, kernel, cache,
+                        max_vertices, kernel_options):
+    """
+    run a single clip job once a slot of the semaphore is free. Errors of
+    the job, e.g. a missing parent file or kernel executable, are returned
+    as a failed ClipResult instead of aborting the other jobs.
     """
+    osmpbf_output = pathlib.Path(osmpbf_output)
+    async with semaphore:
+        start = time.perf_counter()
+        if osmpbf_output.is_file() and not overwrite:
+            return ClipResult(name, osmpbf_output, 'skipped')
+        try:
+            if isinstance(shape, shapely.Geometry):
+                shape = [shape]
+            if isinstance(shape[0], shapely.Geometry):
+                shape = write_poly(shape, max_vertices=max_vertices)
+            prepared = _prepare_clip(shape, osmpbf_clip_from, osmpbf_output,
+                                     overwrite, kernel, cache,
+                                     **kernel_options)
+            if prepared is None:
+                return ClipResult(name, osmpbf_output, 'cached',
+                                  duration=time.perf_counter() - start)
+            cmd, env, key = prepared
+            return await _run_clip_kernel(name, cmd, env, key, osmpbf_output,
+                                          timeout, cache, start)
+        except Exception as err:
+            LOGGER.warning('%s: clip failed: %r', name, err)
+            osmpbf_output.unlink(missing_ok=True)
+            return ClipResult(name, osmpbf_output, 'failed',
+                              duration=time.perf_counter() - start,
+                              stderr=repr(err))
 
-    shape_list = _simplify_shapelist(shape_list)
 
-    poly_file = POLY_DIR / 'temp_shp.poly'
+async def clip_async(jobs, overwrite=False, kernel='osmosis', cache=False,
+                     max_jobs=None, mem_per_job=2e9, timeout=None,
+                     progress=None, max_vertices=None, **kernel_options):
+    """
+    Run many clip jobs concurrently, e.g. from different parent files.
 
-    _shapely2poly(shape_list, poly_file)
-    if kernel == 'osmosis':
-        _osmosis_clip(poly_file, osmpbf_clip_from, osmpbf_output, overwrite)
-        poly_file.unlink()
-        return
-    if kernel == 'osmconvert':
-        _osmconvert_clip(poly_file, osmpbf_clip_from, osmpbf_output, overwrite)
-        poly_file.unlink()
-        return
+    The kernels run as subprocesses, at most max_jobs at a time. Their
+    output is passed on to the logger (stdout at DEBUG, stderr at INFO
+    level). Cancelling the returned coroutine kills all running kernels.
 
-    raise ValueError(f"Kernel '{kernel}' is not valid. Abort.")
+    Parameters
+    ----------
+    jobs : dict
+        clip jobs as (shape, osmpbf_clip_from, osmpbf_output) tuples, with a
+        job name as key. Each shape is a bounding box [xmin, ymin, xmax,
+        ymax], a file path to a .poly file, or a list of (Multi-)Polygon(s).
+    overwrite : bool
+        default is False. Whether to overwrite files if they already exist.
+        Existing files are skipped otherwise.
+    kernel : str
+        name of the clipping kernel, see CLIP_KERNELS. Default is 'osmosis'.
+    cache : bool
+        default is False. Whether to reuse identical clips from the clip
+        cache, and to add new clips to it.
+    max_jobs : int, optional
+        maximal number of concurrent kernels. Default is the number of CPUs,
+        limited by the available memory divided by mem_per_job.
+    mem_per_job : float, optional
+        memory needed per kernel in bytes, to derive the default of
+        max_jobs. Default is 2e9.
+    timeout : float, optional
+        time limit per job in seconds, after which the kernel is killed.
+        Default is no limit.
+    progress : callable, optional
+        function called with each ClipResult once the job is finished
+    max_vertices : int, optional
+        vertex budget of each shape given as polygons. Default is no budget.
+    **kernel_options
+        further options of the kernel
+
+    Returns
+    -------
+    dict
+        ClipResult per job, with the same keys as jobs
+
+    See also
+    --------
+    run_clip_jobs() to run the jobs from synchronous code.
+    """
+    _get_kernel(kernel)
+    if max_jobs is None:
+        max_jobs = _default_max_jobs(mem_per_job)
+    semaphore = asyncio.Semaphore(max_jobs)
+    LOGGER.info('Running %d clip jobs, %d at a time.', len(jobs), max_jobs)
+
+    tasks = {}
+    for name, (shape, osmpbf_clip_from, osmpbf_output) in jobs.items():
+        tasks[name] = asyncio.ensure_future(_run_clip_job(
+            name, shape, osmpbf_clip_from, osmpbf_output, semaphore, timeout,
+            overwrite, kernel, cache, max_vertices, kernel_options))
+
+    results = {}
+    try:
+        for future in asyncio.as_completed(list(tasks.values())):
+            result = await future
+            results[result.name] = result
+            LOGGER.info('%d/%d clip jobs finished, %s: %s in %.1f s',
+                        len(results), len(tasks), result.name, result.status,
+                        result.duration)
+            if progress is not None:
+                progress(result)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    return {name: results[name] for name in jobs}
+
+
+def run_clip_jobs(jobs, overwrite=False, kernel='osmosis', cache=False,
+                  max_jobs=None, mem_per_job=2e9, timeout=None, progress=None,
+                  max_vertices=None, **kernel_options):
+    """
+    Run many clip jobs concurrently and wait for them to finish.
+
+    See clip_async() for the parameters.
+
+    Returns
+    -------
+    dict
+        ClipResult per job, with the same keys as jobs
+    """
+    return asyncio.run(clip_async(
+        jobs, overwrite, kernel, cache, max_jobs, mem_per_job, timeout,
+        progress, max_vertices, **kernel_options))
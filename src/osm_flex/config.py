@@ -22,6 +22,18 @@ OSMCONVERT_PATH = OSM_DIR / 'osmconvert'
 OSM_DATA_DIR = OSM_DIR.joinpath("osm_bpf")
 POLY_DIR = OSM_DIR.joinpath("poly")
 EXTRACT_DIR = OSM_DIR.joinpath("extracts")
+CLIP_CACHE_DIR = OSM_DIR.joinpath("clip_cache")
+BOUNDARY_INDEX_DIR = OSM_DIR.joinpath("boundaries")
+
+# =============================================================================
+# CACHE
+# =============================================================================
+
+# maximal disk space of the clip cache in bytes
+CLIP_CACHE_QUOTA = 20e9
+
+# maximal disk space of the content-addressed .poly files in POLY_DIR in bytes
+POLY_CACHE_QUOTA = 1e8
 
 # =============================================================================
 # URLS
@@ -30,6 +42,27 @@ EXTRACT_DIR = OSM_DIR.joinpath("extracts")
 GEOFABRIK_URL = 'https://download.geofabrik.de/'
 PLANET_URL = 'https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf'
 
+"""
+groups of mirrors, which serve the same files under the same relative paths.
+A download from a URL starting with one of the base URLs of a group can be
+served by any mirror of the group: the mirrors are ranked by probing their
+latency and throughput, and a failing download continues from the next
+mirror. Add the mirrors of a deployment here, or with
+download.register_mirror().
+"""
+MIRRORS = {
+    'geofabrik': [GEOFABRIK_URL],
+    'planet': [
+        'https://planet.openstreetmap.org/',
+        'https://ftp5.gwdg.de/pub/misc/openstreetmap/planet.openstreetmap.org/',
+        'https://ftp.fau.de/osm-planet/'],
+}
+
+# time in seconds for which mirror probes are reused
+MIRROR_PROBE_TTL = 3600
+# number of bytes downloaded from each mirror to probe it
+MIRROR_PROBE_BYTES = 2**18
+
 
 # =============================================================================
 # DICTIONARIES
@@ -377,3 +410,85 @@ DICT_CIS_OSM =  {
                             building='hut' or building='industrial' or 
                             building='shed' or building='apartments'"""}
                               }
+
+"""
+mapping of the categories of DICT_CIS_OSM to the layers of the free shapefiles
+of Geofabrik (gis_osm_<layer>_free_1.shp in the -free.shp.zip archives), used
+by extract.extract_cis_shp().
+
+Per category, a list of (layers, field, tags) tuples: features of the layers
+are selected by the value of field, and tags maps each value to the OSM tags
+it stands for, which fill the osm_keys columns of DICT_CIS_OSM. The key None
+stands for an empty field.
+
+Only categories which the shapefiles cover are listed; e.g. power lines,
+pipelines and telecom lines are not part of the free shapefiles.
+
+See also
+--------
+https://download.geofabrik.de/osm-data-in-gis-formats-free.pdf
+"""
+DICT_CIS_SHP = {
+    'education': [
+        (['pois', 'pois_a'], 'fclass', {
+            'school': {'amenity': 'school'},
+            'kindergarten': {'amenity': 'kindergarten'},
+            'college': {'amenity': 'college'},
+            'university': {'amenity': 'university'}})],
+    'healthcare': [
+        (['pois', 'pois_a'], 'fclass', {
+            'hospital': {'amenity': 'hospital'},
+            'clinic': {'amenity': 'clinic'},
+            'doctors': {'amenity': 'doctors'}})],
+    'water': [
+        (['pois', 'pois_a'], 'fclass', {
+            'water_well': {'man_made': 'water_well'},
+            'water_works': {'man_made': 'water_works'},
+            'water_tower': {'man_made': 'water_tower'}})],
+    'telecom': [
+        (['pois', 'pois_a'], 'fclass', {
+            'comms_tower': {'man_made': 'tower',
+                            'tower_type': 'communication'}})],
+    'road': [
+        (['roads'], 'fclass', {
+            'unknown': {'highway': 'road'},
+            **{value: {'highway': value} for value in [
+                'motorway', 'motorway_link', 'trunk', 'trunk_link',
+                'primary', 'primary_link', 'secondary', 'secondary_link',
+                'tertiary', 'tertiary_link', 'residential',
+                'unclassified']}})],
+    'main_road': [
+        (['roads'], 'fclass', {
+            value: {'highway': value} for value in [
+                'primary', 'primary_link', 'secondary', 'secondary_link',
+                'tertiary', 'tertiary_link', 'trunk', 'trunk_link',
+                'motorway', 'motorway_link']})],
+    'rail': [
+        (['railways'], 'fclass', {
+            value: {'railway': value} for value in [
+                'rail', 'tram', 'subway', 'narrow_gauge', 'light_rail']}),
+        (['transport', 'transport_a'], 'fclass', {
+            'railway_station': {'railway': 'station'},
+            'railway_halt': {'railway': 'halt'},
+            'tram_stop': {'railway': 'tram_stop'}})],
+    'air': [
+        (['transport_a'], 'fclass', {
+            'airport': {'aeroway': 'aerodrome'},
+            'airfield': {'aeroway': 'aerodrome'}})],
+    'oil': [
+        (['traffic', 'traffic_a'], 'fclass', {
+            'fuel': {'amenity': 'fuel'}})],
+    'wastewater': [
+        (['pois', 'pois_a'], 'fclass', {
+            'wastewater_plant': {'man_made': 'wastewater_plant'}})],
+    'food': [
+        (['pois', 'pois_a'], 'fclass', {
+            value: {'shop': value} for value in [
+                'supermarket', 'greengrocer', 'general', 'bakery']})],
+    'buildings': [
+        (['buildings_a'], 'type', {
+            None: {'building': 'yes'},
+            **{value: {'building': value} for value in [
+                'house', 'residential', 'detached', 'hut', 'industrial',
+                'shed', 'apartments']}})],
+}
@@ -0,0 +1,40 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+running the external command line tools, e.g. osmosis, osmconvert and osmium
+"""
+
+import logging
+import os
+import pathlib
+import subprocess
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _run_command(cmd, env=None):
+    """
+    Run a command line tool with additional environment variables. The
+    output on stderr is passed on to the logger.
+
+    Raises
+    ------
+    RuntimeError
+        if the tool exits with a non-zero exit code
+    """
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            env={**os.environ, **env} if env else None)
+    for line in result.stderr.splitlines():
+        LOGGER.info('%s: %s', pathlib.Path(cmd[0]).name, line)
+    if result.returncode != 0:
+        raise RuntimeError(f'{cmd[0]} failed with exit code '
+                           f'{result.returncode}.')
+    return result
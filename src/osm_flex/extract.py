@@ -12,14 +12,17 @@ extraction functions
 """
 
 import logging
+import re
+import zipfile
 import geopandas as gpd
+import numpy as np
 from osgeo import ogr, gdal
 import pandas as pd
 from pathlib import Path
 import shapely
 from tqdm import tqdm
 
-from osm_flex.config import DICT_CIS_OSM, OSM_CONFIG_FILE
+from osm_flex.config import DICT_CIS_OSM, DICT_CIS_SHP, OSM_CONFIG_FILE
 
 
 LOGGER = logging.getLogger(__name__)
@@ -54,7 +57,8 @@ def _query_builder(geo_type, constraint_dict):
         query += " FROM " + geo_type + f" WHERE {constraint_dict['osm_keys'][0]} IS NOT NULL"
     return query
 
-def extract(osm_path, geo_type, osm_keys, osm_query=None):
+def extract(osm_path, geo_type, osm_keys, osm_query=None, as_xy=False,
+            bbox=None):
     """
     Function to extract geometries and tag info for entires in the OSM file
     matching certain OSM keys, or key-value constraints.
@@ -74,12 +78,27 @@ def extract(osm_path, geo_type, osm_keys, osm_query=None):
         "key='value' (and/or further queries)". If left empty, all objects
         for which the first entry of osm_keys is not Null will be parsed.
         See examples in DICT_CIS_OSM in case of doubt.
+    as_xy : bool
+        optional, only for geo_type 'points'. If True, the point coordinates
+        are returned as float64 columns x and y of a plain DataFrame instead
+        of shapely Points, which is much more compact for millions of points.
+        Default is False.
+    bbox : list, optional
+        [xmin, ymin, xmax, ymax]. If given, only features intersecting the
+        bounding box are read, which avoids converting all other features.
+        Default is None.
 
     Returns
     -------
     gpd.GeoDataFrame
         A gdf with all results from the osm.pbf file matching the
         specified constraints.
+        If as_xy is True, a pd.DataFrame with columns x and y (lon/lat in
+        EPSG:4326) instead of the geometry column. Shapely Points can be
+        created from it when needed with
+        gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.x, df.y),
+        crs="epsg:4326"). The functions of the simplify module accept it
+        directly.
 
     Note
     ----
@@ -109,33 +128,34 @@ def extract(osm_path, geo_type, osm_keys, osm_query=None):
     """
     if not Path(osm_path).is_file():
         raise ValueError(f"the given path is not a file: {osm_path}")
+    if as_xy and geo_type != 'points':
+        raise ValueError("as_xy is only available for geo_type 'points'")
 
     osm_path = str(osm_path)
     constraint_dict = {
         'osm_keys' : osm_keys,
         'osm_query' : osm_query}
+    columns = ["osm_id", *constraint_dict["osm_keys"]]
 
     driver = ogr.GetDriverByName('OSM')
     data = driver.Open(osm_path)
     query = _query_builder(geo_type, constraint_dict)
     LOGGER.debug("query: %s", query)
-    sql_lyr = data.ExecuteSQL(query)
+    spatial_filter = None
+    if bbox is not None:
+        spatial_filter = ogr.CreateGeometryFromWkb(
+            shapely.to_wkb(shapely.box(*bbox)))
+    sql_lyr = data.ExecuteSQL(query, spatialFilter=spatial_filter)
     features = []
     geometry = []
     if data is not None:
         LOGGER.info('query is finished, lets start the loop')
         for feature in tqdm(sql_lyr, desc=f'extract {geo_type}'):
             try:
-                wkb = feature.geometry().ExportToWkb()
-                geom = shapely.wkb.loads(bytes(wkb))
-                if geom is None:
-                    continue
-                geometry.append(geom)
-                fields = [
-                    feature.GetField(key)
-                    for key in ["osm_id", *constraint_dict["osm_keys"]]
-                ]
-                features.append(fields)
+                geom = feature.GetGeometryRef()
+                geometry.append((geom.GetX(), geom.GetY()) if as_xy
+                                else bytes(geom.ExportToWkb()))
+                features.append([feature.GetField(key) for key in columns])
             except Exception as exc:
                 LOGGER.info('%s - %s', exc.__class__, exc)
                 LOGGER.warning("skipped OSM feature")
@@ -144,15 +164,25 @@ def extract(osm_path, geo_type, osm_keys, osm_query=None):
                      query and the OSM config file under the respective
                      geometry - perhaps key is unknown.""")
 
+    if as_xy:
+        df = pd.DataFrame(features, columns=columns)
+        df[['x', 'y']] = np.array(geometry, dtype=np.float64).reshape(-1, 2)
+        return df
+
+    geometry = shapely.from_wkb(geometry, on_invalid='ignore')
+    valid = ~shapely.is_missing(geometry)
+    if not valid.all():
+        LOGGER.warning("skipped %d OSM features with invalid geometry",
+                       (~valid).sum())
     return gpd.GeoDataFrame(
-        features,
-        columns=["osm_id", *constraint_dict['osm_keys']],
-        geometry=geometry,
+        [fields for fields, keep in zip(features, valid) if keep],
+        columns=columns,
+        geometry=geometry[valid],
         crs="epsg:4326"
     )
 
 # TODO: decide on name of wrapper, which categories included & what components fall under it.
-def extract_cis(osm_path, ci_type):
+def extract_cis(osm_path, ci_type, bbox=None):
     """
     A wrapper around extract() to conveniently extract map info for a
     selection of  critical infrastructure types from the given osm.pbf file.
@@ -165,6 +195,9 @@ def extract_cis(osm_path, ci_type):
         one of DICT_CIS_OSM.keys(), i.e. 'education', 'healthcare',
         'water', 'telecom', 'road', 'rail', 'air', 'gas', 'oil', 'power',
         'wastewater', 'food'
+    bbox : list, optional
+        [xmin, ymin, xmax, ymax]. If given, only features intersecting the
+        bounding box are extracted. Default is None.
     See also
     -------
     DICT_CIS_OSM for the keys and key/value tags queried for the respective
@@ -174,29 +207,182 @@ def extract_cis(osm_path, ci_type):
     if ci_type in ['healthcare','education','food', 'buildings']:
         gdf = pd.concat([
             extract(osm_path, 'points', DICT_CIS_OSM[ci_type]['osm_keys'],
-                    DICT_CIS_OSM[ci_type]['osm_query']),
+                    DICT_CIS_OSM[ci_type]['osm_query'], bbox=bbox),
             extract(osm_path, 'multipolygons', DICT_CIS_OSM[ci_type]['osm_keys'],
-                    DICT_CIS_OSM[ci_type]['osm_query'])
+                    DICT_CIS_OSM[ci_type]['osm_query'], bbox=bbox)
             ])
 
     # features consisting in multipolygon results:
     elif ci_type in ['air']:
         gdf = extract(osm_path, 'multipolygons',
                       DICT_CIS_OSM[ci_type]['osm_keys'],
-                      DICT_CIS_OSM[ci_type]['osm_query'])
+                      DICT_CIS_OSM[ci_type]['osm_query'], bbox=bbox)
 
     # features consisting in points, multipolygons and lines:
     elif ci_type in ['gas','oil','telecom','water','wastewater','power',
                      'rail','road', 'main_road']:
         gdf =  pd.concat([
             extract(osm_path, 'points', DICT_CIS_OSM[ci_type]['osm_keys'],
-                    DICT_CIS_OSM[ci_type]['osm_query']),
+                    DICT_CIS_OSM[ci_type]['osm_query'], bbox=bbox),
             extract(osm_path, 'multipolygons', DICT_CIS_OSM[ci_type]['osm_keys'],
-                             DICT_CIS_OSM[ci_type]['osm_query']),
+                             DICT_CIS_OSM[ci_type]['osm_query'], bbox=bbox),
             extract(osm_path, 'lines', DICT_CIS_OSM[ci_type]['osm_keys'],
-                             DICT_CIS_OSM[ci_type]['osm_query'])
+                             DICT_CIS_OSM[ci_type]['osm_query'], bbox=bbox)
             ])
     else:
         LOGGER.warning('feature not in DICT_CIS_OSM. Returning empty gdf')
         gdf = gpd.GeoDataFrame()
     return gdf
+
+
+def _shp_layers(shp_zip):
+    """
+    members of a Geofabrik shapefile archive, by layer name, e.g.
+    {'pois_a': ['gis_osm_pois_a_free_1.shp']}
+    """
+    with zipfile.ZipFile(shp_zip) as archive:
+        names = archive.namelist()
+    layers = {}
+    for name in names:
+        match = re.fullmatch(r'(?:.*/)?gis_osm_(\w+?)_free_\d+\.shp', name)
+        if match:
+            layers.setdefault(match[1], []).append(name)
+    return layers
+
+
+def _shp_filter(field, values):
+    """OGR attribute filter selecting the given values of field"""
+    conditions = []
+    listed = [f"'{value}'" for value in values if value is not None]
+    if listed:
+        conditions.append(f"{field} IN ({', '.join(listed)})")
+    if None in values:
+        conditions.append(f"{field} IS NULL OR {field} = ''")
+    return ' OR '.join(conditions)
+
+
+def _shp_value(value):
+    """attribute value as in the osm.pbf extracts: str, or None if empty"""
+    return None if value in (None, '', 0) else str(value)
+
+
+def extract_cis_shp(shp_zip, ci_type, bbox=None):
+    """
+    Extract critical infrastructure from a Geofabrik shapefile archive
+    (-free.shp.zip, see download.get_country_geofabrik(file_format='shp')),
+    with the same columns as extract_cis().
+
+    The layers are read in place from the archive with GDAL's /vsizip/
+    virtual file system, without unzipping it. This is much faster than
+    parsing the osm.pbf file, but only covers the categories of DICT_CIS_SHP
+    and the tags which the shapefiles keep.
+
+    Parameters
+    ----------
+    shp_zip : str or Path
+        location of the -free.shp.zip archive
+    ci_type : str
+        one of DICT_CIS_SHP.keys(), i.e. 'education', 'healthcare', 'water',
+        'telecom', 'road', 'main_road', 'rail', 'air', 'oil', 'wastewater',
+        'food', 'buildings'
+    bbox : list, optional
+        [xmin, ymin, xmax, ymax]. If given, only features intersecting the
+        bounding box are extracted. Default is None.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        columns osm_id and the osm_keys of DICT_CIS_OSM[ci_type], filled from
+        the feature classes of the shapefiles and their attributes of the same
+        name (e.g. name, maxspeed)
+
+    See also
+    --------
+    DICT_CIS_SHP for the layers and feature classes (fclass) per category.
+    """
+    if ci_type not in DICT_CIS_SHP:
+        raise ValueError(
+            f"'{ci_type}' is not covered by the Geofabrik shapefiles, choose "
+            f"one of {list(DICT_CIS_SHP)} or use extract_cis() with the "
+            "osm.pbf file instead.")
+    osm_keys = DICT_CIS_OSM[ci_type]['osm_keys']
+    columns = ['osm_id', *osm_keys]
+    shp_zip = Path(shp_zip).resolve()
+    members = _shp_layers(shp_zip)
+
+    features = []
+    geometry = []
+    n_missing = 0
+    for layer_names, field, tags_by_value in DICT_CIS_SHP[ci_type]:
+        for member in [member for layer_name in layer_names
+                       for member in members.get(layer_name, [])]:
+            data = ogr.Open(f'/vsizip/{shp_zip}/{member}')
+            layer = data.GetLayer()
+            layer.SetAttributeFilter(_shp_filter(field, tags_by_value))
+            if bbox is not None:
+                layer.SetSpatialFilterRect(*bbox)
+            defn = layer.GetLayerDefn()
+            attributes = [key for key in osm_keys
+                          if defn.GetFieldIndex(key) >= 0]
+            LOGGER.debug("%s: %d features", member, layer.GetFeatureCount())
+            for feature in layer:
+                geom = feature.GetGeometryRef()
+                if geom is None:
+                    n_missing += 1
+                    continue
+                tags = {key: _shp_value(feature.GetField(key))
+                        for key in attributes}
+                tags.update(tags_by_value[feature.GetField(field) or None])
+                features.append([feature.GetField('osm_id'),
+                                 *[tags.get(key) for key in osm_keys]])
+                geometry.append(bytes(geom.ExportToWkb()))
+
+    if n_missing:
+        LOGGER.warning("skipped %d features without geometry", n_missing)
+    return gpd.GeoDataFrame(features, columns=columns,
+                            geometry=shapely.from_wkb(geometry),
+                            crs="epsg:4326")
+
+
+def extract_in_shape(osm_path, shapes, ci_type):
+    """
+    Extract critical infrastructure within one or several shapes directly
+    from a larger osm.pbf file, without clipping it first.
+
+    The file is read once, restricted to the bounding box of all shapes.
+    The extracted features are then assigned to the shapes they intersect
+    with a single bulk query of a spatial index.
+
+    Parameters
+    ----------
+    osm_path : str or Path
+        location of osm.pbf file from which to parse
+    shapes : shapely.Geometry or list or dict
+        (Multi-)Polygon, or a list or dict of (Multi-)Polygons, e.g. the
+        admin1 shapes of clip.get_admin1_shapes()
+    ci_type : str
+        one of DICT_CIS_OSM.keys(), see extract_cis()
+
+    Returns
+    -------
+    gpd.GeoDataFrame or list or dict
+        the features intersecting each shape; a single gdf for a single
+        shape, otherwise a list or dict like shapes
+    """
+    if isinstance(shapes, shapely.Geometry):
+        return extract_in_shape(osm_path, [shapes], ci_type)[0]
+    if isinstance(shapes, dict):
+        return dict(zip(shapes, extract_in_shape(
+            osm_path, list(shapes.values()), ci_type)))
+
+    shapes = np.asarray(shapes, dtype=object)
+    gdf = extract_cis(osm_path, ci_type, bbox=shapely.total_bounds(shapes))
+    if gdf.empty:
+        return [gdf.copy() for _ in shapes]
+
+    shape_idx, feature_idx = shapely.STRtree(gdf.geometry.values).query(
+        shapes, predicate='intersects')
+    order = np.argsort(shape_idx, kind='stable')
+    splits = np.searchsorted(shape_idx[order], np.arange(1, len(shapes)))
+    return [gdf.iloc[np.sort(idx)]
+            for idx in np.split(feature_idx[order], splits)]
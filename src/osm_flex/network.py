@@ -0,0 +1,231 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+network topology functions
+"""
+
+import logging
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _hash_coords(coords, tolerance):
+    """
+    Map coordinates onto a regular grid with cell size tolerance and return
+    the integer grid keys, one row per coordinate.
+    """
+    return np.round(coords / tolerance).astype(np.int64)
+
+
+def _lookup_rows(keys, query):
+    """
+    Positions of the rows in query within keys, which must be unique and
+    sorted lexicographically (as returned by np.unique(..., axis=0)).
+    """
+    dtype = [('x', np.int64), ('y', np.int64)]
+    keys = np.ascontiguousarray(keys).view(dtype).ravel()
+    query = np.ascontiguousarray(query).view(dtype).ravel()
+    return np.searchsorted(keys, query)
+
+
+def _endpoints(counts):
+    """
+    Positions of the first and last coordinates of consecutive lines in a
+    coordinate array, given the number of coordinates per line
+    """
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    return starts, ends - 1
+
+
+def _connected_labels(n_items, pairs_a, pairs_b):
+    """
+    Label connected components of items linked by pairs, by propagating the
+    minimal label along the links with pointer jumping.
+
+    Returns
+    -------
+    np.ndarray
+        component label (smallest item index in the component) per item
+    """
+    labels = np.arange(n_items)
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, pairs_a, labels[pairs_b])
+        np.minimum.at(labels, pairs_b, labels[pairs_a])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def build_network(gdf, merge_keys=None, snap_tolerance=1e-7):
+    """
+    Build a compact network topology from line features, such as the road,
+    main_road and rail categories of extract_cis().
+
+    Line endpoints which fall into the same cell of a grid with cell size
+    snap_tolerance are snapped onto a common node. Chains of lines which are
+    joined at nodes of degree two, and which share the same values for all
+    merge_keys, are merged into single edges.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        GeoDataFrame with (multi-)linestring geometries. Entries with other
+        geometry types are ignored.
+    merge_keys : list, optional
+        columns whose values must be equal for two lines to be merged.
+        Default is all columns except osm_id and the geometry.
+    snap_tolerance : float, optional
+        grid size for snapping endpoints, in units of the gdf crs.
+        Default is 1e-7 (ca. 1 cm in EPSG:4326).
+
+    Returns
+    -------
+    nodes : gpd.GeoDataFrame
+        one row per node (index is the node id) with the node degree
+    edges : gpd.GeoDataFrame
+        one row per merged edge with from_node, to_node, the attributes of
+        the first merged line and the number of merged lines (n_segments)
+
+    See also
+    --------
+    network_to_csr() to obtain the adjacency of the network as CSR arrays.
+    """
+    lines = gdf[gdf.geometry.type.isin(['LineString', 'MultiLineString'])
+                & ~gdf.geometry.is_empty]
+    if len(lines) < len(gdf):
+        LOGGER.info('ignore %d non-line entries', len(gdf) - len(lines))
+    lines = lines.explode(index_parts=False).reset_index(drop=True)
+    geom_col = lines.geometry.name
+    if merge_keys is None:
+        merge_keys = [col for col in lines.columns
+                      if col not in ('osm_id', geom_col)]
+
+    # snap endpoints onto nodes
+    coords, index = shapely.get_coordinates(lines.geometry.values,
+                                            return_index=True)
+    counts = np.bincount(index, minlength=len(lines))
+    first, last = _endpoints(counts)
+    node_keys, node_pos, inverse = np.unique(
+        _hash_coords(np.concatenate([coords[first], coords[last]]),
+                     snap_tolerance),
+        axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    node_xy = np.concatenate([coords[first], coords[last]])[node_pos]
+    from_node, to_node = np.split(inverse, 2)
+    coords[first] = node_xy[from_node]
+    coords[last] = node_xy[to_node]
+
+    # drop lines which collapse to a single node
+    valid = ~((from_node == to_node) & (counts <= 2))
+    geometry = shapely.linestrings(coords, indices=index)[valid]
+    lines = lines[valid].reset_index(drop=True)
+    from_node, to_node = from_node[valid], to_node[valid]
+
+    # merge degree-2 chains of lines with equal attributes
+    n_lines = len(lines)
+    attr = (lines.groupby(merge_keys, dropna=False, sort=False).ngroup()
+            .to_numpy() if merge_keys else np.zeros(n_lines, dtype=int))
+    end_node = np.concatenate([from_node, to_node])
+    end_line = np.tile(np.arange(n_lines), 2)
+    degree = np.bincount(end_node, minlength=len(node_keys))
+    order = np.argsort(end_node, kind='stable')
+    end_node, end_line = end_node[order], end_line[order]
+    is_pair = ((degree[end_node[:-1]] == 2)
+               & (end_node[:-1] == end_node[1:]))
+    line_a, line_b = end_line[:-1][is_pair], end_line[1:][is_pair]
+    mergeable = (line_a != line_b) & (attr[line_a] == attr[line_b])
+    labels = _connected_labels(n_lines, line_a[mergeable], line_b[mergeable])
+
+    group_id = pd.factorize(labels, sort=True)[0]
+    n_segments = np.bincount(group_id)
+    first_line = np.unique(group_id, return_index=True)[1]
+    merged = geometry[first_line]
+    multi = n_segments[group_id] > 1
+    if multi.any():
+        multi_groups, multi_index = np.unique(group_id[multi],
+                                              return_inverse=True)
+        merged[multi_groups] = shapely.line_merge(
+            shapely.multilinestrings(geometry[multi], indices=multi_index))
+
+    # endpoints of the merged edges
+    merged_coords, merged_index = shapely.get_coordinates(merged,
+                                                          return_index=True)
+    first, last = _endpoints(np.bincount(merged_index,
+                                         minlength=len(merged)))
+    edge_from = _lookup_rows(
+        node_keys, _hash_coords(merged_coords[first], snap_tolerance))
+    edge_to = _lookup_rows(
+        node_keys, _hash_coords(merged_coords[last], snap_tolerance))
+
+    # renumber the remaining nodes
+    used, inverse = np.unique(np.concatenate([edge_from, edge_to]),
+                              return_inverse=True)
+    edge_from, edge_to = np.split(inverse.ravel(), 2)
+
+    edges = lines.iloc[first_line].drop(columns=geom_col).reset_index(drop=True)
+    edges.insert(0, 'from_node', edge_from)
+    edges.insert(1, 'to_node', edge_to)
+    edges['n_segments'] = n_segments
+    edges = gpd.GeoDataFrame(edges, geometry=merged, crs=gdf.crs)
+
+    nodes = gpd.GeoDataFrame(
+        {'degree': np.bincount(np.concatenate([edge_from, edge_to]),
+                               minlength=len(used))},
+        geometry=shapely.points(node_xy[used]), crs=gdf.crs)
+    nodes.index.name = 'node_id'
+
+    LOGGER.info('merged %d lines into %d edges between %d nodes',
+                n_lines, len(edges), len(nodes))
+    return nodes, edges
+
+
+def network_to_csr(edges, n_nodes=None, directed=False):
+    """
+    Adjacency of a network in compressed sparse row (CSR) format.
+
+    The neighbours of node i are indices[indptr[i]:indptr[i+1]], connected
+    via the edges edge_index[indptr[i]:indptr[i+1]]. The arrays can be stored
+    with np.savez and loaded quickly for network analysis.
+
+    Parameters
+    ----------
+    edges : pd.DataFrame
+        edge table with columns from_node and to_node, as returned by
+        build_network()
+    n_nodes : int, optional
+        number of nodes. Default is the largest node id + 1.
+    directed : bool, optional
+        if False (default), every edge is listed for both of its nodes.
+
+    Returns
+    -------
+    indptr, indices, edge_index : np.ndarray
+        CSR row pointers, neighbour node ids and edge positions
+    """
+    source = edges['from_node'].to_numpy()
+    target = edges['to_node'].to_numpy()
+    edge_index = np.arange(len(edges))
+    if not directed:
+        source, target = (np.concatenate([source, target]),
+                          np.concatenate([target, source]))
+        edge_index = np.tile(edge_index, 2)
+    if n_nodes is None:
+        n_nodes = int(source.max()) + 1 if len(source) else 0
+
+    order = np.argsort(source, kind='stable')
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source, minlength=n_nodes), out=indptr[1:])
+    return indptr, target[order], edge_index[order]
@@ -0,0 +1,323 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+reading metadata from osm.pbf files
+
+A minimal decoder of the protocol buffer messages of the OSM PBF format, see
+https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+import lzma
+import pathlib
+import struct
+import zlib
+import numpy as np
+
+# nanodegrees per degree
+_NANO = 1e9
+# maximal size of a BlobHeader in bytes
+_MAX_BLOB_HEADER = 64 * 1024
+
+
+def _read_varint(buf, pos):
+    """decode the varint starting at buf[pos], return value and next pos"""
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        result |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    """decode a zigzag-encoded signed integer (protobuf sint64)"""
+    return (value >> 1) ^ -(value & 1)
+
+
+def _iter_fields(buf):
+    """
+    iterate over the fields of a protocol buffer message
+
+    Yields
+    ------
+    field, value : int, int or bytes
+        field number and value: an int for varints and fixed-size fields, the
+        raw bytes for length-delimited fields
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value = struct.unpack_from('<q', buf, pos)[0]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = bytes(buf[pos:pos+length])
+            pos += length
+        elif wire_type == 5:
+            value = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}.')
+        yield field, value
+
+
+def _read_blob(file):
+    """
+    read the next blob of a PBF file
+
+    Returns
+    -------
+    blob_type, data : str, bytes
+        type of the blob ('OSMHeader' or 'OSMData') and its raw (not yet
+        decompressed) Blob message, or (None, None) at the end of the file
+    """
+    size = file.read(4)
+    if len(size) < 4:
+        return None, None
+    header = dict(_iter_fields(file.read(struct.unpack('>I', size)[0])))
+    return header[1].decode(), file.read(header[3])
+
+
+def _decompress_blob(blob):
+    """decompress the content of a Blob message"""
+    fields = dict(_iter_fields(blob))
+    if 1 in fields:
+        return fields[1]
+    if 3 in fields:
+        return zlib.decompress(fields[3])
+    if 4 in fields:
+        return lzma.decompress(fields[4])
+    raise ValueError('Unsupported compression of PBF blob.')
+
+
+def parse_header_block(data):
+    """
+    decode a (decompressed) OSM HeaderBlock message
+
+    Parameters
+    ----------
+    data : bytes
+        the HeaderBlock message
+
+    Returns
+    -------
+    dict
+        bbox : [xmin, ymin, xmax, ymax] in degrees, or None
+        required_features, optional_features : list of str
+        writingprogram, source : str or None
+        replication_timestamp : int or None, seconds since the epoch
+        replication_sequence_number : int or None
+        replication_base_url : str or None
+    """
+    header = {'bbox': None, 'required_features': [], 'optional_features': [],
+              'writingprogram': None, 'source': None,
+              'replication_timestamp': None,
+              'replication_sequence_number': None,
+              'replication_base_url': None}
+    for field, value in _iter_fields(data):
+        if field == 1:
+            bbox = {key: _zigzag(val) / _NANO
+                    for key, val in _iter_fields(value)}
+            # HeaderBBox: left=1, right=2, top=3, bottom=4
+            header['bbox'] = [bbox[1], bbox[4], bbox[2], bbox[3]]
+        elif field == 4:
+            header['required_features'].append(value.decode())
+        elif field == 5:
+            header['optional_features'].append(value.decode())
+        elif field == 16:
+            header['writingprogram'] = value.decode()
+        elif field == 17:
+            header['source'] = value.decode()
+        elif field == 32:
+            header['replication_timestamp'] = value
+        elif field == 33:
+            header['replication_sequence_number'] = value
+        elif field == 34:
+            header['replication_base_url'] = value.decode()
+    return header
+
+
+def read_header(osm_path):
+    """
+    Read the header of an osm.pbf file, without reading the data blocks.
+
+    Parameters
+    ----------
+    osm_path : str or pathlib.Path
+        location of the osm.pbf file
+
+    Returns
+    -------
+    dict
+        the header information, see parse_header_block()
+
+    Raises
+    ------
+    ValueError
+        if the file does not start with an OSMHeader block
+    """
+    with open(pathlib.Path(osm_path), 'rb') as file:
+        try:
+            blob_type, blob = _read_blob(file)
+        except (KeyError, IndexError, AttributeError, struct.error) as err:
+            raise ValueError(f'{osm_path} is not a valid osm.pbf file.') from err
+    if blob_type != 'OSMHeader':
+        raise ValueError(f'{osm_path} is not a valid osm.pbf file.')
+    return parse_header_block(_decompress_blob(blob))
+
+
+def header_from_bytes(data):
+    """
+    Decode the header of an osm.pbf file from its first bytes, e.g. while
+    the file is being downloaded.
+
+    Parameters
+    ----------
+    data : bytes
+        the first bytes of the file
+
+    Returns
+    -------
+    dict or None
+        the header information (see parse_header_block()), or None if data
+        does not contain the complete header block yet
+
+    Raises
+    ------
+    ValueError
+        if data is not the start of an osm.pbf file
+    """
+    if len(data) < 4:
+        return None
+    size = struct.unpack('>I', data[:4])[0]
+    # the BlobHeader is limited to 64 KiB by the format
+    if size > _MAX_BLOB_HEADER:
+        raise ValueError('Data is not an osm.pbf file.')
+    if len(data) < 4 + size:
+        return None
+    try:
+        blob_header = dict(_iter_fields(data[4:4 + size]))
+        if blob_header.get(1) != b'OSMHeader':
+            raise ValueError('Data does not start with an OSMHeader block.')
+        end = 4 + size + blob_header[3]
+        if len(data) < end:
+            return None
+        return parse_header_block(_decompress_blob(data[4 + size:end]))
+    except (KeyError, IndexError, AttributeError, struct.error,
+            zlib.error, lzma.LZMAError) as err:
+        raise ValueError('Data is not an osm.pbf file.') from err
+
+
+def _decode_varints(data):
+    """decode a packed array of varints, vectorized"""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if not len(buf):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shift = 7 * (np.arange(len(buf)) - np.repeat(starts, ends - starts + 1))
+    values = (buf & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+def _decode_sint64s(data):
+    """decode a packed array of zigzag-encoded signed integers"""
+    values = _decode_varints(data)
+    return ((values >> np.uint64(1)).astype(np.int64)
+            ^ -(values & np.uint64(1)).astype(np.int64))
+
+
+def _dense_node_coords(block):
+    """
+    coordinates of the dense nodes in a (decompressed) PrimitiveBlock, as an
+    array of lon, lat in degrees
+    """
+    granularity, lat_offset, lon_offset = 100, 0, 0
+    lats, lons = [], []
+    for field, value in _iter_fields(block):
+        if field == 2:
+            for group_field, group in _iter_fields(value):
+                if group_field != 2:
+                    continue
+                for dense_field, packed in _iter_fields(group):
+                    if dense_field == 8:
+                        lats.append(np.cumsum(_decode_sint64s(packed)))
+                    elif dense_field == 9:
+                        lons.append(np.cumsum(_decode_sint64s(packed)))
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = value
+        elif field == 20:
+            lon_offset = value
+    if not lats:
+        return np.zeros((0, 2))
+    lat = (lat_offset + granularity * np.concatenate(lats)) / _NANO
+    lon = (lon_offset + granularity * np.concatenate(lons)) / _NANO
+    return np.column_stack([lon, lat])
+
+
+def sample_nodes(osm_path, sample_every=10):
+    """
+    Sample node coordinates from an osm.pbf file, by decoding only every
+    sample_every-th data block. The other blocks are skipped without
+    decompressing them.
+
+    Parameters
+    ----------
+    osm_path : str or pathlib.Path
+        location of the osm.pbf file
+    sample_every : int, optional
+        decode every sample_every-th data block. Default is 10.
+
+    Returns
+    -------
+    coords : np.ndarray
+        lon, lat of the sampled (dense) nodes, shape (n, 2)
+    scale : float
+        number of data blocks per decoded block, i.e. the factor to
+        extrapolate node counts of the sample to the whole file
+
+    Raises
+    ------
+    ValueError
+        if sample_every is smaller than 1
+    """
+    if sample_every < 1:
+        raise ValueError('sample_every must be at least 1, not '
+                         f'{sample_every}.')
+    sampled = []
+    n_blocks = 0
+    with open(pathlib.Path(osm_path), 'rb') as file:
+        while True:
+            size = file.read(4)
+            if len(size) < 4:
+                break
+            header = dict(_iter_fields(file.read(struct.unpack('>I', size)[0])))
+            if header[1] != b'OSMData':
+                file.seek(header[3], 1)
+                continue
+            if n_blocks % sample_every:
+                file.seek(header[3], 1)
+            else:
+                sampled.append(_dense_node_coords(
+                    _decompress_blob(file.read(header[3]))))
+            n_blocks += 1
+    n_sampled = len(sampled)
+    coords = np.concatenate(sampled) if sampled else np.zeros((0, 2))
+    return coords, n_blocks / n_sampled if n_sampled else 0.
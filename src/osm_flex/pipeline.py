@@ -0,0 +1,415 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+download, clip and extract many countries with overlapping stages
+
+Each stage runs in its own worker threads and passes the countries on to the
+next stage through a bounded queue, such that e.g. the download of the next
+country runs while the current one is extracted. A full queue blocks the
+stage before it, which limits the number of downloaded files waiting for
+the slower stages.
+"""
+
+import dataclasses
+import functools
+import logging
+import pathlib
+import queue
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import shapely
+
+from osm_flex.clip import _clip, write_poly
+from osm_flex.config import EXTRACT_DIR, OSM_DATA_DIR
+from osm_flex.download import (DownloadMetrics, TokenBucket,
+                               _create_gf_download_url, get_country_geofabrik)
+from osm_flex.extract import extract_cis
+
+LOGGER = logging.getLogger(__name__)
+
+# end of the input of a stage worker
+_DONE = object()
+
+
+@dataclasses.dataclass
+class PipelineResult:
+    """
+    outcome of the pipeline for one country, see run_pipeline()
+
+    Attributes
+    ----------
+    iso3 : str
+        ISO3 code of the country
+    status : str
+        'done', 'failed' or 'cancelled'
+    osm_path : pathlib.Path or None
+        the downloaded country file
+    download : download.DownloadMetrics or None
+        metrics of the download, whose status shows whether the country file
+        was downloaded ('done') or already existed ('skipped', 'unchanged')
+    clip_path : pathlib.Path or None
+        the clipped file, None if the country was not clipped
+    gdfs : dict
+        extracted features per CI type
+    error : Exception or None
+        the exception raised by the failed stage
+    stage : str or None
+        name of the failed stage
+    durations : dict
+        run time in seconds per stage
+    """
+    iso3: str
+    status: str = 'done'
+    osm_path: Optional[pathlib.Path] = None
+    download: Optional[DownloadMetrics] = None
+    clip_path: Optional[pathlib.Path] = None
+    gdfs: dict = dataclasses.field(default_factory=dict)
+    error: Optional[Exception] = None
+    stage: Optional[str] = None
+    durations: dict = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class StageStats:
+    """
+    utilization of a pipeline stage, summed over its workers
+
+    Attributes
+    ----------
+    name : str
+        name of the stage, 'download', 'clip' or 'extract'
+    workers : int
+        number of worker threads of the stage
+    items : int
+        number of countries processed
+    failed : int
+        number of countries which failed in this stage
+    busy : float
+        seconds spent processing countries
+    starved : float
+        seconds spent waiting for countries from the previous stage
+    blocked : float
+        seconds spent waiting for space in the queue of the next stage
+    wall : float
+        run time of the whole pipeline in seconds
+    """
+    name: str
+    workers: int
+    items: int = 0
+    failed: int = 0
+    busy: float = 0.
+    starved: float = 0.
+    blocked: float = 0.
+    wall: float = 0.
+
+    @property
+    def utilization(self):
+        """fraction of the capacity of the workers spent processing"""
+        capacity = self.workers * self.wall
+        return self.busy / capacity if capacity else 0.
+
+    def as_dict(self):
+        """the stats as a dict, with the utilization"""
+        return {**dataclasses.asdict(self), 'utilization': self.utilization}
+
+
+def _download_stage(result, save_path, overwrite, verify, update, rate_limit,
+                    url_locks, downloaded):
+    """download the country file of result"""
+    url = _create_gf_download_url(result.iso3, 'pbf')
+    with url_locks[url]:
+        # countries in the same file (e.g. 'SEN' and 'GMB') share a download
+        result.osm_path, result.download = get_country_geofabrik(
+            result.iso3, save_path=save_path,
+            overwrite=overwrite and url not in downloaded, verify=verify,
+            update=update and url not in downloaded, rate_limit=rate_limit,
+            return_metrics=True)
+        downloaded.add(url)
+
+
+def _clip_stage(result, shapes, clip_dir, overwrite, kernel, cache,
+                max_vertices, kernel_options):
+    """
+    clip the country file of result to the shape of the country, if any.
+    An existing clip is reused, unless the country file was downloaded again
+    or is newer than the clip.
+    """
+    shape = shapes.get(result.iso3)
+    if shape is None:
+        return
+    output = pathlib.Path(clip_dir, f'{result.iso3}.osm.pbf')
+    stale = output.is_file() and (
+        (result.download is not None and result.download.status == 'done')
+        or result.osm_path.stat().st_mtime_ns > output.stat().st_mtime_ns)
+    if stale and not overwrite:
+        LOGGER.info('%s: %s is older than %s, clip again.', result.iso3,
+                    output, result.osm_path)
+    if not output.is_file() or overwrite or stale:
+        if isinstance(shape, shapely.Geometry):
+            shape = [shape]
+        with tempfile.TemporaryDirectory() as poly_dir:
+            if isinstance(shape[0], shapely.Geometry):
+                shape = write_poly(shape, poly_dir, max_vertices=max_vertices)
+            _clip(shape, result.osm_path, output, overwrite or stale, kernel,
+                  cache, **kernel_options)
+    result.clip_path = output
+
+
+def _extract_stage(result, ci_types, postprocess):
+    """extract the CI types from the (clipped) file of result"""
+    osm_path = result.clip_path or result.osm_path
+    for ci_type in ci_types:
+        gdf = extract_cis(osm_path, ci_type)
+        if postprocess is not None:
+            gdf = postprocess(gdf)
+        result.gdfs[ci_type] = gdf
+
+
+def _stage_worker(func, stats, inbox, outbox, lock, remaining, n_next,
+                  stop):
+    """
+    process the results from inbox with func and pass them on to outbox,
+    until the end of the input. Failed and cancelled results skip func.
+    The last worker of a stage to finish passes the end of the input on to
+    the n_next workers of the next stage.
+    """
+    while True:
+        start = time.perf_counter()
+        result = inbox.get()
+        waited = time.perf_counter() - start
+        if result is _DONE:
+            break
+        if stop.is_set() and result.status == 'done':
+            result.status = 'cancelled'
+        if result.status == 'done':
+            start = time.perf_counter()
+            try:
+                func(result)
+            except Exception as err:
+                LOGGER.error('%s: %s failed: %r', result.iso3, stats.name,
+                             err)
+                result.status, result.error = 'failed', err
+                result.stage = stats.name
+            duration = time.perf_counter() - start
+            result.durations[stats.name] = duration
+            with lock:
+                stats.starved += waited
+                stats.busy += duration
+                stats.items += 1
+                stats.failed += result.status == 'failed'
+        start = time.perf_counter()
+        outbox.put(result)
+        with lock:
+            stats.blocked += time.perf_counter() - start
+    with lock:
+        remaining[stats.name] -= 1
+        last = not remaining[stats.name]
+    if last:
+        for _ in range(n_next):
+            outbox.put(_DONE)
+
+
+def _run_stages(results, stages, queue_size, progress, stop):
+    """
+    Run results through stages, a list of (name, func, workers), connected
+    by queues of queue_size.
+
+    Returns
+    -------
+    dict
+        StageStats per stage name
+    """
+    start = time.perf_counter()
+    lock = threading.Lock()
+    stats = {name: StageStats(name, workers) for name, _, workers in stages}
+    remaining = {name: workers for name, _, workers in stages}
+
+    # all countries are available to the first stage from the start
+    inbox = queue.Queue()
+    for result in results:
+        inbox.put(result)
+    for _ in range(stages[0][2]):
+        inbox.put(_DONE)
+
+    threads = []
+    for index, (name, func, workers) in enumerate(stages):
+        last_stage = index == len(stages) - 1
+        outbox = queue.Queue() if last_stage else queue.Queue(queue_size)
+        n_next = 0 if last_stage else stages[index + 1][2]
+        for worker in range(workers):
+            thread = threading.Thread(
+                target=_stage_worker, name=f'pipeline-{name}-{worker}',
+                args=(func, stats[name], inbox, outbox, lock, remaining,
+                      n_next, stop), daemon=True)
+            thread.start()
+            threads.append(thread)
+        inbox = outbox
+
+    for count in range(1, len(results) + 1):
+        result = inbox.get()
+        LOGGER.info('%d/%d countries finished, %s: %s', count, len(results),
+                    result.iso3, result.status)
+        if progress is not None:
+            progress(result)
+    for thread in threads:
+        thread.join()
+
+    wall = time.perf_counter() - start
+    for stage_stats in stats.values():
+        stage_stats.wall = wall
+    return stats
+
+
+def _log_stats(stats):
+    """log the utilization per stage and the bottleneck of the pipeline"""
+    for stage in stats.values():
+        capacity = stage.workers * stage.wall or 1.
+        LOGGER.info('%s: %d workers, %d countries, %.0f%% busy, %.0f%% '
+                    'waiting for input, %.0f%% blocked by the next stage',
+                    stage.name, stage.workers, stage.items,
+                    100 * stage.utilization, 100 * stage.starved / capacity,
+                    100 * stage.blocked / capacity)
+    bottleneck = max(stats.values(), key=lambda stage: stage.utilization)
+    LOGGER.info('Bottleneck: %s stage (%.0f%% busy).', bottleneck.name,
+                100 * bottleneck.utilization)
+
+
+def run_pipeline(countries, ci_types, shapes=None, save_path=OSM_DATA_DIR,
+                 clip_dir=EXTRACT_DIR, overwrite=False, verify=True,
+                 update=False, rate_limit=None, kernel='osmosis', cache=False,
+                 max_vertices=None, postprocess=None, download_workers=2,
+                 clip_workers=1, extract_workers=1, queue_size=1,
+                 progress=None, **kernel_options):
+    """
+    Download the files of many countries from Geofabrik, clip them and
+    extract critical infrastructure, with the stages of different countries
+    running at the same time.
+
+    Each stage has its own number of worker threads. The stages are
+    connected by queues of queue_size countries: a stage waits while the
+    queue of the next one is full, which limits the number of files
+    waiting for the next stage on disk. Downloads and clipping kernels run
+    outside of the Python interpreter, while extraction is partly limited by
+    the GIL, such that extract_workers > 1 gains less.
+
+    A country which fails in one stage skips the later stages, without
+    affecting the other countries.
+
+    Parameters
+    ----------
+    countries : list of str
+        ISO3 codes of the countries, see download.get_country_geofabrik()
+    ci_types : str or list of str
+        CI types to extract, see extract.extract_cis()
+    shapes : dict, optional
+        shape to clip per ISO3 code: a bounding box [xmin, ymin, xmax, ymax],
+        a path to a .poly file or a list of (Multi-)Polygons. Countries
+        without shape are extracted from the whole country file. Default is
+        None, i.e. no clipping stage.
+    save_path : str or pathlib.Path, optional
+        directory of the country files. Default is OSM_DATA_DIR.
+    clip_dir : str or pathlib.Path, optional
+        directory of the clipped files <iso3>.osm.pbf. Existing files are
+        reused unless overwrite is True, or their country file was
+        downloaded again or is newer. Default is EXTRACT_DIR.
+    overwrite : bool, optional
+        download and clip files again if they exist. Default is False.
+    verify : bool, optional
+        verify the downloads against their md5 checksums. Default is True.
+    update : bool, optional
+        download existing files again only if they changed on the server.
+        Default is False.
+    rate_limit : float or TokenBucket, optional
+        maximal download rate in bytes per second of all downloads together.
+        Default is no limit.
+    kernel : str, optional
+        name of the clipping kernel, see clip.CLIP_KERNELS. Default is
+        'osmosis'.
+    cache : bool, optional
+        reuse identical clips from the clip cache. Default is False.
+    max_vertices : int, optional
+        vertex budget of shapes given as polygons. Default is no budget.
+    postprocess : callable, optional
+        function applied to each extracted gdf in the extract stage, e.g.
+        simplify.remove_exact_duplicates. Default is None.
+    download_workers, clip_workers, extract_workers : int, optional
+        number of concurrent downloads, clips and extractions. Defaults are
+        2, 1 and 1.
+    queue_size : int, optional
+        maximal number of countries waiting between two stages. Default
+        is 1.
+    progress : callable, optional
+        function called with the PipelineResult of each finished country,
+        e.g. to save and drop its gdfs. Default is None.
+    **kernel_options
+        further options of the clipping kernel
+
+    Returns
+    -------
+    results : dict
+        PipelineResult per ISO3 code
+    stats : dict
+        StageStats per stage, whose utilization shows the bottleneck
+
+    Raises
+    ------
+    ValueError
+        if a stage has less than one worker
+    """
+    if min(download_workers, clip_workers, extract_workers) < 1:
+        raise ValueError('Each stage needs at least one worker.')
+    if isinstance(ci_types, str):
+        ci_types = [ci_types]
+    if isinstance(rate_limit, (int, float)):
+        rate_limit = TokenBucket(rate_limit)
+    results = {iso3: PipelineResult(iso3) for iso3 in dict.fromkeys(countries)}
+    if not results:
+        return {}, {}
+
+    url_locks = {}
+    for iso3 in results:
+        try:
+            url_locks.setdefault(_create_gf_download_url(iso3, 'pbf'),
+                                 threading.Lock())
+        except (KeyError, NotImplementedError):
+            # fails in the download stage
+            continue
+    stages = [('download', functools.partial(
+        _download_stage, save_path=save_path, overwrite=overwrite,
+        verify=verify, update=update, rate_limit=rate_limit,
+        url_locks=url_locks, downloaded=set()), download_workers)]
+    if shapes:
+        pathlib.Path(clip_dir).mkdir(parents=True, exist_ok=True)
+        stages.append(('clip', functools.partial(
+            _clip_stage, shapes=shapes, clip_dir=clip_dir,
+            overwrite=overwrite, kernel=kernel, cache=cache,
+            max_vertices=max_vertices, kernel_options=kernel_options),
+            clip_workers))
+    stages.append(('extract', functools.partial(
+        _extract_stage, ci_types=ci_types, postprocess=postprocess),
+        extract_workers))
+    LOGGER.info('Running %d countries through %s.', len(results),
+                ', '.join(f'{name} ({workers} workers)'
+                          for name, _, workers in stages))
+
+    stop = threading.Event()
+    try:
+        stats = _run_stages(list(results.values()), stages, queue_size,
+                            progress, stop)
+    except BaseException:
+        # the running stages finish their current country, the others are
+        # cancelled
+        stop.set()
+        raise
+    _log_stats(stats)
+    return results, stats
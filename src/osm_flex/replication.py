@@ -0,0 +1,274 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+updating osm.pbf files with replication diffs
+
+Geofabrik and planet.openstreetmap.org publish the changes of their files as
+replication diffs (osmChange files). The diff with sequence number 1234567 is
+stored at <base_url>/001/234/567.osc.gz, next to its state file
+001/234/567.state.txt, and <base_url>/state.txt is the state of the latest
+diff. See https://wiki.openstreetmap.org/wiki/Planet.osm/diffs
+"""
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.error
+from pathlib import Path
+
+from osm_flex.download import (_StreamCheck, _download_file, _hash_file_into,
+                               _open_url, _raise_for_status, _record_download,
+                               read_manifest)
+from osm_flex.external import _run_command
+from osm_flex.pbf import read_header
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _sequence_path(sequence):
+    """path of a replication file relative to the base URL, without suffix"""
+    digits = f'{sequence:09d}'
+    return f'{digits[:3]}/{digits[3:6]}/{digits[6:]}'
+
+
+def _parse_timestamp(text):
+    """seconds since the epoch of an ISO timestamp like 2023-11-24T20:21:43Z"""
+    return int(datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ')
+               .replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _format_timestamp(timestamp):
+    """ISO timestamp of seconds since the epoch"""
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse_state(text):
+    """decode a state file, a java properties file with escaped colons"""
+    properties = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        key, _, value = line.partition('=')
+        properties[key.strip()] = value.strip().replace('\\:', ':')
+    return {'sequence_number': int(properties['sequenceNumber']),
+            'timestamp': _parse_timestamp(properties['timestamp'])}
+
+
+def read_state(base_url, sequence=None):
+    """
+    Read the state of a replication diff from the server.
+
+    Parameters
+    ----------
+    base_url : str
+        replication base URL, e.g.
+        'https://download.geofabrik.de/europe/switzerland-updates'
+    sequence : int, optional
+        sequence number of the diff. Default is None, i.e. the latest diff.
+
+    Returns
+    -------
+    dict
+        sequence_number : int
+        timestamp : int, seconds since the epoch
+    """
+    url = base_url.rstrip('/') + '/' + (
+        'state.txt' if sequence is None
+        else f'{_sequence_path(sequence)}.state.txt')
+    with _open_url(url) as response:
+        _raise_for_status(url, response)
+        return _parse_state(response.read().decode())
+
+
+def _sequence_at(base_url, timestamp, latest):
+    """
+    Sequence number of the last diff published at or before timestamp, found
+    with a binary search over the state files.
+
+    Raises
+    ------
+    ValueError
+        if the server does not have the diffs back to timestamp anymore
+    """
+    if latest['timestamp'] <= timestamp:
+        return latest['sequence_number']
+    # the first diff after timestamp is in (low, high]
+    low, high = 0, latest['sequence_number']
+    while high - low > 1:
+        mid = (low + high) // 2
+        try:
+            mid_timestamp = read_state(base_url, mid)['timestamp']
+        except urllib.error.HTTPError as err:
+            if err.code != 404:
+                raise
+            # old diffs are removed from the server
+            low = mid
+            continue
+        if mid_timestamp > timestamp:
+            high = mid
+        else:
+            low = mid
+    try:
+        read_state(base_url, high - 1)
+    except urllib.error.HTTPError as err:
+        raise ValueError(
+            f'The diffs since {_format_timestamp(timestamp)} are not '
+            f'available on {base_url} anymore. Download the file again.'
+        ) from err
+    return high - 1
+
+
+def fetch_diffs(osm_path, diff_dir, base_url=None):
+    """
+    Download the replication diffs which are missing in an osm.pbf file.
+
+    The replication state of the file is read from its header: the sequence
+    number, or else the timestamp, from which the sequence number is
+    searched on the server.
+
+    Parameters
+    ----------
+    osm_path : str or pathlib.Path
+        location of the osm.pbf file
+    diff_dir : str or pathlib.Path
+        directory in which the diffs are stored as <sequence>.osc.gz. Diffs
+        which are already there are not downloaded again.
+    base_url : str, optional
+        replication base URL, which must match the extent of the file.
+        Default is None, i.e. the URL in the header of the file.
+
+    Returns
+    -------
+    diffs : list
+        paths of the missing diffs, in order
+    state : dict
+        state of the latest diff (see read_state()) and the base_url
+
+    Raises
+    ------
+    ValueError
+        if the replication base URL or state of the file are unknown
+    """
+    header = read_header(osm_path)
+    base_url = base_url or header['replication_base_url']
+    if base_url is None:
+        raise ValueError(f'{osm_path} has no replication base URL in its '
+                         'header. Please provide base_url.')
+    base_url = base_url.rstrip('/')
+    latest = read_state(base_url)
+
+    sequence = header['replication_sequence_number']
+    if sequence is None:
+        if header['replication_timestamp'] is None:
+            raise ValueError(f'{osm_path} has no replication state in its '
+                             'header.')
+        sequence = _sequence_at(base_url, header['replication_timestamp'],
+                                latest)
+
+    diffs = []
+    Path(diff_dir).mkdir(parents=True, exist_ok=True)
+    for seq in range(sequence + 1, latest['sequence_number'] + 1):
+        diff = Path(diff_dir, f'{seq:09d}.osc.gz')
+        _download_file(f'{base_url}/{_sequence_path(seq)}.osc.gz', diff,
+                       overwrite=False, verify=False)
+        diffs.append(diff)
+    LOGGER.info(f'{len(diffs)} diffs missing in {osm_path} (sequence '
+                f'{sequence} to {latest["sequence_number"]})')
+    return diffs, {**latest, 'base_url': base_url}
+
+
+def _record_update(osm_path, output):
+    """
+    Record the updated file output in the download manifest of its
+    directory, with the origin of osm_path if osm_path was downloaded (see
+    download.read_manifest()) and the size, modification time, checksums
+    and header of output.
+    """
+    entry = read_manifest(osm_path.parent).get(osm_path.name)
+    if entry is None:
+        return
+    checks = _StreamCheck(parse_header=True)
+    _hash_file_into(output, checks)
+    stat = output.stat()
+    _record_download(output, {
+        **entry, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+        'md5': checks.md5.hexdigest(), 'sha256': checks.sha256.hexdigest(),
+        'header': checks.header,
+        'updated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+
+
+def update_pbf(osm_path, output=None, base_url=None, diff_dir=None):
+    """
+    Update an osm.pbf file with the replication diffs published since it was
+    written, instead of downloading it again.
+
+    Only the missing diffs are downloaded (see fetch_diffs()), and applied
+    with osmium apply-changes. The replication state of the result is
+    written to its header, such that it can be updated again later. If
+    osm_path was downloaded, the manifest entry of the result is updated
+    (see download.read_manifest()).
+
+    Parameters
+    ----------
+    osm_path : str or pathlib.Path
+        location of the osm.pbf file, e.g. a file from Geofabrik
+    output : str or pathlib.Path, optional
+        location of the updated file. Default is None, i.e. osm_path is
+        replaced.
+    base_url : str, optional
+        replication base URL, which must match the extent of the file.
+        Default is None, i.e. the URL in the header of the file.
+    diff_dir : str or pathlib.Path, optional
+        directory in which the diffs are kept. Default is None, i.e. a
+        temporary directory.
+
+    Returns
+    -------
+    pathlib.Path
+        location of the updated file
+
+    Note
+    ----
+    This function uses the command line tool osmium, see
+    https://osmcode.org/osmium-tool/
+    """
+    osm_path = Path(osm_path)
+    output = osm_path if output is None else Path(output)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        diffs, state = fetch_diffs(osm_path, diff_dir or tmp_dir, base_url)
+        if not diffs:
+            LOGGER.info(f'{osm_path} is up to date.')
+            if output != osm_path:
+                shutil.copyfile(osm_path, output)
+                _record_update(osm_path, output)
+            return output
+        part_file = output.with_name(output.name + '.part')
+        try:
+            _run_command(
+                ['osmium', 'apply-changes', str(osm_path), *map(str, diffs),
+                 '-o', str(part_file), '-f', 'pbf', '--overwrite',
+                 '--output-header=osmosis_replication_base_url='
+                 f'{state["base_url"]}',
+                 '--output-header=osmosis_replication_sequence_number='
+                 f'{state["sequence_number"]}',
+                 '--output-header=osmosis_replication_timestamp='
+                 f'{_format_timestamp(state["timestamp"])}'])
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+    os.replace(part_file, output)
+    _record_update(osm_path, output)
+    LOGGER.info(f'Updated {output} to sequence {state["sequence_number"]}.')
+    return output
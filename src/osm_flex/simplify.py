@@ -11,10 +11,64 @@ PARTICULAR PURPOSE.  See the GNU General Public License for more details.
 simplification functions
 """
 
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
 import geopandas as gpd
 import numpy as np
+import shapely
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _is_xy(df):
+    """
+    Whether df is a point-only frame with coordinate columns x and y, as
+    returned by extract(..., as_xy=True), instead of a GeoDataFrame
+    """
+    return (not isinstance(df, gpd.GeoDataFrame)
+            and {'x', 'y'}.issubset(df.columns))
+
+
+def _xy_to_gdf(df, crs='epsg:4326'):
+    """Create a GeoDataFrame with Point geometries from a frame with x and y"""
+    return gpd.GeoDataFrame(df.drop(columns=['x', 'y']),
+                            geometry=gpd.points_from_xy(df.x, df.y), crs=crs)
+
+# authalic (equal-area) earth radius of WGS84 in metres
+EARTH_RADIUS_AUTHALIC = 6371007.181
+
 
-def remove_small_polygons(gdf, min_area):
+def _area_m2(geometry):
+    """
+    Area in square metres of geometries given in lon/lat degrees.
+
+    On an equal-area (sinusoidal) projection, a surface element of
+    dlon * dlat degrees covers R^2 * cos(lat) * dlon * dlat (in radians).
+    Expanding cos(lat) around the centroid of each geometry, the first-order
+    term vanishes, so that the planar area in degrees scaled by the cosine of
+    the centroid latitude is accurate up to second order in the latitude
+    extent of the geometry (< 0.1 % deviation from the area on the authalic
+    sphere for shapes spanning less than 5 degrees).
+
+    Parameters
+    ----------
+    geometry : np.ndarray
+        array of shapely geometries in EPSG:4326
+
+    Returns
+    -------
+    np.ndarray
+        area of each geometry in m2
+    """
+    lat = shapely.get_y(shapely.centroid(geometry))
+    return (shapely.area(geometry) * np.cos(np.radians(lat))
+            * np.radians(EARTH_RADIUS_AUTHALIC) ** 2)
+
+
+def remove_small_polygons(gdf, min_area=None, min_area_m2=None):
     """Remove (multi-)polygons of area smaller than min_area
     Points and lines are untouched.
 
@@ -23,31 +77,46 @@ def remove_small_polygons(gdf, min_area):
     Parameters
     ----------
     gdf : GeoDataFrame
-        geodataframe with polygons
-    min_area : float
-        minimal value of area
+        geodataframe with polygons. Point frames with x and y columns are
+        returned unchanged.
+    min_area : float, optional
+        minimal value of area, in units of the gdf crs
+    min_area_m2 : float, optional
+        minimal value of area in square metres, for gdfs in EPSG:4326.
+        The area is computed on an equal-area projection, so that the
+        threshold removes the same real-world sizes at all latitudes.
+        Exactly one of min_area or min_area_m2 must be given.
 
     Return
     ------
     GeoDataFrame:
         entry geodataframe without (multi-)polygons smaller than min_area
     """
+    if (min_area is None) == (min_area_m2 is None):
+        raise ValueError("Provide exactly one of min_area or min_area_m2.")
+    if _is_xy(gdf):
+        return gdf.reset_index(drop=True)
+    if min_area_m2 is not None and gdf.crs is not None and not gdf.crs.is_geographic:
+        raise ValueError("min_area_m2 requires a gdf in geographic "
+                         "coordinates (EPSG:4326).")
 
     gdf_temp = gdf.copy()
 
-    def make_valid(geometry):
-        if geometry.is_valid:
-            return geometry
-        return geometry.buffer(1e-10)
+    geometry = np.array(gdf_temp.geometry.values)
+    invalid = ~shapely.is_valid(geometry)
+    geometry[invalid] = shapely.buffer(geometry[invalid], 1e-10)
+    gdf_temp[gdf_temp.geometry.name] = geometry
 
-    gdf_temp['geometry'] = gdf_temp.apply(lambda row: make_valid(row.geometry),
-                                          axis=1)
+    if min_area is not None:
+        area = shapely.area(geometry)
+    else:
+        area = _area_m2(geometry)
+        min_area = min_area_m2
 
-    return gdf_temp[(gdf_temp['geometry'].area > min_area) |
-                    (gdf_temp['geometry'].area == 0)].reset_index(drop=True)
+    return gdf_temp[(area > min_area) | (area == 0)].reset_index(drop=True)
 
 
-def remove_contained_points(gdf_p_mp):
+def remove_contained_points(gdf_p_mp, gdf_polys=None):
     """
     from a GeoDataFrame containing points and (multi-)polygons, remove those
     points that are contained in a multipolygons entry.
@@ -55,16 +124,34 @@ def remove_contained_points(gdf_p_mp):
 
     Parameters
     ----------
-    gdf_p_mp : gpd.GeoDataFrame
-        GeoDataFrame containing entries with point and (multi-)polygon geometry
+    gdf_p_mp : gpd.GeoDataFrame or pd.DataFrame
+        GeoDataFrame containing entries with point and (multi-)polygon
+        geometry, or a point frame with coordinate columns x and y, as
+        returned by extract(..., as_xy=True)
+    gdf_polys : gpd.GeoDataFrame, optional
+        GeoDataFrame with the (multi-)polygons to check against. If given,
+        only the points of gdf_p_mp are checked against these polygons,
+        e.g. to combine a point frame with x and y columns with a separate
+        polygon extract. Default is None, the polygons of gdf_p_mp are used.
     """
 
     gdf_p_mp = gdf_p_mp.reset_index(drop=True)
+    if gdf_polys is None:
+        if _is_xy(gdf_p_mp):
+            return gdf_p_mp
+        gdf_polys = gdf_p_mp
+
+    polys = gdf_polys[(gdf_polys.geometry.type=='MultiPolygon')|
+                      (gdf_polys.geometry.type=='Polygon')]
+
+    if _is_xy(gdf_p_mp):
+        points = shapely.points(gdf_p_mp.x.to_numpy(), gdf_p_mp.y.to_numpy())
+        ind_dupl = np.unique(shapely.STRtree(polys.geometry.values).query(
+            points, predicate='within')[0])
+        return gdf_p_mp.drop(index=ind_dupl).reset_index(drop=True)
 
     ind_dupl = np.unique(gpd.sjoin(gdf_p_mp[gdf_p_mp.geometry.type=='Point'],
-              gdf_p_mp[(gdf_p_mp.geometry.type=='MultiPolygon')|
-                       (gdf_p_mp.geometry.type=='Polygon')],
-              predicate='within').index)
+              polys, predicate='within').index)
 
     return gdf_p_mp.drop(index=ind_dupl).reset_index(drop=True)
 
@@ -82,10 +169,13 @@ def remove_contained_polys(gdf):
     Parameters
     ----------
     gdf : gpd.GeoDataFrame
-        GeoDataFrame containing entries with (multi-)polygon geometry
+        GeoDataFrame containing entries with (multi-)polygon geometry.
+        Point frames with x and y columns are returned unchanged.
     """
 
     gdf = gdf.reset_index(drop=True)
+    if _is_xy(gdf):
+        return gdf
 
     contained = gpd.sjoin(
         gdf[(gdf.geometry.type=='MultiPolygon')| (gdf.geometry.type=='Polygon')],
@@ -109,11 +199,293 @@ def remove_exact_duplicates(gdf):
     Parameters
     ----------
     gdf : gpd.GeoDataFrame
-        GeoDataFrame containing any types of geometry
+        GeoDataFrame containing any types of geometry, or a point frame with
+        coordinate columns x and y
     """
 
     gdf = gdf.reset_index(drop=True)
+    if _is_xy(gdf):
+        return gdf.drop_duplicates(subset=['x', 'y']).reset_index(drop=True)
 
     geom_wkb = gdf["geometry"].apply(lambda geom: geom.wkb)
 
     return gdf.loc[geom_wkb.drop_duplicates().index].reset_index(drop=True)
+
+
+def _geometry_size(geometry):
+    """Number of coordinates and WKB size in bytes of an array of geometries"""
+    return (int(shapely.get_num_coordinates(geometry).sum()),
+            int(sum(len(wkb) for wkb in shapely.to_wkb(geometry)
+                    if wkb is not None)))
+
+
+def reduce_precision(gdf, grid_size=1e-7, tolerance_m=None):
+    """
+    Snap all coordinates to a regular grid and optionally remove redundant
+    vertices, to reduce the memory and output size of large extracts.
+    Entries whose geometry collapses (e.g. polygons smaller than the grid
+    size) are removed.
+
+    Resets the index of the dataframe.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        GeoDataFrame containing any types of geometry, or a point frame with
+        coordinate columns x and y (in which only the grid snapping applies)
+    grid_size : float, optional
+        grid size to snap coordinates to, in units of the gdf crs.
+        Default is 1e-7, the coordinate precision of OSM data in EPSG:4326
+        (ca. 1 cm). Set to None to keep the coordinates as they are.
+    tolerance_m : float, optional
+        tolerance in metres for the topology-preserving removal of vertices
+        (Douglas-Peucker). For gdfs in geographic coordinates, the tolerance
+        is converted to degrees of latitude, which never exceeds the given
+        distance in metres. Requires a gdf with crs. Default is None, no
+        vertices are removed.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        geodataframe with reduced geometries. The reduction in number of
+        coordinates and WKB size is logged at INFO level.
+
+    Raises
+    ------
+    ValueError
+        if tolerance_m is given for a gdf without crs
+    """
+    gdf = gdf.reset_index(drop=True)
+    if _is_xy(gdf):
+        if grid_size is not None:
+            gdf[['x', 'y']] = np.round(gdf[['x', 'y']] / grid_size) * grid_size
+        return gdf
+
+    geometry = np.array(gdf.geometry.values)
+    log_size = LOGGER.isEnabledFor(logging.INFO)
+    if log_size:
+        size_before = _geometry_size(geometry)
+
+    if tolerance_m is not None:
+        if gdf.crs is None:
+            raise ValueError("tolerance_m requires a gdf with crs, to convert "
+                             "the tolerance to its units.")
+        tolerance = tolerance_m
+        if gdf.crs.is_geographic:
+            tolerance = tolerance_m / np.radians(EARTH_RADIUS_AUTHALIC)
+        geometry = shapely.simplify(geometry, tolerance,
+                                    preserve_topology=True)
+    if grid_size is not None:
+        geometry = shapely.set_precision(geometry, grid_size)
+
+    gdf[gdf.geometry.name] = geometry
+    gdf = gdf[~shapely.is_empty(geometry)].reset_index(drop=True)
+
+    if log_size:
+        size_after = _geometry_size(gdf.geometry.values)
+        LOGGER.info(
+            'reduced coordinates from %d to %d (%.1f MB to %.1f MB in memory), '
+            'WKB size from %.1f MB to %.1f MB',
+            size_before[0], size_after[0], size_before[0] * 16 / 1e6,
+            size_after[0] * 16 / 1e6, size_before[1] / 1e6,
+            size_after[1] / 1e6)
+    return gdf
+
+
+# =============================================================================
+#  PARALLEL SIMPLIFICATION
+# =============================================================================
+
+def _partition_geometries(geometry, n_partitions, method='hilbert'):
+    """
+    Split geometries into partitions of (nearly) equal size which are compact
+    in space, by sorting them along a space-filling curve.
+
+    Parameters
+    ----------
+    geometry : np.ndarray
+        array of shapely geometries
+    n_partitions : int
+        number of partitions
+    method : str
+        'hilbert' to order geometries along a Hilbert curve or 'grid' to order
+        them by the cell of a regular grid they fall into. Default is
+        'hilbert'.
+
+    Returns
+    -------
+    list of np.ndarray
+        positional indices of the geometries in each partition
+    """
+    if method == 'hilbert':
+        key = gpd.GeoSeries(geometry).hilbert_distance().to_numpy()
+    elif method == 'grid':
+        bounds = shapely.bounds(geometry)
+        x_mid = (bounds[:, 0] + bounds[:, 2]) / 2
+        y_mid = (bounds[:, 1] + bounds[:, 3]) / 2
+        n_cells = int(np.ceil(np.sqrt(n_partitions)))
+        x_edges = np.linspace(np.nanmin(x_mid), np.nanmax(x_mid), n_cells+1)
+        y_edges = np.linspace(np.nanmin(y_mid), np.nanmax(y_mid), n_cells+1)
+        col = np.clip(np.searchsorted(x_edges, x_mid, side='right') - 1,
+                      0, n_cells-1)
+        row = np.clip(np.searchsorted(y_edges, y_mid, side='right') - 1,
+                      0, n_cells-1)
+        key = row * n_cells + col
+    else:
+        raise ValueError(f"Partitioning method '{method}' is not valid. "
+                         "Choose one of [hilbert, grid].")
+    order = np.argsort(key, kind='stable')
+    return [part for part in np.array_split(order, n_partitions) if part.size]
+
+
+def _to_shared_wkb(geometry):
+    """
+    Serialize geometries to WKB and place them in shared memory, as one
+    contiguous byte buffer and an array of offsets into that buffer.
+
+    Returns
+    -------
+    shm_wkb, shm_offsets : SharedMemory
+        shared memory blocks holding the WKB bytes and the int64 offsets
+    """
+    wkb = shapely.to_wkb(geometry)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    np.cumsum([len(geom) for geom in wkb], out=offsets[1:])
+
+    shm_wkb = SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+    shm_wkb.buf[:offsets[-1]] = b''.join(wkb)
+    shm_offsets = SharedMemory(create=True, size=offsets.nbytes)
+    np.ndarray(offsets.shape, dtype=np.int64, buffer=shm_offsets.buf)[:] = offsets
+    return shm_wkb, shm_offsets
+
+
+def _simplify_partition(func, kwargs, crs, wkb_name, offsets_name, n_geoms,
+                        members, owned):
+    """
+    Worker function: rebuild the geometries of one partition (incl. its halo)
+    from shared memory, apply the simplification function and return the
+    positions and WKB of those surviving entries the partition owns.
+    """
+    shm_wkb = SharedMemory(name=wkb_name)
+    shm_offsets = SharedMemory(name=offsets_name)
+    try:
+        offsets = np.ndarray((n_geoms + 1,), dtype=np.int64,
+                             buffer=shm_offsets.buf)[members]
+        ends = np.ndarray((n_geoms + 1,), dtype=np.int64,
+                          buffer=shm_offsets.buf)[members + 1]
+        wkb = [bytes(shm_wkb.buf[start:end])
+               for start, end in zip(offsets, ends)]
+    finally:
+        shm_wkb.close()
+        shm_offsets.close()
+
+    gdf = gpd.GeoDataFrame({'_pos': members}, geometry=shapely.from_wkb(wkb),
+                           crs=crs)
+    result = func(gdf, **kwargs)
+    pos = result['_pos'].to_numpy()
+    is_owned = np.isin(pos, owned)
+    return pos[is_owned], shapely.to_wkb(result.geometry.values[is_owned])
+
+
+def _simplify_partitioned(gdf, func, kwargs, executor, n_partitions, method,
+                          halo):
+    """Apply one simplification function to all partitions of gdf."""
+    geometry = gdf.geometry.values
+    partitions = _partition_geometries(geometry, n_partitions, method)
+
+    # halo: all geometries whose bounds overlap the extent of a partition
+    bounds = np.array([shapely.total_bounds(geometry[part])
+                       for part in partitions])
+    extents = shapely.box(*(bounds + [-halo, -halo, halo, halo]).T)
+    ind_part, ind_geom = shapely.STRtree(geometry).query(extents)
+
+    shm_wkb, shm_offsets = _to_shared_wkb(geometry)
+    try:
+        futures = [
+            executor.submit(
+                _simplify_partition, func, kwargs, gdf.crs, shm_wkb.name,
+                shm_offsets.name, len(geometry),
+                np.union1d(part, ind_geom[ind_part == i]), part)
+            for i, part in enumerate(partitions)]
+        results = [future.result() for future in futures]
+    finally:
+        for shm in (shm_wkb, shm_offsets):
+            shm.close()
+            shm.unlink()
+
+    pos = np.concatenate([res[0] for res in results])
+    wkb = np.concatenate([res[1] for res in results])
+    order = np.argsort(pos)
+    gdf_out = gdf.iloc[pos[order]].copy()
+    gdf_out[gdf.geometry.name] = gpd.GeoSeries.from_wkb(
+        wkb[order], index=gdf_out.index, crs=gdf.crs)
+    return gdf_out.reset_index(drop=True)
+
+
+def simplify_parallel(gdf, funcs, max_workers=None, n_partitions=None,
+                      method='hilbert', halo=0.):
+    """
+    Apply simplification functions of this module in parallel on spatial
+    partitions of a (large) GeoDataFrame.
+
+    The geometries are split along a space-filling curve into compact
+    partitions. Each partition is processed in a separate process together
+    with a halo of all geometries whose bounds overlap the partition extent,
+    so that containment and duplicate checks across partition borders give
+    the same result as the serial functions. Geometries are handed to the
+    workers as WKB buffers in shared memory.
+    Resets the index of the dataframe.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        GeoDataFrame containing any types of geometry. Point frames with
+        x and y columns are converted to a GeoDataFrame with Points.
+    funcs : callable or list
+        simplification function, or list of functions, which are applied
+        one after the other. Functions which take further arguments can be
+        given as tuples (function, kwargs), e.g.
+        (remove_small_polygons, {'min_area': 1e-8}). The functions must be
+        importable module-level functions that only depend on the geometry
+        column, such as the functions of this module.
+    max_workers : int, optional
+        number of worker processes. Default is the number of CPUs.
+    n_partitions : int, optional
+        number of spatial partitions. Default is four per worker.
+    method : str, optional
+        space-filling curve used for partitioning, 'hilbert' or 'grid'.
+        Default is 'hilbert'.
+    halo : float, optional
+        additional distance (in units of the gdf crs) by which the partition
+        extents are enlarged when collecting neighbouring geometries.
+        Default is 0.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        simplified geodataframe, with rows in their original order
+    """
+    if callable(funcs) or isinstance(funcs, tuple):
+        funcs = [funcs]
+    funcs = [func if isinstance(func, tuple) else (func, {})
+             for func in funcs]
+    max_workers = max_workers or os.cpu_count()
+    n_partitions = n_partitions or 4 * max_workers
+
+    gdf = gdf.reset_index(drop=True)
+    if _is_xy(gdf):
+        gdf = _xy_to_gdf(gdf)
+    if max_workers == 1 or n_partitions == 1:
+        for func, kwargs in funcs:
+            gdf = func(gdf, **kwargs)
+        return gdf
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for func, kwargs in funcs:
+            if gdf.empty:
+                break
+            LOGGER.info('run %s on %d partitions', func.__name__,
+                        n_partitions)
+            gdf = _simplify_partitioned(gdf, func, kwargs, executor,
+                                        n_partitions, method, halo)
+    return gdf
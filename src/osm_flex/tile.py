@@ -0,0 +1,162 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+tiling of osm.pbf files by data density
+"""
+
+import json
+import logging
+import pathlib
+
+from osm_flex.clip import clip_many, _check_parent_file
+from osm_flex.pbf import read_header, sample_nodes
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _quadtree(coords, bbox, max_nodes, scale, max_depth, key=''):
+    """
+    Split bbox recursively into quadrants until the estimated number of nodes
+    per tile is at most max_nodes.
+
+    Quadrants are numbered 0 (south-west), 1 (south-east), 2 (north-west)
+    and 3 (north-east) and appended to the key of the parent tile. All
+    quadrants are kept, also those without any sampled node, such that the
+    tiles cover the whole bbox.
+
+    Returns
+    -------
+    list
+        (key, bbox, estimated number of nodes) per tile
+    """
+    n_nodes = len(coords) * scale
+    if n_nodes <= max_nodes or len(key) >= max_depth:
+        return [(key, bbox, n_nodes)]
+    xmid = (bbox[0] + bbox[2]) / 2
+    ymid = (bbox[1] + bbox[3]) / 2
+    east = coords[:, 0] >= xmid
+    north = coords[:, 1] >= ymid
+    quadrants = [
+        (~east & ~north, [bbox[0], bbox[1], xmid, ymid]),
+        (east & ~north, [xmid, bbox[1], bbox[2], ymid]),
+        (~east & north, [bbox[0], ymid, xmid, bbox[3]]),
+        (east & north, [xmid, ymid, bbox[2], bbox[3]])]
+    tiles = []
+    for i, (mask, quad_bbox) in enumerate(quadrants):
+        tiles += _quadtree(coords[mask], quad_bbox, max_nodes, scale,
+                           max_depth, key + str(i))
+    return tiles
+
+
+def plan_tiles(osmpbf, max_nodes=5e6, sample_every=10, max_depth=12):
+    """
+    Plan a quadtree tiling of an osm.pbf file with roughly max_nodes nodes
+    per tile, from a sample of the node coordinates.
+
+    Parameters
+    ----------
+    osmpbf : str or pathlib.Path
+        file path of the osm.pbf file to tile
+    max_nodes : float, optional
+        node budget per tile. Default is 5e6.
+    sample_every : int, optional
+        only every sample_every-th data block is decoded to estimate the node
+        density. Default is 10.
+    max_depth : int, optional
+        maximal depth of the quadtree. Default is 12.
+
+    Returns
+    -------
+    list
+        per tile, a dict with name, bbox [xmin, ymin, xmax, ymax] and the
+        estimated number of nodes. The tiles cover the whole extent of the
+        file, also where the sample has no nodes.
+
+    Raises
+    ------
+    ValueError
+        if sample_every is smaller than 1
+    """
+    if sample_every < 1:
+        raise ValueError('sample_every must be at least 1, not '
+                         f'{sample_every}.')
+    coords, scale = sample_nodes(osmpbf, sample_every)
+    bbox = read_header(osmpbf)['bbox']
+    if bbox is None:
+        bbox = ([-180., -90., 180., 90.] if not len(coords) else
+                [*coords.min(axis=0).tolist(), *coords.max(axis=0).tolist()])
+    LOGGER.info('Sampled %d nodes, ca. %d nodes in total.', len(coords),
+                len(coords) * scale)
+    return [{'name': f'tile_{key}' if key else 'tile',
+             'bbox': tile_bbox,
+             'estimated_nodes': int(round(n_nodes))}
+            for key, tile_bbox, n_nodes in _quadtree(
+                coords, bbox, max_nodes, scale, max_depth)]
+
+
+def tile_pbf(osmpbf, out_dir, max_nodes=5e6, sample_every=10, max_depth=12,
+             max_tiles_per_pass=100, overwrite=False, kernel='osmosis',
+             **kernel_options):
+    """
+    Split an osm.pbf file into tiles of roughly equal data volume.
+
+    The node density is estimated from a sample of the data blocks, and the
+    extent of the file is split along a quadtree until each tile has at most
+    max_nodes nodes. The tiles are clipped with clip_many(), i.e. many tiles
+    per pass over the file. A manifest tiles.json with the tile bounds is
+    written to out_dir.
+
+    Parameters
+    ----------
+    osmpbf : str or pathlib.Path
+        file path of the osm.pbf file to tile
+    out_dir : str or pathlib.Path
+        directory in which the tiles are stored as <name>.osm.pbf
+    max_nodes : float, optional
+        node budget per tile. Default is 5e6.
+    sample_every : int, optional
+        only every sample_every-th data block is decoded to estimate the node
+        density. Default is 10.
+    max_depth : int, optional
+        maximal depth of the quadtree. Default is 12.
+    max_tiles_per_pass : int, optional
+        maximal number of tiles written in one pass over the file, which
+        bounds the memory use of the kernel. Default is 100.
+    overwrite : bool
+        default is False. Whether to overwrite tiles if they already exist.
+    kernel : str
+        name of the clipping kernel, see clip.CLIP_KERNELS.
+        Default is 'osmosis'.
+    **kernel_options
+        further options of the kernel
+
+    Returns
+    -------
+    list
+        the tiles of the manifest: dicts with name, bbox, estimated_nodes
+        and file
+    """
+    osmpbf = _check_parent_file(osmpbf)
+    out_dir = pathlib.Path(out_dir)
+    tiles = plan_tiles(osmpbf, max_nodes, sample_every, max_depth)
+    LOGGER.info('Writing %d tiles of %s', len(tiles), osmpbf)
+
+    for start in range(0, len(tiles), max_tiles_per_pass):
+        outputs = clip_many(
+            {tile['name']: tile['bbox']
+             for tile in tiles[start:start + max_tiles_per_pass]},
+            osmpbf, out_dir, overwrite, kernel, **kernel_options)
+        for tile in tiles[start:start + max_tiles_per_pass]:
+            tile['file'] = outputs[tile['name']].name
+
+    with open(out_dir / 'tiles.json', 'w') as file:
+        json.dump({'parent': str(osmpbf), 'max_nodes': max_nodes,
+                   'tiles': tiles}, file, indent=1)
+    return tiles
@@ -0,0 +1,45 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+helpers shared by the tests
+"""
+
+import struct
+import sys
+
+
+def pb_field(field, value):
+    """encode a varint or bytes protocol buffer field"""
+    def varint(val):
+        out = b''
+        while val > 0x7f:
+            out += bytes([val & 0x7f | 0x80])
+            val >>= 7
+        return out + bytes([val])
+    if isinstance(value, int):
+        return varint(field << 3) + varint(value)
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+
+def header_pbf(header_block):
+    """the header blob of an osm.pbf file with an uncompressed HeaderBlock"""
+    blob = pb_field(1, header_block) + pb_field(2, len(header_block))
+    blob_header = pb_field(1, b'OSMHeader') + pb_field(3, len(blob))
+    return struct.pack('>I', len(blob_header)) + blob_header + blob
+
+
+def build_fail_multi_cmd(shapes, osmpbf_clip_from, osmpbf_outputs,
+                         tmp_dir=None):
+    """command of a dummy kernel writing partial outputs and failing"""
+    return [sys.executable, '-c',
+            'import sys\n'
+            'for output in sys.argv[1:]: open(output, "w").write("partial")\n'
+            'sys.exit(1)',
+            *map(str, osmpbf_outputs)]
@@ -0,0 +1,146 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test boundary functions
+"""
+
+import os
+import unittest
+import tempfile
+from pathlib import Path
+from unittest import mock
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from osm_flex import boundaries
+from osm_flex.boundaries import (_read_index, _Layer, load_boundaries,
+                                 assign_regions, country_shapes)
+from osm_flex.clip import get_country_shape
+
+
+class TestBoundaries(unittest.TestCase):
+
+    def _write_shapefile(self, path):
+        gpd.GeoDataFrame(
+            {'adm0_a3': ['CHE', 'CHE', 'AUT'],
+             'name_en': ['Zurich', 'Bern', 'Tyrol']},
+            geometry=[shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1),
+                      shapely.box(2, 0, 3, 1)],
+            crs='epsg:4326').to_file(path)
+
+    def test__read_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shp_file = Path(tmpdir, 'admin1.shp')
+            index_file = Path(tmpdir, 'index', 'admin1.pkl')
+            self._write_shapefile(shp_file)
+
+            index = _read_index(shp_file, 'adm0_a3', 'name_en', index_file)
+            self.assertTrue(index_file.is_file())
+            self.assertEqual(index['iso3'].tolist(), ['CHE', 'CHE', 'AUT'])
+
+            # reuse the stored index
+            mtime = index_file.stat().st_mtime_ns
+            _read_index(shp_file, 'adm0_a3', 'name_en', index_file)
+            self.assertEqual(index_file.stat().st_mtime_ns, mtime)
+
+            # rebuild if the shapefile changes
+            os.utime(shp_file, ns=(0, 0))
+            _read_index(shp_file, 'adm0_a3', 'name_en', index_file)
+            self.assertNotEqual(index_file.stat().st_mtime_ns, mtime)
+
+            layer = _Layer(index)
+            self.assertEqual(layer.name[layer.by_iso3['CHE']].tolist(),
+                             ['Zurich', 'Bern'])
+            self.assertEqual(layer.by_name['tyrol'].tolist(), [2])
+            self.assertTrue(layer.geometry[layer.by_name['bern'][0]].equals(
+                shapely.box(1, 0, 2, 1)))
+
+    def test_country_shapes(self):
+        layer = _Layer({
+            'iso3': np.array(['CHE', 'AUT'], dtype=object),
+            'name': np.array(['Switzerland', 'Austria'], dtype=object),
+            'wkb': np.array(shapely.to_wkb([shapely.box(0, 0, 1, 1),
+                                            shapely.box(1, 0, 2, 1)]),
+                            dtype=object)})
+        with mock.patch.object(boundaries, 'load_boundaries',
+                               return_value=layer):
+            shapes = country_shapes(['AUT', 'switzerland'])
+            self.assertTrue(shapes['AUT'].equals(shapely.box(1, 0, 2, 1)))
+            self.assertTrue(shapes['switzerland'].equals(
+                shapely.box(0, 0, 1, 1)))
+            with self.assertRaises(LookupError):
+                country_shapes('Switzerland', by_name=False)
+
+            # get_country_shape() only looks up ISO3 codes
+            self.assertTrue(get_country_shape('CHE').equals(
+                shapely.box(0, 0, 1, 1)))
+            with self.assertRaises(LookupError):
+                get_country_shape('Switzerland')
+
+    def test_load_boundaries_invalid(self):
+        with self.assertRaises(ValueError):
+            load_boundaries('admin2')
+
+    def test_assign_regions(self):
+        regions = {'west': shapely.box(0, 0, 1, 1),
+                   'east': shapely.box(1, 0, 2, 1)}
+        gdf = gpd.GeoDataFrame(
+            {'osm_id': [1, 2, 3, 4]},
+            geometry=[shapely.Point(0.5, 0.5), shapely.Point(5, 5),
+                      shapely.LineString([(1.2, 0.5), (1.8, 0.5)]),
+                      shapely.LineString([(0.2, 0.2), (1.4, 0.2)])],
+            crs='epsg:4326')
+
+        result = assign_regions(gdf, regions)
+        self.assertEqual(result.region.dropna().tolist(),
+                         ['west', 'east', 'west'])
+        self.assertTrue(result.region.isna().iloc[1])
+        self.assertNotIn('region', gdf.columns)
+
+        result = assign_regions(gdf, regions, split=True, column='adm1')
+        self.assertEqual(len(result), 5)
+        parts = result[result.osm_id == 4]
+        self.assertEqual(sorted(parts.adm1), ['east', 'west'])
+        self.assertAlmostEqual(parts.length.sum(), 1.2)
+        self.assertTrue(parts[parts.adm1 == 'west'].geometry.iloc[0].equals(
+            shapely.LineString([(0.2, 0.2), (1, 0.2)])))
+
+        # the part outside of all regions is kept without region
+        leaving = gdf.iloc[[0]].set_geometry(
+            [shapely.LineString([(0.5, 0.5), (1.5, 0.5), (1.5, 1.5)])],
+            crs='epsg:4326')
+        result = assign_regions(leaving, regions, split=True)
+        self.assertEqual(len(result), 3)
+        self.assertAlmostEqual(result.length.sum(), 2)
+        self.assertEqual(result.region.tolist()[:2], ['west', 'east'])
+        self.assertTrue(result.region.isna().iloc[2])
+        self.assertTrue(result.geometry.iloc[2].equals(
+            shapely.LineString([(1.5, 1), (1.5, 1.5)])))
+
+        # also a feature leaving its only region is split
+        leaving = leaving.set_geometry(
+            [shapely.LineString([(0.5, 0.5), (0.5, 1.5)])], crs='epsg:4326')
+        result = assign_regions(leaving, regions, split=True)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result.region.iloc[0], 'west')
+        self.assertTrue(result.region.isna().iloc[1])
+        self.assertTrue(result.geometry.iloc[0].equals(
+            shapely.LineString([(0.5, 0.5), (0.5, 1)])))
+
+        result = assign_regions(gdf, regions, as_dict=True)
+        self.assertEqual(set(result), {'west', 'east'})
+        self.assertEqual(result['west'].osm_id.tolist(), [1, 4])
+        self.assertEqual(result['east'].osm_id.tolist(), [3])
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestBoundaries)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)
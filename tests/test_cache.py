@@ -0,0 +1,149 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test clip cache functions
+"""
+
+import unittest
+import os
+import sys
+import tempfile
+import time
+import shapely
+from pathlib import Path
+from osm_flex.cache import (clip_cache_key, fetch_from_cache, add_to_cache,
+                            evict_cache)
+from osm_flex.clip import (clip_from_bbox, clip_many, register_kernel,
+                           CLIP_KERNELS)
+from osm_flex.config import CLIP_CACHE_DIR
+from helpers import build_fail_multi_cmd
+
+PATH_TEST_DATA = Path(__file__).parent / 'data'
+OSM_FILE = PATH_TEST_DATA / 'test.osm.pbf'
+
+
+def _build_count_cmd(shape, osmpbf_clip_from, osmpbf_output, counter):
+    """command of a dummy kernel counting its runs in the file counter"""
+    return [sys.executable, '-c',
+            'import sys; open(sys.argv[1], "a").write("x"); '
+            'open(sys.argv[2], "w").write("clipped")',
+            str(counter), str(osmpbf_output)]
+
+
+class TestCache(unittest.TestCase):
+
+    def test_clip_cache_key(self):
+        key = clip_cache_key([0, 0, 1, 1], OSM_FILE, 'osmium',
+                             {'strategy': 'smart'})
+        self.assertEqual(len(key), 64)
+        self.assertEqual(key, clip_cache_key([0., 0., 1., 1.], OSM_FILE,
+                                             'osmium', {'strategy': 'smart'}))
+        self.assertEqual(
+            clip_cache_key([0, 0, 1, 1], OSM_FILE, 'osmium'),
+            clip_cache_key([0, 0, 1, 1], OSM_FILE, 'osmium', {}))
+        self.assertNotEqual(key, clip_cache_key([0, 0, 1, 2], OSM_FILE,
+                                                'osmium', {'strategy': 'smart'}))
+        self.assertNotEqual(key, clip_cache_key([0, 0, 1, 1], OSM_FILE,
+                                                'osmosis', {'strategy': 'smart'}))
+        self.assertNotEqual(key, clip_cache_key([0, 0, 1, 1], OSM_FILE, 'osmium'))
+        self.assertNotEqual(key, clip_cache_key([0, 0, 1, 1], OSM_FILE, 'osmium',
+                                                {'strategy': 'smart'},
+                                                hash_parent=True))
+
+        # polygons are hashed independent of their vertex order
+        square = shapely.Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+        square_rev = shapely.Polygon([(0, 1), (1, 1), (1, 0), (0, 0)])
+        self.assertEqual(clip_cache_key([square], OSM_FILE, 'osmium'),
+                         clip_cache_key([square_rev], OSM_FILE, 'osmium'))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            parent = Path(tmpdir, 'parent.osm.pbf')
+            parent.write_bytes(b'abc')
+            key = clip_cache_key([0, 0, 1, 1], parent, 'osmium')
+            parent.write_bytes(b'abcd')
+            self.assertNotEqual(key, clip_cache_key([0, 0, 1, 1], parent,
+                                                    'osmium'))
+
+    def test_fetch_add_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = Path(tmpdir, 'cache')
+            output = Path(tmpdir, 'out.osm.pbf')
+            self.assertFalse(fetch_from_cache('a', output, cache_dir))
+
+            for key, size in [('a', 10), ('b', 20), ('c', 30)]:
+                Path(tmpdir, f'{key}.osm.pbf').write_bytes(b'x' * size)
+                add_to_cache(key, Path(tmpdir, f'{key}.osm.pbf'), cache_dir,
+                             quota=100)
+            mtime = (cache_dir / 'a.osm.pbf').stat().st_mtime_ns
+            time.sleep(0.01)
+            self.assertTrue(fetch_from_cache('a', output, cache_dir))
+            self.assertEqual(output.read_bytes(), b'x' * 10)
+            # a hit does not change the (hard linked) files, whose mtime
+            # identifies them as parents of other clips
+            self.assertEqual(output.stat().st_mtime_ns, mtime)
+            self.assertEqual(Path(tmpdir, 'a.osm.pbf').stat().st_mtime_ns,
+                             mtime)
+
+            # least recently used 'b' is evicted first
+            os.utime(cache_dir / '.b.osm.pbf.used', (0, 0))
+            os.utime(cache_dir / 'a.osm.pbf', (0, 0))
+            Path(tmpdir, 'd.osm.pbf').write_bytes(b'x' * 50)
+            add_to_cache('d', Path(tmpdir, 'd.osm.pbf'), cache_dir, quota=100)
+            self.assertEqual(sorted(path.name for path in cache_dir.glob('*')
+                                    if not path.name.startswith('.')),
+                             ['a.osm.pbf', 'c.osm.pbf', 'd.osm.pbf'])
+            self.assertFalse((cache_dir / '.b.osm.pbf.used').exists())
+
+            evict_cache(cache_dir, quota=0)
+            self.assertEqual(list(cache_dir.iterdir()), [])
+            # files fetched before remain
+            self.assertEqual(output.read_bytes(), b'x' * 10)
+
+    def test_clip_with_cache(self):
+        register_kernel('count', _build_count_cmd)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                counter = Path(tmpdir, 'counter')
+                bbox = [0, 0, 1, 1]
+                key = clip_cache_key(bbox, OSM_FILE, 'count',
+                                     {'counter': counter})
+                for i in range(3):
+                    output = Path(tmpdir, f'out_{i}.osm.pbf')
+                    clip_from_bbox(bbox, OSM_FILE, output, kernel='count',
+                                   cache=True, counter=counter)
+                    self.assertEqual(output.read_text(), 'clipped')
+                self.assertEqual(counter.read_text(), 'x')
+
+                clip_from_bbox(bbox, OSM_FILE, output, overwrite=True,
+                               kernel='count', counter=counter)
+                self.assertEqual(counter.read_text(), 'xx')
+                self.assertTrue(Path(CLIP_CACHE_DIR, f'{key}.osm.pbf').is_file())
+        finally:
+            del CLIP_KERNELS['count']
+            Path(CLIP_CACHE_DIR, f'{key}.osm.pbf').unlink(missing_ok=True)
+
+    def test_clip_many_failure_not_cached(self):
+        register_kernel('fail', _build_count_cmd, build_fail_multi_cmd)
+        bbox = [0, 0, 1, 1]
+        key = clip_cache_key(bbox, OSM_FILE, 'fail')
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with self.assertRaises(RuntimeError):
+                    clip_many({'a': bbox}, OSM_FILE, tmpdir, kernel='fail',
+                              cache=True)
+            self.assertFalse(Path(CLIP_CACHE_DIR, f'{key}.osm.pbf').exists())
+        finally:
+            del CLIP_KERNELS['fail']
+            Path(CLIP_CACHE_DIR, f'{key}.osm.pbf').unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestCache)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)
@@ -14,12 +14,78 @@ test clip functions
 import unittest
 import tempfile
 import os
+import sys
+import json
 import shapely
 from pathlib import Path
 from osm_flex.clip import (get_admin1_shapes, get_country_shape, 
-                           _simplify_shapelist, _shapely2poly, _build_osmosis_cmd,
-                           _build_osmconvert_cmd)
+                           _simplify_shapelist, _shapely2poly, write_poly,
+                           _build_osmosis_cmd,
+                           _build_osmconvert_cmd, _build_osmosis_multi_cmd,
+                           _build_osmium_cmd, _build_osmium_multi_cmd,
+                           clip_many, clip_from_bbox, register_kernel,
+                           CLIP_KERNELS, find_smallest_parent, clip_planned,
+                           run_clip_jobs,
+                           _plan_stages)
 from osm_flex.config import OSMCONVERT_PATH
+from helpers import build_fail_multi_cmd, header_pbf, pb_field
+
+PATH_TEST_DATA = Path(__file__).parent / 'data'
+OSM_FILE = PATH_TEST_DATA / 'test.osm.pbf'
+
+
+def _build_copy_cmd(shape, osmpbf_clip_from, osmpbf_output, suffix=''):
+    """command of a dummy kernel writing the shape and env to the output"""
+    return [sys.executable, '-c',
+            'import os, sys; open(sys.argv[2], "w").write('
+            'sys.argv[1] + os.environ.get("DUMMY_ENV", ""))',
+            str(shape) + suffix, str(osmpbf_output)]
+
+
+def _build_parent_cmd(shape, osmpbf_clip_from, osmpbf_output):
+    """command of a dummy kernel writing the parent file name to the output"""
+    return [sys.executable, '-c',
+            'import sys; open(sys.argv[2], "w").write(sys.argv[1])',
+            Path(osmpbf_clip_from).name, str(osmpbf_output)]
+
+
+def _build_mode_cmd(shape, osmpbf_clip_from, osmpbf_output):
+    """
+    command of a dummy kernel which succeeds, fails or hangs, depending on
+    the first coordinate of the bbox (0, 1 or 2)
+    """
+    return [sys.executable, '-c',
+            'import sys, time\n'
+            'mode, output = sys.argv[1:]\n'
+            'open(output, "w").write(mode)\n'
+            'print("progress", mode, file=sys.stderr)\n'
+            'if mode == "1": sys.exit(3)\n'
+            'if mode == "2": time.sleep(60)\n',
+            str(shape[0]), str(osmpbf_output)]
+
+
+def _build_long_line_cmd(shape, osmpbf_clip_from, osmpbf_output):
+    """command of a dummy kernel writing a long line to stderr"""
+    return [sys.executable, '-c',
+            'import sys; print("x" * 200000, file=sys.stderr); '
+            'open(sys.argv[1], "w").write("ok")', str(osmpbf_output)]
+
+
+def _build_missing_cmd(shape, osmpbf_clip_from, osmpbf_output):
+    """command of a kernel whose executable does not exist"""
+    return ['/nonexistent/kernel', str(osmpbf_output)]
+
+
+def _write_header_pbf(path, bbox=None, size=0):
+    """write an osm.pbf file with only a header block, padded to size"""
+    header_block = pb_field(4, b'OsmSchema-V0.6')
+    if bbox is not None:
+        nano = [int(round(val * 1e9)) for val in bbox]
+        header_block += pb_field(1, b''.join(
+            pb_field(field, (val << 1) ^ (val >> 63))
+            for field, val in zip([1, 4, 2, 3], nano)))
+    data = header_pbf(header_block)
+    Path(path).write_bytes(data + b'\x00' * max(size - len(data), 0))
 
 
 class TestClip(unittest.TestCase):
@@ -62,6 +128,16 @@ class TestClip(unittest.TestCase):
         result = _simplify_shapelist(geom_list)
         self.assertFalse(result) #check if result is empty list
 
+        # Test explicit threshold
+        result = _simplify_shapelist(geom_list, thres=1e-5)
+        self.assertEqual(len(result), 1)
+
+        # Test vertex budget
+        circle = shapely.Point(0, 0).buffer(10, quad_segs=256)
+        result = _simplify_shapelist([circle], max_vertices=50)
+        self.assertLessEqual(shapely.get_num_coordinates(result[0]), 50)
+        self.assertAlmostEqual(result[0].area / circle.area, 1, places=1)
+
         # Test for invalid input type
         with self.assertRaises(TypeError):
             _simplify_shapelist("invalid_input")
@@ -81,12 +157,53 @@ class TestClip(unittest.TestCase):
                 self.assertIn("1.0     1.0", content)
                 self.assertIn("0.0     1.0", content)
                 self.assertIn("END", content)
+            with self.assertRaises(ValueError):
+                _shapely2poly(geom_list, filename)
+
+        # Test holes
+        polygon = shapely.box(0, 0, 4, 4).difference(shapely.box(1, 1, 2, 2))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = Path(tmpdir, "test_poly.poly")
+            _shapely2poly([polygon, shapely.box(5, 5, 6, 6)], filename)
+            lines = filename.read_text().splitlines()
+            self.assertEqual(lines[0], "Polygons")
+            self.assertEqual([line for line in lines if line.strip()
+                              and not line.startswith(" ")],
+                             ["Polygons", "0", "END", "!1", "END",
+                              "2", "END", "END"])
+            self.assertEqual(len(lines), 2 + 3 * 2 + 3 * 5)
+            self.assertEqual(os.listdir(tmpdir), ["test_poly.poly"])
+
         # Test for invalid input type
         with tempfile.TemporaryDirectory() as tmpdir:
             filename = os.path.join(tmpdir, "test_poly")
             with self.assertRaises(AttributeError):
                 _shapely2poly("invalid_input", filename)
 
+    def test_write_poly(self):
+        shapes = [shapely.box(0, 0, 1, 1)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            poly_file = write_poly(shapes, tmpdir)
+            self.assertEqual(write_poly(shapes, tmpdir), poly_file)
+            self.assertNotEqual(write_poly([shapely.box(0, 0, 2, 1)], tmpdir),
+                                poly_file)
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+            self.assertIn("1.0     1.0", poly_file.read_text())
+
+        # the content-addressed files are bounded by the quota, least
+        # recently used first, other files are kept
+        with tempfile.TemporaryDirectory() as tmpdir:
+            Path(tmpdir, 'mine.poly').write_text('x' * 1000)
+            size = write_poly(shapes, tmpdir).stat().st_size
+            os.utime(Path(tmpdir, poly_file.name), (0, 0))
+            write_poly([shapely.box(0, 0, 2, 1)], tmpdir, quota=2 * size)
+            write_poly([shapely.box(0, 0, 3, 1)], tmpdir, quota=2 * size)
+            self.assertNotIn(poly_file.name, os.listdir(tmpdir))
+            self.assertEqual(len(os.listdir(tmpdir)), 3)
+            self.assertIn('mine.poly', os.listdir(tmpdir))
+            # a single file above the quota is kept while in use
+            self.assertTrue(write_poly(shapes, tmpdir, quota=0).is_file())
+
     def test__build_osmosis_cmd(self):
         # Test for bbox input
         shape = [0, 0, 1, 1]
@@ -144,6 +261,265 @@ class TestClip(unittest.TestCase):
         self.assertEqual(result, expected_result)
         
 
+    def test__build_osmosis_multi_cmd(self):
+        shapes = [[0, 0, 1, 1], "/path/to/shape.poly"]
+        outputs = ["/path/to/a.osm.pbf", "/path/to/b.osm.pbf"]
+        result = _build_osmosis_multi_cmd(shapes, "/path/to/planet.osm.pbf",
+                                          outputs)
+        expected_result = [
+            'osmosis',
+            '--read-pbf',
+            'file=/path/to/planet.osm.pbf',
+            '--tee',
+            'outputCount=2',
+            '--bounding-box',
+            'top=1',
+            'left=0',
+            'bottom=0',
+            'right=1',
+            '--write-pbf',
+            'file=/path/to/a.osm.pbf',
+            '--bounding-polygon',
+            'file=/path/to/shape.poly',
+            '--write-pbf',
+            'file=/path/to/b.osm.pbf']
+        self.assertEqual(result, expected_result)
+
+    def test_clip_many(self):
+        shapes_by_name = {'a': [0, 0, 1, 1], 'b': [1, 1, 2, 2]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # existing files are not clipped again
+            for name in shapes_by_name:
+                Path(tmpdir, f'{name}.osm.pbf').touch()
+            result = clip_many(shapes_by_name, OSM_FILE, tmpdir)
+            self.assertEqual(result, {'a': Path(tmpdir, 'a.osm.pbf'),
+                                      'b': Path(tmpdir, 'b.osm.pbf')})
+
+            with self.assertRaises(ValueError):
+                clip_many(shapes_by_name, OSM_FILE, tmpdir, kernel='abc')
+            with self.assertRaises(ValueError):
+                clip_many(shapes_by_name, Path(tmpdir, 'missing.osm.pbf'),
+                          tmpdir)
+
+    def test__build_osmium_cmd(self):
+        result = _build_osmium_cmd([0, 0, 1, 1], "/path/to/planet.osm.pbf",
+                                   "/path/to/extract.osm.pbf")
+        expected_result = ['osmium', 'extract', '-b', '0,0,1,1',
+                           '-s', 'complete_ways',
+                           '-o', '/path/to/extract.osm.pbf', '--overwrite',
+                           '/path/to/planet.osm.pbf']
+        self.assertEqual(result, expected_result)
+
+        result = _build_osmium_cmd(Path("/path/to/shape.poly"),
+                                   "/path/to/planet.osm.pbf",
+                                   "/path/to/extract.osm.pbf", strategy='smart')
+        expected_result = ['osmium', 'extract', '-p', '/path/to/shape.poly',
+                           '-s', 'smart',
+                           '-o', '/path/to/extract.osm.pbf', '--overwrite',
+                           '/path/to/planet.osm.pbf']
+        self.assertEqual(result, expected_result)
+
+    def test__build_osmium_multi_cmd(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result = _build_osmium_multi_cmd(
+                [[0, 0, 1, 1], "/path/to/shape.poly"], "/path/to/planet.osm.pbf",
+                ["/path/to/a.osm.pbf", "/path/to/b.osm.pbf"], tmpdir)
+            config_file = Path(tmpdir, 'osmium_extract.json')
+            self.assertEqual(result, ['osmium', 'extract', '-c', str(config_file),
+                                      '-s', 'complete_ways', '--overwrite',
+                                      '/path/to/planet.osm.pbf'])
+            config = json.loads(config_file.read_text())
+        self.assertEqual(config, {'extracts': [
+            {'output': '/path/to/a.osm.pbf', 'bbox': [0., 0., 1., 1.]},
+            {'output': '/path/to/b.osm.pbf',
+             'polygon': {'file_name': '/path/to/shape.poly',
+                         'file_type': 'poly'}}]})
+
+    def test_register_kernel(self):
+        register_kernel('dummy', _build_copy_cmd,
+                        env=lambda value='': {'DUMMY_ENV': value})
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                output = Path(tmpdir, 'out.osm.pbf')
+                clip_from_bbox([0, 0, 1, 1], OSM_FILE, output, kernel='dummy',
+                               suffix='_s', value='_v')
+                self.assertEqual(output.read_text(), '[0, 0, 1, 1]_s_v')
+
+                with self.assertRaisesRegex(ValueError, 'already exists'):
+                    clip_from_bbox([0, 0, 1, 1], OSM_FILE, output,
+                                   kernel='dummy')
+
+                # without multi_cmd, clip_many falls back to a loop
+                result = clip_many({'a': [0, 0, 1, 1], 'b': [1, 1, 2, 2]},
+                                   OSM_FILE, tmpdir, kernel='dummy')
+                self.assertEqual(result['b'].read_text(), '[1, 1, 2, 2]')
+        finally:
+            del CLIP_KERNELS['dummy']
+
+        with self.assertRaisesRegex(ValueError, "Kernel 'dummy' is not valid"):
+            clip_from_bbox([0, 0, 1, 1], OSM_FILE, 'out.osm.pbf', kernel='dummy')
+
+    def test_kernel_failure(self):
+        register_kernel('mode', _build_mode_cmd)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with self.assertRaisesRegex(RuntimeError, 'exit code 3'):
+                    clip_from_bbox([1, 0, 2, 1], OSM_FILE,
+                                   Path(tmpdir, 'out.osm.pbf'), kernel='mode')
+        finally:
+            del CLIP_KERNELS['mode']
+
+    def test_run_clip_jobs(self):
+        register_kernel('mode', _build_mode_cmd)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                Path(tmpdir, 'exists.osm.pbf').write_text('old')
+                jobs = {name: ([mode, 0, mode + 1, 1], OSM_FILE,
+                               Path(tmpdir, f'{name}.osm.pbf'))
+                        for name, mode in [('ok', 0), ('ok2', 0),
+                                           ('fail', 1), ('hang', 2),
+                                           ('exists', 0)]}
+                finished = []
+                with self.assertLogs('osm_flex.clip', level='INFO') as logs:
+                    results = run_clip_jobs(
+                        jobs, kernel='mode', max_jobs=2, timeout=5,
+                        progress=lambda result: finished.append(result.name))
+                self.assertEqual(list(results), list(jobs))
+                self.assertEqual(sorted(finished), sorted(jobs))
+                self.assertEqual(
+                    {name: result.status for name, result in results.items()},
+                    {'ok': 'done', 'ok2': 'done', 'fail': 'failed',
+                     'hang': 'timeout', 'exists': 'skipped'})
+                self.assertEqual(results['ok'].returncode, 0)
+                self.assertEqual(results['fail'].returncode, 3)
+                self.assertEqual(results['fail'].stderr, 'progress 1')
+                self.assertGreaterEqual(results['hang'].duration, 5)
+                self.assertTrue(any('fail: progress 1' in line
+                                    for line in logs.output))
+                self.assertEqual(results['ok'].output.read_text(), '0')
+                self.assertFalse(results['fail'].output.exists())
+                self.assertFalse(results['hang'].output.exists())
+                self.assertEqual(results['exists'].output.read_text(), 'old')
+        finally:
+            del CLIP_KERNELS['mode']
+
+    def test_run_clip_jobs_errors(self):
+        register_kernel('long', _build_long_line_cmd)
+        register_kernel('missing', _build_missing_cmd)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                results = run_clip_jobs(
+                    {'long': ([0, 0, 1, 1], OSM_FILE,
+                              Path(tmpdir, 'long.osm.pbf'))},
+                    kernel='long')
+                self.assertEqual(results['long'].status, 'done')
+                # the line is passed on in pieces
+                self.assertEqual(results['long'].stderr.replace('\n', ''),
+                                 'x' * 200000)
+
+                # a job which cannot be run does not abort the others
+                results = run_clip_jobs(
+                    {name: ([0, 0, 1, 1], OSM_FILE,
+                            Path(tmpdir, f'{name}.osm.pbf'))
+                     for name in ['a', 'b']}, kernel='missing')
+                self.assertEqual([result.status for result in results.values()],
+                                 ['failed', 'failed'])
+                self.assertIn('FileNotFoundError', results['a'].stderr)
+
+                # a missing parent file only fails its own job
+                results = run_clip_jobs(
+                    {'a': ([0, 0, 1, 1], OSM_FILE,
+                           Path(tmpdir, 'a.osm.pbf')),
+                     'b': ([0, 0, 1, 1], Path(tmpdir, 'missing.osm.pbf'),
+                           Path(tmpdir, 'b.osm.pbf')),
+                     'c': ([shapely.box(0, 0, 1, 1)], OSM_FILE,
+                           Path(tmpdir, 'c.osm.pbf'))}, kernel='long')
+                self.assertEqual(
+                    {name: result.status for name, result in results.items()},
+                    {'a': 'done', 'b': 'failed', 'c': 'done'})
+                self.assertIn('not found', results['b'].stderr)
+        finally:
+            del CLIP_KERNELS['long']
+            del CLIP_KERNELS['missing']
+
+    def test_clip_failure_removes_outputs(self):
+        register_kernel('mode', _build_mode_cmd, build_fail_multi_cmd)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                output = Path(tmpdir, 'fail.osm.pbf')
+                with self.assertRaises(RuntimeError):
+                    clip_from_bbox([1, 0, 2, 1], OSM_FILE, output,
+                                   kernel='mode')
+                self.assertFalse(output.exists())
+
+                with self.assertRaises(RuntimeError):
+                    clip_many({'a': [0, 0, 1, 1], 'b': [0, 0, 2, 1]},
+                              OSM_FILE, tmpdir, kernel='mode')
+                self.assertFalse(Path(tmpdir, 'a.osm.pbf').exists())
+                self.assertFalse(Path(tmpdir, 'b.osm.pbf').exists())
+        finally:
+            del CLIP_KERNELS['mode']
+
+    def _write_parents(self, tmpdir):
+        _write_header_pbf(Path(tmpdir, 'planet-latest.osm.pbf'), size=3000)
+        _write_header_pbf(Path(tmpdir, 'europe-latest.osm.pbf'),
+                          [-25, 34, 45, 72], size=2000)
+        _write_header_pbf(Path(tmpdir, 'switzerland-latest.osm.pbf'),
+                          [5.9, 45.8, 10.5, 47.8], size=1000)
+        _write_header_pbf(Path(tmpdir, 'no-bbox.osm.pbf'), size=10)
+
+    def test_find_smallest_parent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self._write_parents(tmpdir)
+            self.assertEqual(find_smallest_parent([8, 47, 9, 47.5], tmpdir),
+                             Path(tmpdir, 'switzerland-latest.osm.pbf'))
+            square = shapely.box(2, 48, 3, 49)
+            self.assertEqual(find_smallest_parent([square], tmpdir),
+                             Path(tmpdir, 'europe-latest.osm.pbf'))
+            self.assertEqual(find_smallest_parent([20, -10, 21, -9], tmpdir),
+                             Path(tmpdir, 'planet-latest.osm.pbf'))
+            Path(tmpdir, 'planet-latest.osm.pbf').unlink()
+            with self.assertRaises(LookupError):
+                find_smallest_parent([20, -10, 21, -9], tmpdir)
+
+    def test__plan_stages(self):
+        bounds = {f'r{i}': [20 + i, -10, 21 + i, -9] for i in range(6)}
+        bounds['far'] = [-100, 40, -99, 41]
+        stage = _plan_stages(list(bounds), bounds, [-180, -90, 180, 90], 5)
+        self.assertEqual(stage['names'], ['far'])
+        self.assertEqual(len(stage['stages']), 1)
+        self.assertEqual(stage['stages'][0]['bbox'], [20, -10, 26, -9])
+        self.assertEqual(sorted(stage['stages'][0]['names']),
+                         [f'r{i}' for i in range(6)])
+
+        # too few regions for a stage
+        stage = _plan_stages(list(bounds), bounds, [-180, -90, 180, 90], 10)
+        self.assertEqual(len(stage['names']), 7)
+        self.assertEqual(stage['stages'], [])
+
+    def test_clip_planned(self):
+        register_kernel('parent', _build_parent_cmd)
+        shapes_by_name = {f'r{i}': [20 + i, -10, 21 + i, -9] for i in range(6)}
+        shapes_by_name['zurich'] = [8, 47, 9, 47.5]
+        shapes_by_name['paris'] = [shapely.box(2, 48, 3, 49)]
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                self._write_parents(tmpdir)
+                out_dir = Path(tmpdir, 'out')
+                result = clip_planned(shapes_by_name, out_dir, tmpdir,
+                                      kernel='parent')
+                self.assertEqual(set(result), set(shapes_by_name))
+                self.assertEqual(result['zurich'].read_text(),
+                                 'switzerland-latest.osm.pbf')
+                self.assertEqual(result['paris'].read_text(),
+                                 'europe-latest.osm.pbf')
+                self.assertEqual(result['r0'].read_text(),
+                                 '_stage_planet-latest_0.osm.pbf')
+                # intermediate files are removed
+                self.assertEqual(len(list(out_dir.iterdir())), 8)
+        finally:
+            del CLIP_KERNELS['parent']
+
 
 if __name__ == "__main__":
     TESTS = unittest.TestLoader().loadTestsFromTestCase(TestClip)
@@ -14,14 +14,134 @@ test download functions
 import unittest
 import tempfile
 import os
-import shapely
+import hashlib
+import threading
+import time
+import urllib.error
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from unittest import mock
+from urllib.parse import urlsplit
+from osm_flex import cache, clip, download
 from osm_flex.download import (
     _create_gf_download_url,
+    _download_file,
+    _download_parallel,
     get_country_geofabrik,
+    get_countries_geofabrik,
     get_region_geofabrik,
     get_planet_file,
 )
+from helpers import header_pbf, pb_field
+
+
+# header with bbox [5.9, 45.8, 10.5, 47.8] (left, right, top, bottom)
+_PBF_HEADER = header_pbf(
+    pb_field(1, b''.join(
+        pb_field(field, (val << 1) ^ (val >> 63)) for field, val in zip(
+            [1, 2, 3, 4], [5_900_000_000, 10_500_000_000, 47_800_000_000,
+                           45_800_000_000])))
+    + pb_field(4, b'OsmSchema-V0.6'))
+
+
+_LAST_MODIFIED = 'Mon, 19 Oct 2026 00:00:00 GMT'
+
+
+def _pbf(size):
+    """content of an osm.pbf file of size bytes: a header and random data"""
+    return _PBF_HEADER + os.urandom(size - len(_PBF_HEADER))
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler serving the in-memory files of the server, with support
+    for Range and conditional requests (If-None-Match, If-Range). Responses
+    of the paths in server.truncate are cut off after the given number of
+    bytes, once. server.delay delays all
+    responses by the given number of seconds.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        self.server.requests.append((self.command, self.path,
+                                     dict(self.headers)))
+        time.sleep(self.server.delay)
+        # absolute URLs of requests to a proxy
+        content = self.server.files.get(urlsplit(self.path).path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start, end = 0, len(content)
+        range_header = self.headers.get('Range')
+        if self.headers.get('If-Range', etag) not in (etag, _LAST_MODIFIED):
+            range_header = None
+        if range_header:
+            first, last = range_header.split('=')[1].split('-')
+            start = int(first)
+            end = min(int(last) + 1, len(content)) if last else len(content)
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end - 1}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', _LAST_MODIFIED)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if body:
+            cut = self.server.truncate.pop(self.path, None)
+            self.wfile.write(content[start:end if cut is None
+                                     else start + cut])
+            if cut is not None:
+                self.close_connection = True
+
+
+@contextmanager
+def _serve(files):
+    """run a local HTTP server for files, a dict of path: bytes"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FileHandler)
+    server.files = files
+    server.truncate = {}
+    server.requests = []
+    server.connections = 0
+    server.delay = 0
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _with_md5(path, content):
+    """server files for content and its .md5 file"""
+    md5 = hashlib.md5(content).hexdigest()
+    return {path: content,
+            path + '.md5': f'{md5}  {path.split("/")[-1]}\n'.encode()}
 
 
 class TestDownload(unittest.TestCase):
@@ -71,6 +191,486 @@ class TestDownload(unittest.TestCase):
             self.assertEqual(return_value, Path(filename))
             self.assertTrue(os.path.exists(filename))
 
+    def test__download_file(self):
+        content = _pbf(3 * 2**20 + 17)
+        with _serve(_with_md5('/file.osm.pbf', content)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            url = server.url + '/file.osm.pbf'
+            filepath = Path(tmpdir, 'file.osm.pbf')
+            part_file = Path(tmpdir, 'file.osm.pbf.part')
+
+            # interrupted download leaves only the part file
+            server.truncate['/file.osm.pbf'] = 2**20
+            with self.assertRaises(urllib.error.ContentTooShortError):
+                _download_file(url, filepath)
+            self.assertFalse(filepath.exists())
+            self.assertEqual(part_file.stat().st_size, 2**20)
+
+            # the next call resumes, if the file is still the same
+            _download_file(url, filepath, overwrite=False)
+            self.assertEqual(filepath.read_bytes(), content)
+            self.assertFalse(part_file.exists())
+            self.assertFalse(Path(tmpdir, 'file.osm.pbf.part.source').exists())
+            self.assertEqual(server.requests[-1][2]['Range'],
+                             f'bytes={2**20}-')
+            self.assertEqual(server.requests[-1][2]['If-Range'],
+                             f'"{hashlib.md5(content).hexdigest()}"')
+
+            # a file changed on the server since is downloaded from the start
+            filepath.unlink()
+            server.truncate['/file.osm.pbf'] = 2**20
+            with self.assertRaises(urllib.error.ContentTooShortError):
+                _download_file(url, filepath, verify=False)
+            changed = _pbf(len(content))
+            server.files['/file.osm.pbf'] = changed
+            _download_file(url, filepath, verify=False)
+            self.assertEqual(filepath.read_bytes(), changed)
+            server.files['/file.osm.pbf'] = content
+
+            # existing files are skipped
+            n_requests = len(server.requests)
+            _download_file(url, filepath, overwrite=False)
+            self.assertEqual(len(server.requests), n_requests)
+
+            # a stale part file is replaced
+            part_file.write_bytes(b'x' * 100)
+            _download_file(url, filepath, overwrite=True)
+            self.assertEqual(filepath.read_bytes(), content)
+
+            # checksum mismatch
+            server.files['/file.osm.pbf.md5'] = b'0' * 32
+            filepath.unlink()
+            with self.assertRaisesRegex(ValueError, 'Checksum mismatch'):
+                _download_file(url, filepath)
+            self.assertFalse(filepath.exists())
+            self.assertFalse(part_file.exists())
+
+            # no checksum available
+            del server.files['/file.osm.pbf.md5']
+            with self.assertLogs('osm_flex.download', 'WARNING'):
+                _download_file(url, filepath)
+            self.assertEqual(filepath.read_bytes(), content)
+
+            with self.assertRaises(urllib.error.HTTPError):
+                _download_file(server.url + '/missing.osm.pbf',
+                               Path(tmpdir, 'missing.osm.pbf'))
+
+    def test__download_file_parallel(self):
+        content = _pbf(2**20 + 5)
+        with _serve(_with_md5('/file.osm.pbf', content)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            url = server.url + '/file.osm.pbf'
+            filepath = Path(tmpdir, 'file.osm.pbf')
+
+            # one range fails and is retried on its own
+            server.truncate['/file.osm.pbf'] = 1000
+            with self.assertLogs('osm_flex.download', 'INFO') as logs:
+                _download_file(url, filepath, connections=4)
+            self.assertEqual(filepath.read_bytes(), content)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['file.osm.pbf', download.MANIFEST_NAME])
+            ranges = [headers['Range'] for method, _, headers
+                      in server.requests if 'Range' in headers]
+            self.assertEqual(len(ranges), 5)
+            self.assertIn('bytes=262146-524291', ranges)
+            self.assertTrue(any('MB/s' in line for line in logs.output))
+
+            # interrupted download only fetches the missing ranges
+            part_file = Path(tmpdir, 'resume.part')
+            server.truncate['/file.osm.pbf'] = 1000
+            with self.assertRaises(urllib.error.ContentTooShortError):
+                _download_parallel(url, part_file, len(content), 2,
+                                   hashlib.md5(), retries=0)
+            self.assertTrue(Path(tmpdir, 'resume.part.ranges').is_file())
+            n_requests = len(server.requests)
+            hasher = hashlib.md5()
+            resumed = _download_parallel(url, part_file, len(content), 2,
+                                         hasher, retries=0)
+            # either range may have failed
+            self.assertIn(resumed, [len(content) // 2, len(content) // 2 + 1])
+            self.assertEqual(len(server.requests), n_requests + 1)
+            self.assertEqual(part_file.read_bytes(), content)
+            self.assertEqual(hasher.hexdigest(),
+                             hashlib.md5(content).hexdigest())
+            self.assertFalse(Path(tmpdir, 'resume.part.ranges').exists())
+
+            # a single connection continues after the completed ranges at
+            # the start of the preallocated part file
+            etag = f'"{hashlib.md5(content).hexdigest()}"'
+            part_file.unlink()
+            server.truncate['/file.osm.pbf'] = 1000
+            with self.assertRaises(urllib.error.ContentTooShortError):
+                _download_parallel(url, part_file, len(content), 2,
+                                   hashlib.md5(), retries=0, etag=etag)
+            done = download._read_ranges(
+                Path(tmpdir, 'resume.part.ranges'))['done']
+            n_requests = len(server.requests)
+            hasher = hashlib.md5()
+            offset, _ = download._download_to_part(
+                url, part_file, hasher, download._Transfer(
+                    download.DownloadMetrics(url, part_file)))
+            self.assertEqual(offset, len(content) // 2 + 1 if done == [0]
+                             else 0)
+            self.assertEqual(part_file.read_bytes(), content)
+            self.assertEqual(hasher.hexdigest(),
+                             hashlib.md5(content).hexdigest())
+            self.assertFalse(Path(tmpdir, 'resume.part.ranges').exists())
+            self.assertEqual(server.requests[n_requests][2].get('If-Range'),
+                             etag if offset else None)
+
+            # ranges of a file which changed on the server are refused
+            part_file.unlink()
+            with self.assertRaisesRegex(ValueError, 'changed'):
+                _download_parallel(url, part_file, len(content), 2,
+                                   hashlib.md5(), retries=0, etag='"old"')
+
+    def test__download_file_update(self):
+        content = _pbf(1000)
+        with _serve(_with_md5('/file.osm.pbf', content)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            url = server.url + '/file.osm.pbf'
+            filepath = Path(tmpdir, 'file.osm.pbf')
+            _download_file(url, filepath)
+            entry = download.read_manifest(tmpdir)['file.osm.pbf']
+            self.assertEqual(entry['url'], url)
+            self.assertEqual(entry['etag'],
+                             f'"{hashlib.md5(content).hexdigest()}"')
+            self.assertEqual(entry['last_modified'],
+                             'Mon, 19 Oct 2026 00:00:00 GMT')
+            self.assertEqual(entry['size'], len(content))
+            self.assertEqual(entry['md5'], hashlib.md5(content).hexdigest())
+
+            # unchanged files take a single conditional request
+            n_requests = len(server.requests)
+            with self.assertLogs('osm_flex.download', 'INFO') as logs:
+                _download_file(url, filepath, overwrite=False, update=True)
+            self.assertEqual(len(server.requests), n_requests + 1)
+            method, _, headers = server.requests[-1]
+            self.assertEqual(method, 'HEAD')
+            self.assertEqual(headers['If-None-Match'], entry['etag'])
+            self.assertIn('Skip unchanged file', logs.output[-1])
+
+            # changed files are downloaded again
+            content = _pbf(500)
+            server.files.update(_with_md5('/file.osm.pbf', content))
+            _download_file(url, filepath, overwrite=False, update=True)
+            self.assertEqual(filepath.read_bytes(), content)
+            self.assertEqual(
+                download.read_manifest(tmpdir)['file.osm.pbf']['size'], 500)
+
+            # files without manifest entry are downloaded again
+            Path(tmpdir, download.MANIFEST_NAME).unlink()
+            n_requests = len(server.requests)
+            _download_file(url, filepath, overwrite=False, update=True)
+            self.assertEqual(server.requests[n_requests][0], 'GET')
+            self.assertIn('file.osm.pbf', download.read_manifest(tmpdir))
+
+    def test__download_file_checks(self):
+        content = _pbf(2**20 + 5)
+        with _serve(_with_md5('/file.osm.pbf', content)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            url = server.url + '/file.osm.pbf'
+            filepath = Path(tmpdir, 'file.osm.pbf')
+            for connections in [1, 3]:
+                _download_file(url, filepath, connections=connections)
+                entry = download.read_manifest_entry(filepath)
+                self.assertEqual(entry['sha256'],
+                                 hashlib.sha256(content).hexdigest())
+                self.assertEqual(entry['header']['bbox'],
+                                 [5.9, 45.8, 10.5, 47.8])
+
+            # the checksums and header are used instead of reading the file
+            with mock.patch.object(clip, 'read_header') as read_header:
+                self.assertEqual(clip._parent_extents(tmpdir)[0][1],
+                                 [5.9, 45.8, 10.5, 47.8])
+            read_header.assert_not_called()
+            self.assertEqual(cache._file_identity(filepath, True),
+                             entry['sha256'])
+
+            # modified files have no valid entry
+            filepath.write_bytes(content[:-1])
+            self.assertIsNone(download.read_manifest_entry(filepath))
+
+            # an error page instead of the file
+            server.files['/page.osm.pbf'] = b'<!DOCTYPE html><html>' * 100
+            with self.assertRaisesRegex(ValueError, 'not an osm.pbf file'):
+                _download_file(server.url + '/page.osm.pbf',
+                               Path(tmpdir, 'page.osm.pbf'), verify=False)
+            self.assertFalse(Path(tmpdir, 'page.osm.pbf.part').exists())
+
+    def test_token_bucket(self):
+        bucket = download.TokenBucket(1e6, capacity=1e5)
+        start = time.perf_counter()
+        bucket.consume(1e5)
+        self.assertLess(time.perf_counter() - start, 0.05)
+        bucket.consume(2e5)
+        self.assertGreater(time.perf_counter() - start, 0.15)
+        with self.assertRaises(ValueError):
+            download.TokenBucket(0)
+
+    def test__download_file_metrics(self):
+        content = _pbf(3 * 2**20)
+        with _serve(_with_md5('/file.osm.pbf', content)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(download, 'PROGRESS_INTERVAL', 0):
+            url = server.url + '/file.osm.pbf'
+            filepath = Path(tmpdir, 'file.osm.pbf')
+            reports = []
+            metrics = _download_file(
+                url, filepath, progress=reports.append,
+                rate_limit=download.TokenBucket(4 * 2**20, capacity=2**20))
+            self.assertEqual(filepath.read_bytes(), content)
+            self.assertEqual(metrics.status, 'done')
+            self.assertEqual(metrics.received, len(content))
+            self.assertEqual(metrics.size, len(content))
+            self.assertEqual(metrics.retries, 0)
+            self.assertGreater(metrics.time_to_first_byte, 0)
+            # 2 MB above the burst capacity at 4 MB/s
+            self.assertGreater(metrics.duration, 0.4)
+            self.assertEqual(metrics.as_dict()['path'], str(filepath))
+            self.assertAlmostEqual(metrics.as_dict()['rate'],
+                                   len(content) / metrics.duration)
+            # running reports per block, then the final metrics
+            self.assertEqual([report.status for report in reports],
+                             ['running'] * 3 + ['done'])
+            self.assertEqual([report.received for report in reports],
+                             [2**20, 2 * 2**20, 3 * 2**20, 3 * 2**20])
+
+            reports.clear()
+            metrics = _download_file(url, filepath, overwrite=False,
+                                     progress=reports.append)
+            self.assertEqual(reports, [metrics])
+            self.assertEqual(metrics.status, 'skipped')
+
+            server.truncate['/file.osm.pbf'] = 1000
+            with self.assertRaises(urllib.error.ContentTooShortError):
+                _download_file(url, filepath, progress=reports.append)
+            self.assertEqual(reports[-1].status, 'failed')
+            self.assertEqual(reports[-1].received, 1000)
+
+            # retried ranges of parallel downloads
+            server.truncate['/file.osm.pbf'] = 1000
+            metrics = _download_file(url, filepath, connections=2)
+            self.assertEqual(metrics.retries, 1)
+            # only the missing rest of the range is requested again
+            self.assertEqual(metrics.received, len(content))
+
+    def test_rank_mirrors(self):
+        files = _with_md5('/pbf/file.osm.pbf', _pbf(2**16))
+        with _serve(files) as fast, _serve(files) as slow, \
+                _serve({}) as broken, \
+                mock.patch.dict(download.MIRRORS, {}), \
+                mock.patch.dict(download._MIRROR_PROBES, {}):
+            slow.delay = 0.2
+            for server in [broken, slow, fast]:
+                download.register_mirror('test', server.url)
+            self.assertEqual(download.MIRRORS['test'][0], broken.url + '/')
+            url = slow.url + '/pbf/file.osm.pbf'
+            self.assertEqual(download.rank_mirrors(url, sample_bytes=1000),
+                             [fast.url + '/pbf/file.osm.pbf', url,
+                              broken.url + '/pbf/file.osm.pbf'])
+            probe = download._MIRROR_PROBES[slow.url + '/']
+            self.assertGreater(probe.latency, 0.2)
+            self.assertGreater(probe.throughput, 0)
+            self.assertIn('404',
+                          download._MIRROR_PROBES[broken.url + '/'].error)
+            self.assertEqual(fast.requests[-1][2]['Range'], 'bytes=0-999')
+
+            # probes are reused
+            n_requests = len(fast.requests)
+            download.rank_mirrors(url)
+            self.assertEqual(len(fast.requests), n_requests)
+            download.rank_mirrors(url, max_age=0)
+            self.assertEqual(len(fast.requests), n_requests + 1)
+
+            # files outside of all groups
+            self.assertEqual(download.rank_mirrors('http://other/a.pbf'),
+                             ['http://other/a.pbf'])
+
+        # ranked by latency plus transfer time of the sample
+        probes = {'http://near/': download.MirrorProbe(
+                      'http://near/f', latency=0.01, throughput=1e6),
+                  'http://far/': download.MirrorProbe(
+                      'http://far/f', latency=0.5, throughput=1e8),
+                  'http://down/': download.MirrorProbe(
+                      'http://down/f', error='URLError()')}
+        with mock.patch.dict(download.MIRRORS, {'test': list(probes)}), \
+                mock.patch.dict(download._MIRROR_PROBES, probes):
+            self.assertEqual(
+                download.rank_mirrors('http://far/f', sample_bytes=1e5),
+                ['http://near/f', 'http://far/f', 'http://down/f'])
+            self.assertEqual(
+                download.rank_mirrors('http://far/f', sample_bytes=1e6),
+                ['http://far/f', 'http://near/f', 'http://down/f'])
+        self.assertAlmostEqual(probes['http://near/'].duration(1e5), 0.11)
+
+    def test__download_file_failover(self):
+        content = _pbf(3 * 2**20)
+        files = _with_md5('/pbf/file.osm.pbf', content)
+        with _serve(files) as first, _serve(dict(files)) as second, \
+                _serve({**files, '/pbf/file.osm.pbf.md5': b'0' * 32}) \
+                as outdated, tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.dict(download.MIRRORS, {}), \
+                mock.patch.dict(download._MIRROR_PROBES, {}):
+            for server in [first, outdated, second]:
+                download.register_mirror('test', server.url)
+            url = first.url + '/pbf/file.osm.pbf'
+            filepath = Path(tmpdir, 'file.osm.pbf')
+            # rank in the order of registration
+            with mock.patch.object(download, 'rank_mirrors', lambda url: [
+                    server.url + '/pbf/file.osm.pbf'
+                    for server in [first, outdated, second]]):
+                first.truncate['/pbf/file.osm.pbf'] = 2**20
+                with self.assertLogs('osm_flex.download', 'WARNING') as logs:
+                    metrics = _download_file(url, filepath)
+            self.assertEqual(filepath.read_bytes(), content)
+            self.assertTrue(any('another version' in line
+                                for line in logs.output))
+            # continued at the same offset on the next mirror
+            self.assertEqual(second.requests[-1][2]['Range'],
+                             f'bytes={2**20}-')
+            self.assertEqual(metrics.mirror,
+                             second.url + '/pbf/file.osm.pbf')
+            self.assertEqual(metrics.retries, 1)
+            entry = download.read_manifest(tmpdir)['file.osm.pbf']
+            self.assertEqual(entry['url'], url)
+            self.assertEqual(entry['mirror'], metrics.mirror)
+
+            # updates are checked on the mirror of the download
+            n_requests = len(second.requests)
+            _download_file(url, filepath, overwrite=False, update=True,
+                           mirrors=False)
+            self.assertEqual(len(second.requests), n_requests + 1)
+
+        # without checksums, only mirrors with the same ETag or size
+        # continue the download
+        other = _pbf(2**21)
+        with _serve(files) as first, _serve({'/pbf/file.osm.pbf': other}) \
+                as outdated, _serve(dict(files)) as second, \
+                tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.dict(download.MIRRORS, {}), \
+                mock.patch.dict(download._MIRROR_PROBES, {}):
+            for server in [first, outdated, second]:
+                download.register_mirror('test', server.url)
+            filepath = Path(tmpdir, 'file.osm.pbf')
+            for mirrors, expected in [([first, second], content),
+                                      ([first, outdated], other)]:
+                with mock.patch.object(
+                        download, 'rank_mirrors',
+                        lambda url, mirrors=mirrors: [
+                            server.url + '/pbf/file.osm.pbf'
+                            for server in mirrors]):
+                    first.truncate['/pbf/file.osm.pbf'] = 2**20
+                    _download_file(first.url + '/pbf/file.osm.pbf', filepath,
+                                   verify=False)
+                self.assertEqual(filepath.read_bytes(), expected)
+            self.assertEqual(second.requests[-1][2]['Range'],
+                             f'bytes={2**20}-')
+            self.assertEqual([(method, 'Range' in headers) for method, _,
+                              headers in outdated.requests],
+                             [('HEAD', False), ('GET', False)])
+
+    def test_connection_reuse(self):
+        content = _pbf(100)
+        files = {**_with_md5('/a.osm.pbf', _pbf(100)),
+                 **_with_md5('/b.osm.pbf', content)}
+        with _serve(files) as server, tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['a', 'b']:
+                _download_file(f'{server.url}/{name}.osm.pbf',
+                               Path(tmpdir, f'{name}.osm.pbf'))
+            self.assertEqual(len(server.requests), 4)
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(Path(tmpdir, 'b.osm.pbf').read_bytes(),
+                             content)
+
+            # a request which timed out does not leave its response on the
+            # connection for the next request
+            download._close_connections()
+            server.delay = 0.5
+            with mock.patch.object(download, 'TIMEOUT', 0.1), \
+                    self.assertRaises(TimeoutError):
+                _download_file(f'{server.url}/a.osm.pbf',
+                               Path(tmpdir, 'a.osm.pbf'))
+            server.delay = 0
+            time.sleep(0.5)
+            _download_file(f'{server.url}/b.osm.pbf',
+                           Path(tmpdir, 'b.osm.pbf'))
+            self.assertEqual(Path(tmpdir, 'b.osm.pbf').read_bytes(),
+                             content)
+
+            # public download functions close their connections
+            download._close_connections()
+            n_connections = server.connections
+            with mock.patch.object(download, 'PLANET_URL',
+                                   f'{server.url}/b.osm.pbf'):
+                get_planet_file(Path(tmpdir, 'b.osm.pbf'), overwrite=True)
+                path, metrics = get_planet_file(
+                    Path(tmpdir, 'b.osm.pbf'), overwrite=True,
+                    return_metrics=True)
+            self.assertEqual(path, Path(tmpdir, 'b.osm.pbf'))
+            self.assertEqual(metrics.status, 'done')
+            self.assertEqual(server.connections, n_connections + 2)
+            self.assertEqual(download._CONNECTIONS.pool, {})
+
+    def test_proxy(self):
+        content = _pbf(100)
+        with _serve(_with_md5('/a.osm.pbf', content)) as proxy, \
+                tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.dict(os.environ, {
+                    'http_proxy': proxy.url.replace('//', '//us%40er:pw@'),
+                    'no_proxy': ''}):
+            download._close_connections()
+            _download_file('http://osm.invalid/a.osm.pbf',
+                           Path(tmpdir, 'a.osm.pbf'))
+            download._close_connections()
+            self.assertEqual(Path(tmpdir, 'a.osm.pbf').read_bytes(),
+                             content)
+        method, path, headers = proxy.requests[-1]
+        self.assertEqual(path, 'http://osm.invalid/a.osm.pbf')
+        self.assertEqual(headers['Proxy-Authorization'],
+                         'Basic dXNAZXI6cHc=')
+
+    def test_get_countries_geofabrik(self):
+        content = _pbf(300)
+        files = {**_with_md5('/africa/senegal-and-gambia-latest.osm.pbf',
+                             content),
+                 **_with_md5('/europe/switzerland-latest.osm.pbf',
+                             _pbf(300))}
+        with _serve(files) as server, tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(download, 'GEOFABRIK_URL', server.url + '/'):
+            result = get_countries_geofabrik(
+                ['SEN', 'CHE', 'GMB', 'DEU', 'XXX'], save_path=tmpdir,
+                max_workers=2)
+            self.assertEqual(list(result), ['SEN', 'CHE', 'GMB', 'DEU', 'XXX'])
+            self.assertEqual(result['SEN'], result['GMB'])
+            self.assertEqual(result['SEN'].read_bytes(), content)
+            self.assertEqual(result['CHE'],
+                             Path(tmpdir, 'switzerland-latest.osm.pbf'))
+            self.assertIsInstance(result['DEU'], urllib.error.HTTPError)
+            self.assertIsInstance(result['XXX'], KeyError)
+            self.assertEqual(
+                [path for method, path, _ in server.requests
+                 if path.startswith('/africa')].count(
+                     '/africa/senegal-and-gambia-latest.osm.pbf'), 1)
+
+            reports = []
+            result, metrics = get_countries_geofabrik(
+                ['SEN', 'DEU', 'XXX'], save_path=tmpdir,
+                progress=reports.append, return_metrics=True)
+            self.assertEqual(result['SEN'],
+                             Path(tmpdir, 'senegal-and-gambia-latest.osm.pbf'))
+            self.assertEqual(list(metrics), ['SEN', 'DEU', 'XXX'])
+            self.assertEqual(metrics['SEN'].status, 'skipped')
+            self.assertEqual(metrics['DEU'].status, 'failed')
+            self.assertIsNone(metrics['XXX'])
+            self.assertCountEqual(reports, [metrics['SEN'], metrics['DEU']])
+
+            path, metrics = get_country_geofabrik(
+                'CHE', save_path=tmpdir, overwrite=True, return_metrics=True)
+            self.assertEqual(path, Path(tmpdir, 'switzerland-latest.osm.pbf'))
+            self.assertEqual(metrics.status, 'done')
+            self.assertEqual(metrics.received, 300)
+
     @unittest.skip("File too large to test download")
     def test_get_planet_file(self):
         self.fail("No test implemented")
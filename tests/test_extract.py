@@ -12,15 +12,51 @@ test extraction functions
 """
 
 import unittest
+import tempfile
+import zipfile
 import geopandas as gpd
 import numpy as np
 import shapely as sh
-from osm_flex.extract import extract, extract_cis, _query_builder
+from osgeo import ogr, osr
+from osm_flex.extract import (extract, extract_cis, extract_cis_shp,
+                              extract_in_shape, _query_builder, _shp_filter,
+                              _shp_layers)
 from pathlib import Path
 
 PATH_TEST_DATA = Path(__file__).parent / 'data'
 OSM_FILE = PATH_TEST_DATA / 'test.osm.pbf'
 
+
+def _write_shp_zip(path, layers):
+    """
+    write a Geofabrik-like shapefile archive, layers maps layer names to
+    lists of (osm_id, fclass, name, geometry), geometry may be None
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            zipfile.ZipFile(path, 'w') as archive:
+        for layer_name, rows in layers.items():
+            shp_file = Path(tmpdir, f'gis_osm_{layer_name}_free_1.shp')
+            data = driver.CreateDataSource(str(shp_file))
+            layer = data.CreateLayer(shp_file.stem, srs)
+            for field in ['osm_id', 'fclass', 'name']:
+                layer.CreateField(ogr.FieldDefn(field, ogr.OFTString))
+            for osm_id, fclass, name, geom in rows:
+                feature = ogr.Feature(layer.GetLayerDefn())
+                feature.SetField('osm_id', osm_id)
+                feature.SetField('fclass', fclass)
+                feature.SetField('name', name)
+                if geom is not None:
+                    feature.SetGeometry(
+                        ogr.CreateGeometryFromWkb(sh.to_wkb(geom)))
+                layer.CreateFeature(feature)
+            data = None
+            for file in Path(tmpdir).glob(f'{shp_file.stem}.*'):
+                archive.write(file, file.name)
+
+
 class TestExtractionFunctions(unittest.TestCase):
 
     def test_extract(self):
@@ -74,6 +110,20 @@ class TestExtractionFunctions(unittest.TestCase):
         self.assertFalse(any(elem is None for elem in gdf_line3.highway))
 
 
+        gdf_pt = extract(OSM_FILE, 'points', ['amenity', 'name'],
+                         "amenity='school'")
+        df_xy = extract(OSM_FILE, 'points', ['amenity', 'name'],
+                        "amenity='school'", as_xy=True)
+        self.assertNotIsInstance(df_xy, gpd.GeoDataFrame)
+        self.assertEqual(list(df_xy.columns),
+                         ['osm_id', 'amenity', 'name', 'x', 'y'])
+        self.assertEqual(df_xy.x.dtype, np.float64)
+        np.testing.assert_array_equal(df_xy.x, gdf_pt.geometry.x)
+        np.testing.assert_array_equal(df_xy.y, gdf_pt.geometry.y)
+
+        with self.assertRaises(ValueError):
+            extract(OSM_FILE, 'lines', ['highway'], as_xy=True)
+
         # TODO: test with invalid geo_type
 
     def test_extract_cis(self):
@@ -94,6 +144,104 @@ class TestExtractionFunctions(unittest.TestCase):
 
         # TODO: test with invalid ci-argument
 
+    def test_extract_bbox(self):
+        """
+        test bbox filter of function extract()
+        """
+        bbox = [-87.3, 13.8, -87.1, 13.9]
+        gdf_all = extract(OSM_FILE, 'lines', ['name', 'highway'],
+                          "highway='residential'")
+        gdf_bbox = extract(OSM_FILE, 'lines', ['name', 'highway'],
+                           "highway='residential'", bbox=bbox)
+        self.assertGreater(len(gdf_bbox), 0)
+        self.assertLess(len(gdf_bbox), len(gdf_all))
+        self.assertTrue(gdf_bbox.intersects(sh.box(*bbox)).all())
+        self.assertEqual(
+            set(gdf_bbox.osm_id),
+            set(gdf_all[gdf_all.intersects(sh.box(*bbox))].osm_id))
+
+    def test_extract_in_shape(self):
+        """
+        test function extract_in_shape()
+        """
+        shapes = {'west': sh.box(-87.5, 13.7, -87.3, 13.9),
+                  'east': sh.box(-87.2, 13.7, -87.0, 13.9)}
+        result = extract_in_shape(OSM_FILE, shapes, 'road')
+        self.assertEqual(list(result), ['west', 'east'])
+        gdf_all = extract_cis(OSM_FILE, 'road')
+        for name, shape in shapes.items():
+            self.assertIsInstance(result[name], gpd.GeoDataFrame)
+            self.assertGreater(len(result[name]), 0)
+            self.assertEqual(
+                sorted(result[name].osm_id),
+                sorted(gdf_all[gdf_all.intersects(shape)].osm_id))
+
+        gdf = extract_in_shape(OSM_FILE, shapes['west'], 'road')
+        self.assertEqual(sorted(gdf.osm_id), sorted(result['west'].osm_id))
+
+        # a shape without any feature gets an empty frame with all columns
+        result = extract_in_shape(
+            OSM_FILE, [sh.box(10, 10, 11, 11), shapes['west']], 'road')
+        self.assertEqual(len(result[0]), 0)
+        self.assertEqual(list(result[0].columns), list(result[1].columns))
+
+    def test_extract_cis_shp(self):
+        """
+        test function extract_cis_shp()
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shp_zip = Path(tmpdir, 'test-latest-free.shp.zip')
+            _write_shp_zip(shp_zip, {
+                'pois': [('1', 'school', 'A', sh.Point(0, 0)),
+                         ('2', 'bakery', 'B', sh.Point(1, 1)),
+                         ('3', 'university', '', sh.Point(5, 5)),
+                         ('8', 'school', 'G', None)],
+                'pois_a': [('4', 'college', 'C', sh.box(0, 0, 1, 1))],
+                'roads': [
+                    ('5', 'primary', 'D', sh.LineString([(0, 0), (1, 1)])),
+                    ('6', 'footway', 'E', sh.LineString([(0, 0), (1, 0)])),
+                    ('7', 'unknown', 'F', sh.LineString([(1, 1), (2, 2)]))],
+                'transport': [('9', 'railway_halt', 'H', sh.Point(2, 2))]})
+            self.assertEqual(_shp_layers(shp_zip),
+                             {'pois': ['gis_osm_pois_free_1.shp'],
+                              'pois_a': ['gis_osm_pois_a_free_1.shp'],
+                              'roads': ['gis_osm_roads_free_1.shp'],
+                              'transport': ['gis_osm_transport_free_1.shp']})
+
+            with self.assertLogs('osm_flex.extract', 'WARNING') as logs:
+                gdf = extract_cis_shp(shp_zip, 'education')
+            self.assertIn('skipped 1 features without geometry',
+                          logs.output[0])
+            self.assertEqual(list(gdf.columns),
+                             ['osm_id', 'amenity', 'building', 'name',
+                              'geometry'])
+            self.assertEqual(list(gdf.osm_id), ['1', '3', '4'])
+            self.assertEqual(list(gdf.amenity),
+                             ['school', 'university', 'college'])
+            self.assertEqual(gdf.name.isna().tolist(), [False, True, False])
+            self.assertEqual(gdf.name.dropna().tolist(), ['A', 'C'])
+            self.assertTrue(gdf.building.isna().all())
+            self.assertEqual(gdf.crs, 'epsg:4326')
+
+            gdf = extract_cis_shp(shp_zip, 'road', bbox=[0.5, 0.5, 0.9, 0.9])
+            self.assertEqual(list(gdf.osm_id), ['5'])
+            self.assertEqual(list(gdf.highway), ['primary'])
+            self.assertEqual(
+                list(extract_cis_shp(shp_zip, 'road').highway),
+                ['primary', 'road'])
+
+            self.assertEqual(list(extract_cis_shp(shp_zip, 'rail').railway),
+                             ['halt'])
+            self.assertTrue(extract_cis_shp(shp_zip, 'air').empty)
+            with self.assertRaisesRegex(ValueError, 'not covered'):
+                extract_cis_shp(shp_zip, 'power')
+
+    def test__shp_filter(self):
+        self.assertEqual(_shp_filter('fclass', {'a': {}, 'b': {}}),
+                         "fclass IN ('a', 'b')")
+        self.assertEqual(_shp_filter('type', {None: {}, 'a': {}}),
+                         "type IN ('a') OR type IS NULL OR type = ''")
+
     def test__query_builder(self):
         """
         test function _query_builder()
@@ -0,0 +1,89 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test network topology functions
+"""
+
+import unittest
+import geopandas as gpd
+import numpy as np
+import shapely as sh
+from osm_flex.network import build_network, network_to_csr
+
+
+# a primary road split into two segments (with a tiny gap at the split),
+# continued by a third primary segment, and two residential branches
+gdf_roads = gpd.GeoDataFrame(
+    {'osm_id': [1, 2, 3, 4, 5, 6],
+     'highway': ['primary', 'primary', 'primary', 'residential',
+                 'residential', 'primary']},
+    geometry=[sh.LineString([(0, 0), (1, 0)]),
+              sh.LineString([(2, 0), (1, 1e-8)]),
+              sh.LineString([(2, 0), (3, 0)]),
+              sh.LineString([(1, 0), (1, 1)]),
+              sh.LineString([(3, 0), (3, 1)]),
+              sh.Point(0, 0)],
+    crs='epsg:4326')
+
+
+class TestNetworkFunctions(unittest.TestCase):
+
+    def test_build_network(self):
+        """ test function build_network() """
+        nodes, edges = build_network(gdf_roads)
+
+        self.assertEqual(len(nodes), 5)
+        self.assertEqual(len(edges), 4)
+        self.assertEqual(list(edges.columns),
+                         ['from_node', 'to_node', 'osm_id', 'highway',
+                          'n_segments', 'geometry'])
+        self.assertEqual(edges.n_segments.sum(), 5)
+        merged = edges[edges.n_segments == 2].iloc[0]
+        self.assertEqual(merged.osm_id, 2)
+        self.assertTrue(merged.geometry.equals(
+            sh.LineString([(1, 0), (2, 0), (3, 0)])))
+        # every edge connects the nodes at its ends
+        self.assertTrue(all(
+            nodes.geometry[edge.from_node].equals(sh.get_point(edge.geometry, 0))
+            and nodes.geometry[edge.to_node].equals(sh.get_point(edge.geometry, -1))
+            for edge in edges.itertuples()))
+        np.testing.assert_array_equal(
+            np.sort(nodes.degree.to_numpy()), [1, 1, 1, 2, 3])
+
+        # lines of different type are not merged
+        nodes, edges = build_network(gdf_roads, merge_keys=['osm_id'])
+        self.assertEqual(len(edges), 5)
+
+        # without snapping, the gap at the split remains (6 instead of 5 nodes)
+        nodes, edges = build_network(gdf_roads, snap_tolerance=1e-9)
+        self.assertEqual(len(nodes), 6)
+
+    def test_network_to_csr(self):
+        """ test function network_to_csr() """
+        nodes, edges = build_network(gdf_roads)
+        indptr, indices, edge_index = network_to_csr(edges, len(nodes))
+
+        self.assertEqual(len(indptr), len(nodes) + 1)
+        self.assertEqual(len(indices), 2 * len(edges))
+        np.testing.assert_array_equal(np.diff(indptr), nodes.degree)
+        for node in range(len(nodes)):
+            for neighbour, edge in zip(indices[indptr[node]:indptr[node+1]],
+                                       edge_index[indptr[node]:indptr[node+1]]):
+                self.assertEqual(
+                    {node, neighbour},
+                    {edges.from_node[edge], edges.to_node[edge]})
+
+        indptr, indices, edge_index = network_to_csr(edges, directed=True)
+        self.assertEqual(len(indices), len(edges))
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestNetworkFunctions)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)
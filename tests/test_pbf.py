@@ -0,0 +1,85 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test osm.pbf reading functions
+"""
+
+import unittest
+import tempfile
+from pathlib import Path
+import numpy as np
+from osm_flex.pbf import (header_from_bytes, read_header, sample_nodes,
+                         _read_varint, _zigzag, _decode_varints,
+                         _decode_sint64s)
+
+PATH_TEST_DATA = Path(__file__).parent / 'data'
+OSM_FILE = PATH_TEST_DATA / 'test.osm.pbf'
+
+
+class TestPbf(unittest.TestCase):
+
+    def test__read_varint(self):
+        self.assertEqual(_read_varint(bytes([0x01]), 0), (1, 1))
+        self.assertEqual(_read_varint(bytes([0xff, 0x00, 0xac, 0x02]), 2),
+                         (300, 4))
+        self.assertEqual([_zigzag(val) for val in [0, 1, 2, 3]], [0, -1, 1, -2])
+
+    def test__decode_varints(self):
+        data = bytes([0x01, 0xac, 0x02, 0x00, 0xff, 0xff, 0x03])
+        np.testing.assert_array_equal(_decode_varints(data), [1, 300, 0, 65535])
+        np.testing.assert_array_equal(_decode_sint64s(data),
+                                      [-1, 150, 0, -32768])
+        self.assertEqual(len(_decode_varints(b'')), 0)
+
+    def test_sample_nodes(self):
+        coords, scale = sample_nodes(OSM_FILE, sample_every=1)
+        self.assertEqual(coords.shape, (105659, 2))
+        self.assertEqual(scale, 1.)
+        bbox = read_header(OSM_FILE)['bbox']
+        self.assertTrue((coords.min(axis=0) >= np.array(bbox[:2]) - 1e-6).all())
+        self.assertTrue((coords.max(axis=0) <= np.array(bbox[2:]) + 1e-6).all())
+
+        coords, scale = sample_nodes(OSM_FILE, sample_every=2)
+        self.assertLess(len(coords), 105659)
+        self.assertGreater(scale, 1)
+
+        with self.assertRaises(ValueError):
+            sample_nodes(OSM_FILE, sample_every=0)
+
+    def test_read_header(self):
+        header = read_header(OSM_FILE)
+        self.assertEqual(header['required_features'],
+                         ['OsmSchema-V0.6', 'DenseNodes'])
+        self.assertEqual(header['bbox'], [-87.649398973, 13.66004507,
+                                          -87.0, 14.031899318])
+        self.assertIsNone(header['replication_timestamp'])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir, 'invalid.osm.pbf')
+            path.write_bytes(b'')
+            with self.assertRaises(ValueError):
+                read_header(path)
+            path.write_bytes(b'\x00\x00\x00\x02\x08\x01')
+            with self.assertRaises(ValueError):
+                read_header(path)
+
+    def test_header_from_bytes(self):
+        data = OSM_FILE.read_bytes()[:2**16]
+        self.assertEqual(header_from_bytes(data), read_header(OSM_FILE))
+        # incomplete header
+        self.assertIsNone(header_from_bytes(data[:2]))
+        self.assertIsNone(header_from_bytes(data[:40]))
+        with self.assertRaises(ValueError):
+            header_from_bytes(b'<!DOCTYPE html><html>')
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestPbf)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)
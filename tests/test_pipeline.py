@@ -0,0 +1,219 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test pipeline functions
+"""
+
+import os
+import unittest
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+import shapely
+from osm_flex import pipeline
+from osm_flex.download import DownloadMetrics
+from osm_flex.pipeline import run_pipeline
+
+
+class _Stages:
+    """
+    stand-ins for the download, clip and extract functions, which take
+    delay seconds (or a dict of seconds per stage) and record when they ran
+    """
+
+    def __init__(self, delay=0.1, fail=(), download_status='done'):
+        self.delay = delay if isinstance(delay, dict) else {
+            'download': delay, 'clip': delay, 'extract': delay}
+        self.fail = fail
+        self.download_status = download_status
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _run(self, stage, name):
+        start = time.perf_counter()
+        time.sleep(self.delay[stage])
+        if (stage, name) in self.fail:
+            raise RuntimeError(f'{stage} of {name} failed')
+        with self.lock:
+            self.events.append((stage, name, start, time.perf_counter()))
+
+    def download(self, iso3, save_path, overwrite, verify, update,
+                 rate_limit, return_metrics):
+        self._run('download', iso3)
+        path = Path(save_path, f'{iso3}.osm.pbf')
+        return path, DownloadMetrics(iso3, path, self.download_status)
+
+    def clip(self, shape, osmpbf_clip_from, osmpbf_output, *args, **kwargs):
+        self._run('clip', Path(osmpbf_output).name)
+        self.clip_args = shape, args
+
+    def extract(self, osm_path, ci_type):
+        self._run('extract', Path(osm_path).name)
+        return f'{ci_type} of {Path(osm_path).name}'
+
+    def patch(self):
+        return mock.patch.multiple(
+            pipeline, get_country_geofabrik=self.download, _clip=self.clip,
+            extract_cis=self.extract)
+
+    def times(self, stage, name):
+        return [(start, end) for event_stage, event_name, start, end
+                in self.events if (event_stage, event_name) == (stage, name)]
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_run_pipeline(self):
+        stages = _Stages(delay=0.2)
+        countries = ['CHE', 'AUT', 'LIE']
+        with stages.patch(), tempfile.TemporaryDirectory() as tmpdir:
+            start = time.perf_counter()
+            results, stats = run_pipeline(countries, 'road', save_path=tmpdir)
+            duration = time.perf_counter() - start
+
+        self.assertEqual(list(results), countries)
+        for iso3, result in results.items():
+            self.assertEqual(result.status, 'done')
+            self.assertEqual(result.osm_path, Path(tmpdir, f'{iso3}.osm.pbf'))
+            self.assertIsNone(result.clip_path)
+            self.assertEqual(result.gdfs, {'road': f'road of {iso3}.osm.pbf'})
+            self.assertEqual(set(result.durations), {'download', 'extract'})
+
+        # downloads overlap with the extraction of the previous country
+        self.assertLess(stages.times('download', 'LIE')[0][0],
+                        stages.times('extract', 'AUT.osm.pbf')[0][1])
+        self.assertLess(duration, 6 * 0.2)
+
+        self.assertEqual(list(stats), ['download', 'extract'])
+        self.assertEqual(stats['download'].workers, 2)
+        self.assertEqual(stats['extract'].items, 3)
+        self.assertGreater(stats['extract'].utilization, 0.6)
+        self.assertGreater(stats['download'].blocked, 0)
+        self.assertAlmostEqual(stats['extract'].as_dict()['utilization'],
+                               stats['extract'].utilization)
+
+    def test_run_pipeline_backpressure(self):
+        stages = _Stages(delay={'download': 0.01, 'extract': 0.1})
+        countries = [f'C{index:02d}' for index in range(6)]
+        with stages.patch(), tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(pipeline, '_create_gf_download_url',
+                                  side_effect=lambda iso3, _: iso3):
+            results, stats = run_pipeline(countries, 'road', save_path=tmpdir,
+                                          download_workers=1, queue_size=1)
+        self.assertTrue(all(result.status == 'done'
+                            for result in results.values()))
+        # downloads wait for the extraction instead of running ahead
+        extract_starts = sorted(start for stage, _, start, _ in stages.events
+                                if stage == 'extract')
+        for index, iso3 in enumerate(countries):
+            download_end = stages.times('download', iso3)[0][1]
+            started = sum(start < download_end for start in extract_starts)
+            self.assertGreaterEqual(started, index - 2)
+        self.assertGreater(stats['download'].blocked, 0.2)
+        self.assertGreater(stats['extract'].utilization, 0.8)
+        self.assertGreater(stats['extract'].utilization,
+                           stats['download'].utilization)
+
+    def test_run_pipeline_failures(self):
+        stages = _Stages(delay=0.01, fail=[('extract', 'AUT.osm.pbf')])
+        progress = []
+        with stages.patch(), tempfile.TemporaryDirectory() as tmpdir:
+            results, stats = run_pipeline(['XXX', 'AUT', 'CHE'],
+                                          ['road', 'rail'], save_path=tmpdir,
+                                          progress=progress.append)
+        self.assertEqual(results['XXX'].status, 'failed')
+        self.assertEqual(results['XXX'].stage, 'download')
+        self.assertIsInstance(results['XXX'].error, KeyError)
+        self.assertNotIn('extract', results['XXX'].durations)
+        self.assertEqual(results['AUT'].status, 'failed')
+        self.assertEqual(results['AUT'].stage, 'extract')
+        self.assertEqual(results['CHE'].status, 'done')
+        self.assertEqual(set(results['CHE'].gdfs), {'road', 'rail'})
+        self.assertCountEqual(progress, results.values())
+        self.assertEqual(stats['download'].failed, 1)
+        self.assertEqual(stats['extract'].items, 2)
+        self.assertEqual(stats['extract'].failed, 1)
+
+        with self.assertRaises(ValueError):
+            run_pipeline(['CHE'], 'road', extract_workers=0)
+
+    def test_run_pipeline_shared_download(self):
+        stages = _Stages(delay=0.01)
+        calls = []
+
+        def download(iso3, **kwargs):
+            calls.append((iso3, kwargs['overwrite']))
+            return stages.download(iso3, **kwargs)
+
+        with stages.patch(), tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(pipeline, 'get_country_geofabrik',
+                                  download):
+            results, _ = run_pipeline(['SEN', 'GMB'], 'road', save_path=tmpdir,
+                                      overwrite=True)
+        self.assertTrue(all(result.status == 'done'
+                            for result in results.values()))
+        # senegal-and-gambia is only downloaded once
+        self.assertCountEqual([overwrite for _, overwrite in calls],
+                              [True, False])
+
+    def test_run_pipeline_clip(self):
+        stages = _Stages(delay=0.01)
+        with stages.patch(), tempfile.TemporaryDirectory() as tmpdir:
+            clip_dir = Path(tmpdir, 'clips')
+            results, stats = run_pipeline(
+                ['CHE', 'AUT'], 'road', shapes={'CHE': [8., 46., 9., 47.]},
+                save_path=tmpdir, clip_dir=clip_dir)
+            self.assertTrue(clip_dir.is_dir())
+        self.assertEqual(list(stats), ['download', 'clip', 'extract'])
+        self.assertEqual(results['CHE'].clip_path,
+                         Path(clip_dir, 'CHE.osm.pbf'))
+        self.assertEqual(results['CHE'].gdfs['road'], 'road of CHE.osm.pbf')
+        self.assertIsNone(results['AUT'].clip_path)
+        self.assertEqual(len(stages.times('clip', 'CHE.osm.pbf')), 1)
+        self.assertEqual(stages.times('clip', 'AUT.osm.pbf'), [])
+
+    def test_run_pipeline_stale_clip(self):
+        stages = _Stages(delay=0.01, download_status='skipped')
+        shapes = {'CHE': [shapely.box(8., 46., 9., 47.)]}
+        with stages.patch(), tempfile.TemporaryDirectory() as tmpdir:
+            clip_dir = Path(tmpdir, 'clips')
+            clip_dir.mkdir()
+            country_file = Path(tmpdir, 'CHE.osm.pbf')
+            country_file.write_text('country')
+            Path(clip_dir, 'CHE.osm.pbf').write_text('clip')
+
+            def n_clips():
+                run_pipeline(['CHE'], 'road', shapes=shapes, save_path=tmpdir,
+                             clip_dir=clip_dir)
+                return len(stages.times('clip', 'CHE.osm.pbf'))
+
+            # existing clip newer than the existing country file
+            self.assertEqual(n_clips(), 0)
+            # country file newer than the clip
+            os.utime(country_file, ns=(time.time_ns(), time.time_ns() + 10**9))
+            self.assertEqual(n_clips(), 1)
+            # overwrite the stale clip
+            self.assertTrue(stages.clip_args[1][0])
+            # country file downloaded again
+            os.utime(country_file, ns=(0, 0))
+            stages.download_status = 'done'
+            self.assertEqual(n_clips(), 2)
+
+            # the .poly file is written to a temporary directory
+            poly_file = Path(stages.clip_args[0])
+            self.assertEqual(poly_file.suffix, '.poly')
+            self.assertFalse(poly_file.parent.exists())
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestPipeline)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)
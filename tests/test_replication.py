@@ -0,0 +1,229 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test replication functions
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+from osm_flex import download
+from osm_flex.pbf import read_header
+from osm_flex.replication import (
+    _format_timestamp,
+    _parse_state,
+    _sequence_path,
+    fetch_diffs,
+    read_state,
+    update_pbf,
+)
+from helpers import header_pbf, pb_field
+from test_download import _serve
+
+# timestamp of sequence 100 of the test server, 2023-11-24T00:00:00Z
+T_100 = 1700784000
+
+
+def _write_replication_pbf(path, base_url=None, sequence=None,
+                           timestamp=None):
+    """write an osm.pbf file with only a header block with replication state"""
+    header_block = pb_field(4, b'OsmSchema-V0.6')
+    if timestamp is not None:
+        header_block += pb_field(32, timestamp)
+    if sequence is not None:
+        header_block += pb_field(33, sequence)
+    if base_url is not None:
+        header_block += pb_field(34, base_url.encode())
+    Path(path).write_bytes(header_pbf(header_block))
+
+
+def _state(sequence, timestamp):
+    """content of a state file"""
+    iso = _format_timestamp(timestamp).replace(':', '\\:')
+    return (f'#Fri Nov 24 00:00:00 UTC 2023\nsequenceNumber={sequence}\n'
+            f'timestamp={iso}\n').encode()
+
+
+def _osc(node_id):
+    """gzipped osmChange file creating a node"""
+    return gzip.compress(
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<osmChange version="0.6" generator="test"><create>'
+        + f'<node id="{node_id}" version="1" timestamp="2023-11-24T00:00:00Z"'
+          f' lat="47" lon="8"/>'.encode()
+        + b'</create></osmChange>')
+
+
+def _replication_files(latest, first=100):
+    """
+    files of a daily replication server, with diffs first to latest at
+    one day intervals from T_100
+    """
+    files = {'/updates/state.txt':
+             _state(latest, T_100 + (latest - 100) * 86400)}
+    for seq in range(first, latest + 1):
+        path = '/updates/' + _sequence_path(seq)
+        files[path + '.state.txt'] = _state(seq, T_100 + (seq - 100) * 86400)
+        files[path + '.osc.gz'] = _osc(seq)
+    return files
+
+
+def _fake_osmium(bin_dir):
+    """
+    osmium stand-in in bin_dir, which copies the input file to the output
+    and appends a byte, or writes a part of it and fails if OSMIUM_FAIL is
+    set
+    """
+    script = Path(bin_dir, 'osmium')
+    script.write_text(
+        f'#!{sys.executable}\n'
+        'import os, shutil, sys\n'
+        'output = sys.argv[sys.argv.index("-o") + 1]\n'
+        'shutil.copyfile(sys.argv[2], output)\n'
+        'if os.environ.get("OSMIUM_FAIL"):\n'
+        '    sys.exit("osmium failed")\n'
+        'open(output, "ab").write(b"x")\n')
+    script.chmod(0o755)
+
+
+class TestReplication(unittest.TestCase):
+
+    def test__sequence_path(self):
+        self.assertEqual(_sequence_path(1234567), '001/234/567')
+        self.assertEqual(_sequence_path(5), '000/000/005')
+
+    def test_read_state(self):
+        self.assertEqual(
+            _parse_state(_state(100, T_100).decode()),
+            {'sequence_number': 100, 'timestamp': T_100})
+        with _serve(_replication_files(102)) as server:
+            base_url = server.url + '/updates/'
+            self.assertEqual(read_state(base_url)['sequence_number'], 102)
+            self.assertEqual(read_state(base_url, 101)['timestamp'],
+                             T_100 + 86400)
+
+    def test_fetch_diffs(self):
+        with _serve(_replication_files(104)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            base_url = server.url + '/updates'
+            osm_path = Path(tmpdir, 'test.osm.pbf')
+            diff_dir = Path(tmpdir, 'diffs')
+
+            # by sequence number
+            _write_replication_pbf(osm_path, base_url, sequence=101)
+            diffs, state = fetch_diffs(osm_path, diff_dir)
+            self.assertEqual([diff.name for diff in diffs],
+                             ['000000102.osc.gz', '000000103.osc.gz',
+                              '000000104.osc.gz'])
+            self.assertEqual(state['sequence_number'], 104)
+            self.assertEqual(state['base_url'], base_url)
+            self.assertEqual(diffs[0].read_bytes(),
+                             server.files['/updates/000/000/102.osc.gz'])
+
+            # diffs which are already there are not downloaded again
+            n_requests = len(server.requests)
+            fetch_diffs(osm_path, diff_dir)
+            self.assertEqual(len(server.requests), n_requests + 1)
+
+            # by timestamp, searched on the server
+            _write_replication_pbf(osm_path, base_url,
+                                   timestamp=T_100 + 2 * 86400 + 3600)
+            diffs, _ = fetch_diffs(osm_path, diff_dir)
+            self.assertEqual([diff.name for diff in diffs],
+                             ['000000103.osc.gz', '000000104.osc.gz'])
+
+            # up to date
+            _write_replication_pbf(osm_path, sequence=104)
+            self.assertEqual(fetch_diffs(osm_path, diff_dir, base_url)[0], [])
+
+            _write_replication_pbf(osm_path, sequence=104)
+            with self.assertRaisesRegex(ValueError, 'no replication base URL'):
+                fetch_diffs(osm_path, diff_dir)
+            _write_replication_pbf(osm_path, base_url)
+            with self.assertRaisesRegex(ValueError, 'no replication state'):
+                fetch_diffs(osm_path, diff_dir)
+
+    def test_fetch_diffs_too_old(self):
+        # the server only keeps the diffs since sequence 100
+        with _serve(_replication_files(120)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            osm_path = Path(tmpdir, 'test.osm.pbf')
+            _write_replication_pbf(osm_path, server.url + '/updates',
+                                   timestamp=T_100 + 5 * 86400)
+            diffs, _ = fetch_diffs(osm_path, Path(tmpdir, 'diffs'))
+            self.assertEqual(len(diffs), 15)
+
+            _write_replication_pbf(osm_path, server.url + '/updates',
+                                   timestamp=T_100 - 86400)
+            with self.assertRaisesRegex(ValueError, 'not available'):
+                fetch_diffs(osm_path, Path(tmpdir, 'diffs'))
+
+    @unittest.skipIf(shutil.which('osmium') is None, 'osmium not installed')
+    def test_update_pbf(self):
+        with _serve(_replication_files(102)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            base_url = server.url + '/updates'
+            osm_path = Path(tmpdir, 'test.osm.pbf')
+            _write_replication_pbf(osm_path, base_url, sequence=100)
+            output = update_pbf(osm_path, Path(tmpdir, 'updated.osm.pbf'))
+            header = read_header(output)
+            self.assertEqual(header['replication_sequence_number'], 102)
+            self.assertEqual(header['replication_base_url'], base_url)
+            self.assertEqual(header['replication_timestamp'],
+                             T_100 + 2 * 86400)
+
+            # up to date, updated in place
+            self.assertEqual(update_pbf(output), output)
+            self.assertEqual(read_header(output), header)
+
+    def test_update_pbf_osmium(self):
+        with _serve(_replication_files(102)) as server, \
+                tempfile.TemporaryDirectory() as tmpdir:
+            base_url = server.url + '/updates'
+            osm_path = Path(tmpdir, 'test.osm.pbf')
+            _write_replication_pbf(osm_path, base_url, sequence=100)
+            stat = osm_path.stat()
+            download._record_download(osm_path, {
+                'url': 'http://osm.invalid/test.osm.pbf', 'etag': '"1"',
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'md5': hashlib.md5(osm_path.read_bytes()).hexdigest()})
+            bin_dir = Path(tmpdir, 'bin')
+            bin_dir.mkdir()
+            _fake_osmium(bin_dir)
+            path = f'{bin_dir}{os.pathsep}{os.environ.get("PATH", "")}'
+
+            # the part file of a failed update is removed
+            with mock.patch.dict(os.environ,
+                                 {'PATH': path, 'OSMIUM_FAIL': '1'}), \
+                    self.assertRaisesRegex(RuntimeError, 'exit code 1'):
+                update_pbf(osm_path, diff_dir=Path(tmpdir, 'diffs'))
+            self.assertFalse(Path(tmpdir, 'test.osm.pbf.part').exists())
+
+            # the manifest entry follows the update in place
+            with mock.patch.dict(os.environ, {'PATH': path}):
+                update_pbf(osm_path, diff_dir=Path(tmpdir, 'diffs'))
+            entry = download.read_manifest_entry(osm_path)
+            self.assertIsNotNone(entry)
+            self.assertEqual(entry['url'], 'http://osm.invalid/test.osm.pbf')
+            self.assertEqual(entry['size'], stat.st_size + 1)
+            self.assertEqual(entry['md5'],
+                             hashlib.md5(osm_path.read_bytes()).hexdigest())
+            self.assertEqual(entry['header'], read_header(osm_path))
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestReplication)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)
@@ -13,9 +13,12 @@ test simplification functions
 
 import unittest
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import shapely as sh
 from osm_flex.simplify import (remove_small_polygons, remove_contained_points,
-                               remove_contained_polys, remove_exact_duplicates)
+                               remove_contained_polys, remove_exact_duplicates,
+                               reduce_precision, simplify_parallel)
 from pandas.testing import assert_frame_equal
 from pathlib import Path
 
@@ -57,6 +60,26 @@ class TestSimplificationFunctions(unittest.TestCase):
 
         assert_frame_equal(gdf_removed, gdf_no_small_poly)
 
+        # same real-world area (ca. 1.2 km2 and 0.6 km2) at equator and 60N
+        gdf_lat = gpd.GeoDataFrame(
+            geometry = [
+                sh.box(10, 0, 10.01, 0.01),
+                sh.box(10, 60, 10.01, 60.01),
+                point1,
+            ], crs='EPSG:4326')
+        gdf_removed = remove_small_polygons(gdf_lat, min_area_m2=1e6)
+        self.assertEqual(len(gdf_removed), 2)
+        self.assertTrue(gdf_removed.geometry[0].equals(gdf_lat.geometry[0]))
+        gdf_removed = remove_small_polygons(gdf_lat, min_area_m2=5e5)
+        self.assertEqual(len(gdf_removed), 3)
+
+        with self.assertRaises(ValueError):
+            remove_small_polygons(gdf_lat)
+        with self.assertRaises(ValueError):
+            remove_small_polygons(gdf_lat, 0.5, min_area_m2=1e6)
+        with self.assertRaises(ValueError):
+            remove_small_polygons(gdf_lat.to_crs('EPSG:3857'), min_area_m2=1e6)
+
     def test_remove_contained_points(self):
         """ test function remove_contained_points() """
 
@@ -75,6 +98,31 @@ class TestSimplificationFunctions(unittest.TestCase):
 
 
 
+    def test_simplify_xy_points(self):
+        """ test simplification functions with point frames with x and y """
+
+        df_xy = pd.DataFrame({'name': ['a', 'b', 'c', 'd'],
+                              'x': [1.0, 0.5, 0.5, 0.12345678],
+                              'y': [-1.0, 0.5, 0.5, 0.5]})
+        gdf_poly = gpd.GeoDataFrame(geometry=[polygon1, line1])
+
+        df_simple = remove_contained_points(df_xy, gdf_poly)
+        self.assertIsInstance(df_simple, pd.DataFrame)
+        self.assertEqual(list(df_simple.name), ['a'])
+        assert_frame_equal(remove_contained_points(df_xy), df_xy)
+
+        df_simple = remove_exact_duplicates(df_xy)
+        self.assertEqual(list(df_simple.name), ['a', 'b', 'd'])
+
+        assert_frame_equal(remove_small_polygons(df_xy, 0.5), df_xy)
+        assert_frame_equal(remove_small_polygons(df_xy, min_area_m2=1e6),
+                           df_xy)
+        assert_frame_equal(remove_contained_polys(df_xy), df_xy)
+
+        df_reduced = reduce_precision(df_xy, grid_size=1e-3)
+        self.assertAlmostEqual(df_reduced.x[3], 0.123)
+        self.assertEqual(df_reduced.x.dtype, np.float64)
+
     def test_remove_contained_polys(self):
         """ test function remove_contained_polys() """
 
@@ -109,6 +157,66 @@ class TestSimplificationFunctions(unittest.TestCase):
 
         assert_frame_equal(gdf_check, gdf_simple)
 
+    def test_reduce_precision(self):
+        """ test function reduce_precision() """
+
+        # dense line with vertices every ca. 11 cm, slightly off a straight line
+        x = np.linspace(0, 0.01, 101)
+        line_dense = sh.LineString(np.c_[x, 1e-9 * np.sin(x)])
+        polygon_tiny = sh.box(0, 0, 1e-8, 1e-8)
+        gdf = gpd.GeoDataFrame(
+            {'name': ['a', 'b', 'c', 'd']},
+            geometry=[point1, line_dense, polygon1, polygon_tiny],
+            crs='epsg:4326')
+
+        with self.assertLogs('osm_flex.simplify', level='INFO'):
+            gdf_reduced = reduce_precision(gdf)
+        # tiny polygon collapses on the 1e-7 grid
+        self.assertEqual(list(gdf_reduced.name), ['a', 'b', 'c'])
+        # collinear vertices are kept without tolerance
+        self.assertEqual(sh.get_num_coordinates(gdf_reduced.geometry[1]), 101)
+        self.assertTrue(np.all(
+            sh.get_coordinates(gdf_reduced.geometry[1])[:, 1] == 0))
+
+        gdf_thinned = reduce_precision(gdf, tolerance_m=1)
+        self.assertEqual(sh.get_num_coordinates(gdf_thinned.geometry[1]), 2)
+        self.assertTrue(gdf_thinned.geometry[2].equals(polygon1))
+
+        gdf_exact = reduce_precision(gdf, grid_size=None)
+        assert_frame_equal(gdf_exact, gdf)
+
+        with self.assertRaisesRegex(ValueError, 'requires a gdf with crs'):
+            reduce_precision(gdf.set_crs(None, allow_override=True),
+                             tolerance_m=1)
+
+    def test_simplify_parallel(self):
+        """ test function simplify_parallel() against serial results """
+
+        rng = np.random.default_rng(42)
+        x, y = rng.uniform(0, 10, (2, 400))
+        size = rng.uniform(0.01, 1, 400)
+        polys = sh.box(x, y, x + size, y + size)
+        points = sh.points(rng.uniform(0, 10, (200, 2)))
+        gdf = gpd.GeoDataFrame(
+            {'name': np.arange(800)},
+            geometry=np.concatenate([polys, points, polys[:100], points[:100]]))
+
+        funcs = [remove_exact_duplicates, remove_contained_polys,
+                 remove_contained_points,
+                 (remove_small_polygons, {'min_area': 0.1})]
+        gdf_serial = gdf
+        for func in funcs:
+            gdf_serial = (func[0](gdf_serial, **func[1]) if isinstance(func, tuple)
+                          else func(gdf_serial))
+
+        for method in ['hilbert', 'grid']:
+            gdf_parallel = simplify_parallel(gdf, funcs, max_workers=2,
+                                             n_partitions=7, method=method)
+            assert_frame_equal(gdf_serial, gdf_parallel)
+
+        with self.assertRaises(ValueError):
+            simplify_parallel(gdf, funcs, max_workers=2, method='xyz')
+
 
 if __name__ == "__main__":
     TESTS = unittest.TestLoader().loadTestsFromTestCase(TestSimplificationFunctions)
@@ -0,0 +1,110 @@
+"""
+This file is part of OSM-flex.
+Copyright (C) 2023 OSM-flex contributors listed in AUTHORS.
+OSM-flex is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free
+Software Foundation, version 3.
+OSM-flex is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+-----
+test tiling functions
+"""
+
+import json
+import sys
+import unittest
+import tempfile
+from pathlib import Path
+from unittest import mock
+import numpy as np
+
+from osm_flex.clip import register_kernel, CLIP_KERNELS
+from osm_flex.pbf import sample_nodes
+from osm_flex.tile import _quadtree, plan_tiles, tile_pbf
+
+PATH_TEST_DATA = Path(__file__).parent / 'data'
+OSM_FILE = PATH_TEST_DATA / 'test.osm.pbf'
+
+
+def _build_bbox_cmd(shape, osmpbf_clip_from, osmpbf_output):
+    """command of a dummy kernel writing the bbox to the output"""
+    return [sys.executable, '-c',
+            'import sys; open(sys.argv[2], "w").write(sys.argv[1])',
+            str(shape), str(osmpbf_output)]
+
+
+class TestTile(unittest.TestCase):
+
+    def test__quadtree(self):
+        # dense cluster in the north-east, few points elsewhere
+        coords = np.concatenate([
+            np.random.default_rng(0).uniform(0.75, 1, (100, 2)),
+            [[0.1, 0.1], [0.6, 0.1], [0.1, 0.6]]])
+        tiles = _quadtree(coords, [0, 0, 1, 1], 30, 1., 10)
+        keys = [key for key, _, _ in tiles]
+        self.assertEqual(keys[:3], ['0', '1', '2'])
+        self.assertTrue(all(key.startswith('3') for key in keys[3:]))
+        self.assertTrue(all(n_nodes <= 30 for _, _, n_nodes in tiles))
+        self.assertEqual(sum(n_nodes for _, _, n_nodes in tiles), 103)
+        # tiles cover the extent, also the empty quadrants
+        self.assertAlmostEqual(sum((bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+                                   for _, bbox, _ in tiles), 1)
+        self.assertEqual(sum(n_nodes == 0 for _, _, n_nodes in tiles), 3)
+
+        # depth limit
+        tiles = _quadtree(coords, [0, 0, 1, 1], 30, 1., 1)
+        self.assertEqual(len(tiles), 4)
+
+    def test_plan_tiles(self):
+        tiles = plan_tiles(OSM_FILE, max_nodes=2e4, sample_every=1)
+        self.assertGreater(len(tiles), 4)
+        self.assertTrue(all(tile['estimated_nodes'] <= 2e4 for tile in tiles))
+        self.assertEqual(sum(tile['estimated_nodes'] for tile in tiles),
+                         105659)
+        self.assertEqual(plan_tiles(OSM_FILE, max_nodes=1e6),
+                         [{'name': 'tile',
+                           'bbox': [-87.649398973, 13.66004507,
+                                    -87.0, 14.031899318],
+                           'estimated_nodes': 120000}])
+        for sample_every in [0, -1]:
+            with self.assertRaises(ValueError):
+                plan_tiles(OSM_FILE, sample_every=sample_every)
+
+        # with sparse sampling, the tiles still cover all nodes
+        coords, _ = sample_nodes(OSM_FILE, sample_every=1)
+        tiles = plan_tiles(OSM_FILE, max_nodes=1e4, sample_every=10)
+        bboxes = np.array([tile['bbox'] for tile in tiles])
+        covered = ((coords[:, None, 0] >= bboxes[:, 0] - 1e-6)
+                   & (coords[:, None, 1] >= bboxes[:, 1] - 1e-6)
+                   & (coords[:, None, 0] <= bboxes[:, 2] + 1e-6)
+                   & (coords[:, None, 1] <= bboxes[:, 3] + 1e-6))
+        self.assertTrue(covered.any(axis=1).all())
+        # and the tiles fill the extent without gaps
+        extent = np.concatenate([bboxes[:, :2].min(axis=0),
+                                 bboxes[:, 2:].max(axis=0)])
+        self.assertAlmostEqual(
+            np.prod(bboxes[:, 2:] - bboxes[:, :2], axis=1).sum(),
+            np.prod(extent[2:] - extent[:2]))
+
+    def test_tile_pbf(self):
+        # the kernel registry is restored after the test
+        with mock.patch.dict(CLIP_KERNELS), \
+                tempfile.TemporaryDirectory() as tmpdir:
+            register_kernel('bbox', _build_bbox_cmd)
+            tiles = tile_pbf(OSM_FILE, tmpdir, max_nodes=2e4,
+                             sample_every=1, max_tiles_per_pass=5,
+                             kernel='bbox')
+            with open(Path(tmpdir, 'tiles.json')) as file:
+                manifest = json.load(file)
+            self.assertEqual(manifest['tiles'], tiles)
+            self.assertEqual(manifest['parent'], str(OSM_FILE))
+            for tile in tiles:
+                self.assertEqual(Path(tmpdir, tile['file']).read_text(),
+                                 str(tile['bbox']))
+        self.assertNotIn('bbox', CLIP_KERNELS)
+
+
+if __name__ == "__main__":
+    TESTS = unittest.TestLoader().loadTestsFromTestCase(TestTile)
+    unittest.TextTestRunner(verbosity=2).run(TESTS)